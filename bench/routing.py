@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+"""
+per-call cost of lookup shard routing, against the pre-compiled-table version
+
+run this from the git repo: python bench/routing.py
+"""
+
+import bisect
+import hashlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datahog import pool as dbpool
+
+
+def legacy_int_hash(digest):
+    n = 0
+    for c in digest:
+        n <<= 8
+        n |= ord(c)
+    return n
+
+def legacy_pick_from_plan(digest, plan, num=None):
+    if num is None:
+        num = legacy_int_hash(digest)
+    index = bisect.bisect_right(plan, (num % plan[-1][0], 999999999))
+    return plan[index][1]
+
+def legacy_shards_for_lookup_hash(plans, digest):
+    num = legacy_int_hash(digest)
+    seen = set()
+    for plan in plans[::-1]:
+        shard = legacy_pick_from_plan(digest, plan, num)
+        if shard in seen:
+            continue
+        seen.add(shard)
+        yield shard
+
+
+def config(shards, plans):
+    return {
+        'shards': [{'shard': i, 'count': 1, 'host': None, 'port': None,
+                'user': None, 'password': None, 'database': None}
+            for i in xrange(shards)],
+        'lookup_insertion_plans': plans,
+        'shard_bits': 8,
+        'digest_key': 'digest key',
+    }
+
+
+def main():
+    number = 200000
+    digests = [hashlib.sha1(str(i)).digest() for i in xrange(1000)]
+
+    setups = [
+        ('1 plan, 32 shards', 32, [[(i, 1) for i in xrange(32)]]),
+        ('3 plans, 32 shards', 32, [
+            [(i, 1) for i in xrange(8)],
+            [(i, 1) for i in xrange(16)],
+            [(i, 1) for i in xrange(32)]]),
+        ('3 plans, uneven weights (no table)', 32, [
+            [(i, 1009) for i in xrange(8)],
+            [(i, 1013) for i in xrange(16)],
+            [(i, 1019) for i in xrange(32)]]),
+    ]
+
+    for label, shards, plans in setups:
+        pool = dbpool.ConnectionPool(config(shards, plans))
+        prepared = pool._dbconf['lookup_insertion_plans']
+
+        state = {'i': 0}
+        def legacy():
+            state['i'] += 1
+            return list(legacy_shards_for_lookup_hash(
+                prepared, digests[state['i'] % 1000]))
+
+        def compiled():
+            state['i'] += 1
+            return list(pool.shards_for_lookup_hash(
+                digests[state['i'] % 1000]))
+
+        for d in digests:
+            assert (list(legacy_shards_for_lookup_hash(prepared, d)) ==
+                    list(pool.shards_for_lookup_hash(d)))
+
+        before = min(timeit.repeat(legacy, number=number, repeat=3))
+        after = min(timeit.repeat(compiled, number=number, repeat=3))
+        print "%-36s before %6.2f us/call  after %6.2f us/call" % (
+                label, before / number * 1e6, after / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
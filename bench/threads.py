@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+"""
+ThreadedConnPool throughput as the number of worker threads grows
+
+the connections are stand-ins that sleep for the query latency (releasing the
+GIL as a socket wait would), so this measures the pool's checkout and return
+path under contention rather than postgres.
+
+run this from the git repo: python bench/threads.py
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datahog import pool as dbpool
+
+
+LATENCY = 0.001
+
+
+class FakeCursor(object):
+    def execute(self, sql, params=()):
+        time.sleep(LATENCY)
+
+
+class FakeConn(object):
+    closed = 0
+
+    def cursor(self):
+        return FakeCursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cancel(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class BenchPool(dbpool.ThreadedConnPool):
+    def _try_conn(self, info):
+        return dbpool.PsycoConn(FakeConn())
+
+
+def config(shards, count, maxsize):
+    return {
+        'shards': [{'shard': i, 'count': count, 'max': maxsize, 'host': None,
+                'port': None, 'user': None, 'password': None,
+                'database': None}
+            for i in xrange(shards)],
+        'lookup_insertion_plans': [[(i, 1) for i in xrange(shards)]],
+        'shard_bits': 8,
+        'digest_key': 'digest key',
+    }
+
+
+def run(pool, shards, threads, duration):
+    counts = [0] * threads
+    stop = threading.Event()
+
+    def worker(n):
+        shard = n % shards
+        while not stop.is_set():
+            with pool.get_by_shard(shard, timeout=5) as conn:
+                conn.cursor().execute('select 1')
+            counts[n] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,))
+            for n in xrange(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in workers:
+        t.join()
+
+    return sum(counts) / (time.time() - start)
+
+
+def main():
+    shards = 4
+    duration = 2.0
+    pool = BenchPool(config(shards, 2, 8))
+    pool.start()
+    pool.wait_ready()
+
+    base = None
+    for threads in (1, 2, 4, 8, 16, 32, 64):
+        rate = run(pool, shards, threads, duration)
+        base = base or rate
+        stats = pool.stats()
+        print "%3d threads  %8.0f queries/s  %5.1fx  waits %-6d size %d" % (
+                threads, rate, rate / base,
+                sum(s['waits'] for s in stats.itervalues()),
+                sum(s['size'] for s in stats.itervalues()))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 
 from __future__ import absolute_import
 
-from .api import alias, name, node, prop, relationship
+from . import cache
+from .api import alias, bulk, name, node, prop, purge, relationship
 from .const import *
 from .pool import *
@@ -0,0 +1,61 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+'''future-returning versions of the :mod:`datahog.api` functions
+
+each namespace here mirrors the module of the same name in :mod:`datahog.api`,
+and takes the same arguments, but its functions require an
+:class:`AsyncioConnPool <datahog.pool.AsyncioConnPool>` and return futures.
+with trollius::
+
+    pool = datahog.AsyncioConnPool(dbconf)
+    pool.start()
+
+    @trollius.coroutine
+    def handler(value, ctx):
+        alias = yield trollius.From(datahog.aio.alias.lookup(pool, value, ctx))
+
+each call runs in a greenlet on the pool's event loop, which waits on the loop
+for postgres instead of blocking it. see
+:class:`AsyncioConnPool <datahog.pool.AsyncioConnPool>`.
+
+the ``iter`` functions aren't included, since they hold a connection across
+iterations in the caller's own code. use the ``list`` functions to page
+instead.
+'''
+
+from __future__ import absolute_import
+
+import functools
+
+from .api import alias, bulk, name, node, prop, purge, relationship
+
+
+__all__ = ['alias', 'bulk', 'name', 'node', 'prop', 'purge', 'relationship']
+
+
+class _Namespace(object):
+    def __init__(self, module):
+        self.__name__ = module.__name__
+        self.__doc__ = module.__doc__
+        for attr in module.__all__:
+            value = getattr(module, attr)
+            if not callable(value):
+                # constants like purge.TABLES pass through unchanged
+                setattr(self, attr, value)
+            elif not attr.startswith('iter'):
+                setattr(self, attr, _awaitable(value))
+
+
+def _awaitable(func):
+    @functools.wraps(func)
+    def wrapper(pool, *args, **kwargs):
+        return pool.run(func, *args, **kwargs)
+    return wrapper
+
+
+alias = _Namespace(alias)
+bulk = _Namespace(bulk)
+name = _Namespace(name)
+node = _Namespace(node)
+prop = _Namespace(prop)
+purge = _Namespace(purge)
+relationship = _Namespace(relationship)
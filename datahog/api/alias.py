@@ -6,11 +6,12 @@ import hashlib
 import hmac
 
 from .. import error
-from ..const import table, util
+from ..const import ordering, table, util
 from ..db import query, txn
 
 
-__all__ = ['set', 'lookup', 'list', 'batch', 'set_flags', 'shift', 'remove']
+__all__ = ['set', 'set_many', 'lookup', 'list', 'iter', 'batch', 'set_flags',
+        'shift', 'respace', 'remove']
 
 
 def set(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
@@ -71,6 +72,65 @@ def set(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
     return txn.set_alias(pool, base_id, ctx, value, flags, index, timeout)
 
 
+def set_many(pool, records, timeout=None):
+    '''set many aliases at once, with the guarantees of :func:`set`
+
+    calling :func:`set` for each alias costs a prepared transaction apiece.
+    this instead inserts all of the lookups that land on the same lookup
+    shard in one prepared transaction, and all of the aliases under base
+    objects on the same shard in one ordinary transaction, and commits them
+    together. as with :func:`set`, no alias or lookup is ever stored without
+    the other.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param iterable records:
+        ``(base_id, ctx, value)`` or ``(base_id, ctx, value, flags)`` tuples,
+        with the same meanings as the arguments to :func:`set`. each alias is
+        appended to the end of its ``base_id``'s list, in the order of
+        ``records``.
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list with a result for each record, in the same order. each is
+        ``True`` if the alias was stored, ``False`` if the base object
+        already had it, or the ``AliasInUse`` or ``NoObject`` exception that
+        :func:`set` would have raised for it.
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises BadContext:
+        if any record's ``ctx`` is not a registered context associated with
+        table.ALIAS. nothing is stored in that case.
+
+    :raises BadFlag:
+        if any record's ``flags`` contains something that is not a registered
+        flag associated with its ``ctx``. nothing is stored in that case.
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    rows = []
+    for n, record in enumerate(records):
+        base_id, ctx, value = record[:3]
+        if util.ctx_tbl(ctx) != table.ALIAS:
+            raise error.BadContext(ctx)
+        flags = record[3] if len(record) > 3 else None
+        rows.append((n, base_id, ctx, value,
+            util.flags_to_int(ctx, flags or [])))
+
+    if not rows:
+        return []
+
+    results = txn.set_aliases(pool, rows, timeout)
+    return [results[n] for n in xrange(len(rows))]
+
+
 def lookup(pool, value, ctx, timeout=None):
     '''retrieve an alias record by its value and context
 
@@ -118,7 +178,9 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
 
     :param int start:
         an integer representing the index in the list of aliases from which to
-        start the results
+        start the results. for a context with ``ordering.SPARSE`` this must be
+        ``0`` or a value returned by a previous call, which acts as a keyset
+        cursor that removals don't disturb
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -130,7 +192,7 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
         used as ``start`` in a subsequent call to page forward from after the
         end of this result list.
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         results = query.select_aliases(
                 conn.cursor(), base_id, ctx, limit, start)
 
@@ -142,6 +204,44 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
     return results, pos + 1
 
 
+def iter(pool, base_id, ctx, start=0, itersize=1000, timeout=None):
+    '''iterate over all the aliases under a id object for a given context
+
+    unlike paging with :func:`list`, this runs a single query on a
+    server-side cursor, and fetches rows from it ``itersize`` at a time as
+    the iteration proceeds. a connection is held from the first item until
+    the iterator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent object
+
+    :param int ctx: the alias's context
+
+    :param int start:
+        an integer representing the index in the list of aliases from which to
+        start, as with :func:`list`
+
+    :param int itersize: the number of rows to fetch from the server at once
+
+    :param timeout:
+        maximum time in seconds to wait for a database connection; the default
+        of ``None`` means no limit
+
+    :returns:
+        a generator of alias dicts (containing ``base_id``, ``ctx``,
+        ``value``, and ``flags`` keys)
+    '''
+    def rows(cursor):
+        for result in query.iter_aliases(cursor, base_id, ctx, start):
+            result['flags'] = util.int_to_flags(ctx, result['flags'])
+            yield result
+
+    return txn.iterate(pool, base_id, itersize, rows, timeout)
+
+
 def batch(pool, bid_ctx_pairs, timeout=None):
     '''perform a batch lookup of aliases under given base_ids
 
@@ -151,7 +251,8 @@ def batch(pool, bid_ctx_pairs, timeout=None):
 
     :param list bid_ctx_pairs:
         a list of two-tuples each containing base_id and ctx. the first alias
-        for each base_id/ctx will come up in the results
+        for each base_id/ctx will come up in the results. the pairs are
+        grouped by shard, and the shards are queried concurrently.
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -169,16 +270,12 @@ def batch(pool, bid_ctx_pairs, timeout=None):
     for bid, ctx in bid_ctx_pairs:
         groups.setdefault(pool.shard_by_id(bid), []).append((bid, ctx))
 
-    if timeout is not None:
-        deadline = time.time() + timeout
-
     aliases = []
-    for shard, group in groups.iteritems():
-        with pool.get_by_shard(shard, timeout=timeout) as conn:
-            aliases.extend(query.select_alias_batch(conn.cursor(), group))
-
-        if timeout is not None:
-            timeout = deadline - time.time()
+    for group_aliases in pool.scatter(groups,
+            lambda conn, group: query.select_alias_batch(
+                conn.cursor(), group),
+            timeout, True).itervalues():
+        aliases.extend(group_aliases)
 
     results = [None] * len(bid_ctx_pairs)
     for al in aliases:
@@ -272,6 +369,48 @@ def shift(pool, base_id, ctx, value, index, timeout=None):
         return query.reorder_alias(conn.cursor(), base_id, ctx, value, index)
 
 
+def respace(pool, base_id, ctx, timeout=None):
+    '''renumber the positions of a SPARSE list of aliases with even gaps
+
+    :func:`shift` and inserts at an index in ``ordering.SPARSE`` lists write
+    only the moved row while there's room between its new neighbors. this
+    restores that room everywhere, and is meant to be run now and then from
+    a background job on lists that see a lot of reordering. it leaves the
+    order alone, but ``start`` values from earlier :func:`list` calls don't
+    carry over.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent object
+
+    :param int ctx: the aliases' context
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns: the number of items that were renumbered
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises BadContext:
+        if ``ctx`` isn't a context for ``table.ALIAS`` with
+        ``ordering.SPARSE``
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if (util.ctx_tbl(ctx) != table.ALIAS
+            or util.ctx_ordering(ctx) != ordering.SPARSE):
+        raise error.BadContext(ctx)
+
+    with pool.get_by_id(base_id, timeout=timeout) as conn:
+        return query.respace(conn.cursor(), 'alias', 'base_id=%s and ctx=%s',
+                (base_id, ctx))
+
+
 def remove(pool, base_id, ctx, value, timeout=None):
     '''remove a stored alias
 
@@ -0,0 +1,195 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+import itertools
+
+from .. import error
+from ..const import table, util
+from ..db import txn
+
+
+__all__ = ['load_properties', 'load_aliases', 'load_names']
+
+
+def load_properties(pool, records, chunksize=10000, timeout=None):
+    '''set many properties at once, as when backfilling a new dataset
+
+    records are consumed ``chunksize`` at a time, partitioned by the shard of
+    their ``base_id``, and streamed to each shard with ``COPY FROM STDIN``
+    into a staging table from which they are merged into ``property``. only
+    one chunk is held in memory at a time.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param iterable records:
+        ``(base_id, ctx, value)`` or ``(base_id, ctx, value, flags)`` tuples,
+        with the same meanings as the arguments to :func:`set
+        <datahog.api.prop.set>`. if the same ``base_id/ctx`` appears more
+        than once, the last one wins.
+
+    :param int chunksize: the number of records to send in each round
+
+    :param timeout:
+        maximum time in seconds that each chunk is allowed to take; the
+        default of ``None`` means no limit
+
+    :returns:
+        a list of ``(index, exception)`` pairs for the records that couldn't
+        be stored, where ``index`` is the record's position in ``records``.
+        the exception will be a ``BadContext``, ``StorageClassError`` or
+        ``NoObject``, as :func:`set <datahog.api.prop.set>` would have
+        raised for that record.
+
+    :raises ReadOnly: if given a read-only db pool
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    return _load(pool, records, chunksize, timeout, _prepare_property,
+            txn.bulk_load_properties)
+
+
+def load_aliases(pool, records, chunksize=10000, timeout=None):
+    '''set many aliases at once, as when backfilling a new dataset
+
+    records are consumed ``chunksize`` at a time. each chunk's lookups are
+    first claimed in bulk on their lookup shards, then the aliases themselves
+    are written to the shards of their ``base_id``, both with ``COPY FROM
+    STDIN`` through staging tables.
+
+    unlike :func:`set <datahog.api.alias.set>` this isn't a two-phase commit
+    per record. when an alias can't be written because its base object
+    doesn't exist its lookup is removed again, but an exception raised
+    partway through a chunk can leave that chunk's lookups claimed without
+    their aliases. to recover, load the same records again: lookups already
+    claimed for the same ``base_id`` have their aliases written, and
+    aliases that made it in the first time are skipped.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param iterable records:
+        ``(base_id, ctx, value)`` or ``(base_id, ctx, value, flags)`` tuples,
+        with the same meanings as the arguments to :func:`set
+        <datahog.api.alias.set>`. each alias is appended to the end of its
+        ``base_id``'s list, in the order of ``records``.
+
+    :param int chunksize: the number of records to send in each round
+
+    :param timeout:
+        maximum time in seconds that each chunk is allowed to take; the
+        default of ``None`` means no limit
+
+    :returns:
+        a list of ``(index, exception)`` pairs for the records that couldn't
+        be stored, where ``index`` is the record's position in ``records``.
+        the exception will be a ``BadContext``, ``AliasInUse`` or
+        ``NoObject``. aliases that were already set on the same ``base_id``
+        are skipped without being reported.
+
+    :raises ReadOnly: if given a read-only db pool
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    return _load(pool, records, chunksize, timeout, _prepare_alias,
+            txn.bulk_load_aliases)
+
+
+def load_names(pool, records, chunksize=10000, timeout=None):
+    '''store many names at once, as when backfilling a new dataset
+
+    records are consumed ``chunksize`` at a time. each chunk's names are
+    written to the shards of their ``base_id`` with ``COPY FROM STDIN``
+    through a staging table, and then the search lookups for the ones that
+    were stored are copied straight into the lookup tables on their shards.
+
+    as with :func:`load_aliases`, this isn't a two-phase commit per record,
+    so an exception raised partway through a chunk can leave some of its
+    names without their lookups. to recover, load the same records again:
+    names that are already present get whichever of their lookups are
+    missing, with the flags given in ``records``.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param iterable records:
+        ``(base_id, ctx, value)`` or ``(base_id, ctx, value, flags)`` tuples,
+        with the same meanings as the arguments to :func:`create
+        <datahog.api.name.create>`. each name is appended to the end of its
+        ``base_id``'s list, in the order of ``records``.
+
+    :param int chunksize: the number of records to send in each round
+
+    :param timeout:
+        maximum time in seconds that each chunk is allowed to take; the
+        default of ``None`` means no limit
+
+    :returns:
+        a list of ``(index, exception)`` pairs for the records that couldn't
+        be stored, where ``index`` is the record's position in ``records``.
+        the exception will be a ``BadContext`` or ``NoObject``. names that
+        are already present are skipped without being reported.
+
+    :raises ReadOnly: if given a read-only db pool
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    return _load(pool, records, chunksize, timeout, _prepare_name,
+            txn.bulk_load_names)
+
+
+def _load(pool, records, chunksize, timeout, prepare, load):
+    records = iter(records)
+    conflicts = []
+    start = 0
+
+    while 1:
+        chunk = list(itertools.islice(records, chunksize))
+        if not chunk:
+            break
+
+        rows = []
+        found = []
+        for i, record in enumerate(chunk, start):
+            try:
+                rows.append((i,) + prepare(*record))
+            except (error.BadContext, error.StorageClassError), exc:
+                found.append((i, exc))
+
+        if rows:
+            found.extend(load(pool, rows, timeout))
+
+        found.sort(key=lambda pair: pair[0])
+        conflicts.extend(found)
+        start += len(chunk)
+
+    return conflicts
+
+
+def _prepare_property(base_id, ctx, value, flags=None):
+    if util.ctx_tbl(ctx) != table.PROPERTY or util.ctx_base_ctx(ctx) is None:
+        raise error.BadContext(ctx)
+
+    return (base_id, ctx, util.storage_wrap(ctx, value),
+            util.flags_to_int(ctx, flags or []))
+
+
+def _prepare_alias(base_id, ctx, value, flags=None):
+    if util.ctx_tbl(ctx) != table.ALIAS:
+        raise error.BadContext(ctx)
+
+    return base_id, ctx, value, util.flags_to_int(ctx, flags or [])
+
+
+def _prepare_name(base_id, ctx, value, flags=None):
+    if util.ctx_tbl(ctx) != table.NAME or util.ctx_search(ctx) is None:
+        raise error.BadContext(ctx)
+
+    return base_id, ctx, value, util.flags_to_int(ctx, flags or [])
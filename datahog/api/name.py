@@ -3,11 +3,12 @@
 from __future__ import absolute_import
 
 from .. import error
-from ..const import search as searchconst, table, util
+from ..const import ordering, search as searchconst, table, util
 from ..db import query, txn
 
 
-__all__ = ['create', 'search', 'list', 'set_flags', 'shift', 'remove']
+__all__ = ['create', 'search', 'list', 'iter', 'set_flags', 'shift',
+        'respace', 'remove']
 
 
 def create(pool, base_id, ctx, value, flags=None, index=None, timeout=None):
@@ -114,8 +115,10 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
     :param int limit: maximum number of names to return
 
     :param int start:
-        an integer representing the index in the list of aliases from which
-        to start the results
+        an integer representing the index in the list of aliases from which to
+        start the results. for a context with ``ordering.SPARSE`` this must be
+        ``0`` or a value returned by a previous call, which acts as a keyset
+        cursor that removals don't disturb
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -127,7 +130,7 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
         be used as the value of ``start`` in subsequent calls, to continue
         paging from the end of this result list
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         results = query.select_names(conn.cursor(), base_id, ctx, limit, start)
 
     pos = -1
@@ -138,6 +141,44 @@ def list(pool, base_id, ctx, limit=100, start=0, timeout=None):
     return results, pos + 1
 
 
+def iter(pool, base_id, ctx, start=0, itersize=1000, timeout=None):
+    '''iterate over all the names under a id object for a given context
+
+    this runs a single query on a server-side cursor and fetches rows from it
+    ``itersize`` at a time, so arbitrarily long lists can be walked without
+    paging through :func:`list`. a connection is held from the first item
+    until the iterator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: id of the parent object
+
+    :param int ctx: context of the names to iterate over
+
+    :param int start:
+        an integer representing the index in the list of names from which to
+        start, as with :func:`list`
+
+    :param int itersize: the number of rows to fetch from the server at once
+
+    :param timeout:
+        maximum time in seconds to wait for a database connection; the default
+        of ``None`` means no limit
+
+    :returns:
+        a generator of name dicts (each containing ``base_id``, ``ctx``,
+        ``value``, and ``flags`` keys)
+    '''
+    def rows(cursor):
+        for result in query.iter_names(cursor, base_id, ctx, start):
+            result['flags'] = util.int_to_flags(ctx, result['flags'])
+            yield result
+
+    return txn.iterate(pool, base_id, itersize, rows, timeout)
+
+
 def set_flags(pool, base_id, ctx, value, add, clear, timeout=None):
     '''remove flags from an existing name
 
@@ -220,6 +261,46 @@ def shift(pool, base_id, ctx, value, index, timeout=None):
     return txn.reorder_name(pool, base_id, ctx, value, index, timeout)
 
 
+def respace(pool, base_id, ctx, timeout=None):
+    '''renumber the positions of a SPARSE list of names with even gaps
+
+    like :func:`alias.respace <datahog.api.alias.respace>`, this is for
+    occasionally restoring the room that :func:`shift` and inserts at an
+    index rely on in ``ordering.SPARSE`` lists. ``start`` values from earlier
+    :func:`list` calls don't carry over.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent object
+
+    :param int ctx: the names' context
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns: the number of items that were renumbered
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises BadContext:
+        if ``ctx`` isn't a context for ``table.NAME`` with
+        ``ordering.SPARSE``
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if (util.ctx_tbl(ctx) != table.NAME
+            or util.ctx_ordering(ctx) != ordering.SPARSE):
+        raise error.BadContext(ctx)
+
+    with pool.get_by_id(base_id, timeout=timeout) as conn:
+        return query.respace(conn.cursor(), 'name', 'base_id=%s and ctx=%s',
+                (base_id, ctx))
+
+
 def remove(pool, base_id, ctx, value, timeout=None):
     '''remove a stored name
 
@@ -5,13 +5,14 @@ from __future__ import absolute_import
 import time
 
 from .. import error
-from ..const import context, storage, table, util
+from ..const import context, ordering, storage, table, util
 from ..db import query, txn
 
 
-__all__ = ['create', 'get', 'batch_get', 'child_of', 'list_children',
-        'get_children', 'update', 'increment', 'set_flags', 'move',
-        'shift', 'remove']
+__all__ = ['create', 'create_many', 'get', 'batch_get', 'child_of',
+        'list_children', 'iter_children', 'get_children',
+        'list_children_many', 'update', 'increment', 'set_flags', 'move',
+        'shift', 'respace_children', 'remove', 'sweep']
 
 
 _missing = object()
@@ -86,6 +87,84 @@ def create(pool, ctx, value, base_id=None, index=None, flags=None, timeout=None)
     return node
 
 
+def create_many(pool, ctx, values, base_id=None, flags=None, timeout=None):
+    '''make many new nodes of the same context at once
+
+    rather than a round trip per node (and another per edge), the nodes are
+    written with multi-row INSERTs, and their edges' positions are all
+    assigned in the same statement. the whole batch goes on a single shard
+    in a single transaction, so either all of the nodes are created or none
+    are. without a parent, that shard is picked by the
+    ``root_insertion_plan`` once for the whole batch rather than per node.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int ctx: the nodes' context
+
+    :param list values:
+        the values for the new nodes. depending on the ``ctx``'s
+        configuration, these might be different types. see `storage types`_
+        for more on that.
+
+    :param int base_id:
+        the id of the parent object for all of the nodes, if they have one.
+        they will be appended to the end of its list of children, in the
+        order of ``values``.
+
+    :param iterable flags: any flags to set on all of the new nodes
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list of node dicts (containing keys ``id``, ``ctx``, ``value``,
+        ``flags``) in the same order as ``values``
+
+    :raises ReadOnly: if the provided pool is read-only
+
+    :raises BadContext:
+        if ``ctx`` is not a context associated with table.NODE, or doesn't
+        have both ``base_ctx`` and ``storage`` configured
+
+    :raises MissingParent:
+        if ``ctx`` is configured with a ``base_ctx``, but no ``base_id``
+        was given
+
+    :raises StorageClassError:
+        if any of ``values`` doesn't have the right type for the configured
+        ``storage``
+
+    :raises NoObject:
+        if the parent object at ``base_ctx/base_id`` doesn't exist
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if util.ctx_tbl(ctx) != table.NODE:
+        raise error.BadContext(ctx)
+
+    base_ctx = util.ctx_base_ctx(ctx)
+    if base_ctx is not None and base_id is None:
+        raise error.MissingParent()
+
+    if not values:
+        return []
+
+    flags = util.flags_to_int(ctx, flags or [])
+    values = [util.storage_wrap(ctx, value) for value in values]
+
+    nodes = txn.create_nodes(pool, base_id, ctx, values, flags, timeout)
+
+    for node in nodes:
+        node['flags'] = util.int_to_flags(ctx, node['flags'])
+        node['value'] = util.storage_unwrap(ctx, node['value'])
+
+    return nodes
+
+
 def get(pool, node_id, ctx, timeout=None):
     '''fetch an existing node
 
@@ -114,7 +193,7 @@ def get(pool, node_id, ctx, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(node_id, timeout=timeout) as conn:
+    with pool.get_by_id(node_id, timeout=timeout, read=True) as conn:
         node = query.select_node(conn.cursor(), node_id, ctx)
 
     if node is None:
@@ -134,7 +213,8 @@ def batch_get(pool, nid_ctx_pairs, timeout=None):
         getting a database connection
 
     :param list nid_ctx_pairs:
-        list of ``(id, ctx)`` tuples describing the nodes to fetch
+        list of ``(id, ctx)`` tuples describing the nodes to fetch. they are
+        grouped by shard, and the shards are queried concurrently.
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -151,17 +231,11 @@ def batch_get(pool, nid_ctx_pairs, timeout=None):
     for nid, ctx in nid_ctx_pairs:
         groups.setdefault(pool.shard_by_id(nid), []).append((nid, ctx))
 
-    if timeout is not None:
-        deadline = time.time() + timeout
-
     nodes = []
-    for shard, group in groups.iteritems():
-        with pool.get_by_shard(shard, timeout=timeout) as conn:
-            nodes.extend(
-                    query.select_nodes(conn.cursor(), group))
-
-        if timeout is not None:
-            timeout = deadline - time.time()
+    for group_nodes in pool.scatter(groups,
+            lambda conn, group: query.select_nodes(conn.cursor(), group),
+            timeout, True).itervalues():
+        nodes.extend(group_nodes)
 
     results = [None] * len(nid_ctx_pairs)
     for node in nodes:
@@ -200,7 +274,7 @@ def child_of(pool, node_id, ctx, base_id, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         return query.select_edge_exists(
                 conn.cursor(), node_id, ctx, base_id)
 
@@ -220,7 +294,9 @@ def list_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
 
     :param int start:
         an integer representing the index in the list of nodes from which to
-        start the results
+        start the results. for a context with ``ordering.SPARSE`` this must be
+        ``0`` or a value returned by a previous call, which acts as a keyset
+        cursor that removals don't disturb
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -240,7 +316,7 @@ def list_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
             or util.ctx_storage(ctx) is None):
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         results = query.select_node_ids(
                 conn.cursor(), base_id, limit, start, ctx)
 
@@ -249,6 +325,48 @@ def list_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
     return [group[0] for group in results], end
 
 
+def iter_children(pool, base_id, ctx, start=0, itersize=1000, timeout=None):
+    '''iterate over the ids of all the nodes under a common parent
+
+    this runs a single query on a server-side cursor and fetches rows from it
+    ``itersize`` at a time, rather than paging with :func:`list_children`.
+    a connection is held from the first item until the iterator is exhausted
+    or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent node
+
+    :param int ctx: context of the nodes
+
+    :param int start:
+        an integer representing the index in the list of nodes from which to
+        start, as with :func:`list_children`
+
+    :param int itersize: the number of rows to fetch from the server at once
+
+    :param timeout:
+        maximum time in seconds to wait for a database connection; the default
+        of ``None`` means no limit
+
+    :returns: a generator of the int ids of the nodes
+
+    :raises BadContext:
+        if ``ctx`` isn't a registered context for ``table.NODE``, or
+        doesn't have both a ``base_ctx`` and ``storage`` configured
+    '''
+    if (util.ctx_tbl(ctx) != table.NODE
+            or util.ctx_base_ctx(ctx) is None
+            or util.ctx_storage(ctx) is None):
+        raise error.BadContext(ctx)
+
+    return txn.iterate(pool, base_id, itersize,
+            lambda cursor: query.iter_node_ids(cursor, base_id, ctx, start),
+            timeout)
+
+
 def get_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
     '''fetch the nodes under a common parent
 
@@ -264,7 +382,9 @@ def get_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
 
     :param int start:
         an integer representing the index in the list of nodes from which to
-        start the results
+        start the results. for a context with ``ordering.SPARSE`` this must be
+        ``0`` or a value returned by a previous call, which acts as a keyset
+        cursor that removals don't disturb
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -293,6 +413,104 @@ def get_children(pool, base_id, ctx, limit=100, start=0, timeout=None):
     return [node for node in nodes if node is not None], pos
 
 
+def list_children_many(pool, base_id_ctx_pairs, limit_per_parent=100,
+        fetch_nodes=False, timeout=None):
+    '''list the children under many parents at once
+
+    the parents are grouped by shard, and each shard's children are listed
+    with a single windowed query, with the shards queried concurrently.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param list base_id_ctx_pairs:
+        list of ``(base_id, ctx)`` tuples of the parent node ids and the
+        contexts of the children to list under them
+
+    :param int limit_per_parent:
+        maximum number of children to return for each parent
+
+    :param bool fetch_nodes:
+        whether to return full node dicts rather than just ids. children
+        on the same shard as their parent are fetched in that same query,
+        and any others (which can happen after a :func:`move`) with one
+        more :func:`batch_get`.
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list in the same order as ``base_id_ctx_pairs`` of two-tuples, each
+        like the return value of :func:`list_children` (or of
+        :func:`get_children` with ``fetch_nodes``): a list of the child ids
+        or node dicts, and an integer that can be used as ``start`` in a
+        subsequent call to page past these results
+
+    :raises BadContext:
+        if any of the contexts isn't a registered context for
+        ``table.NODE``, or doesn't have both a ``base_ctx`` and ``storage``
+        configured
+    '''
+    groups = {}
+    for base_id, ctx in base_id_ctx_pairs:
+        if (util.ctx_tbl(ctx) != table.NODE
+                or util.ctx_base_ctx(ctx) is None
+                or util.ctx_storage(ctx) is None):
+            raise error.BadContext(ctx)
+        groups.setdefault(pool.shard_by_id(base_id), []).append((base_id, ctx))
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    listings = {}
+    remote = []
+    for shard, rows in pool.scatter(groups,
+            lambda conn, group: query.select_children_batch(
+                conn.cursor(), group, limit_per_parent, fetch_nodes),
+            timeout, True).iteritems():
+        for row in rows:
+            listings.setdefault((row['base_id'], row['ctx']), []).append(row)
+            if (fetch_nodes and row['node'] is None
+                    and pool.shard_by_id(row['child_id']) != shard):
+                remote.append((row['child_id'], row['ctx']))
+
+    if remote:
+        if timeout is not None:
+            timeout = deadline - time.time()
+        found = {}
+        for node in batch_get(pool, remote, timeout):
+            if node is not None:
+                found[node['id']] = node
+
+    results = []
+    for base_id, ctx in base_id_ctx_pairs:
+        rows = listings.get((base_id, ctx), [])
+        end = rows[-1]['pos'] + 1 if rows else 0
+
+        if not fetch_nodes:
+            results.append(([row['child_id'] for row in rows], end))
+            continue
+
+        nodes = []
+        for row in rows:
+            node = row['node']
+            if node is not None:
+                node = dict(node,
+                        flags=util.int_to_flags(ctx, node['flags']),
+                        value=util.storage_unwrap(ctx, node['value']))
+            elif remote:
+                node = found.get(row['child_id'])
+
+            if node is not None:
+                nodes.append(node)
+
+        results.append((nodes, end))
+
+    return results
+
+
 def update(pool, node_id, ctx, value, old_value=_missing, timeout=None):
     '''overwrite the value stored in a node
 
@@ -473,6 +691,46 @@ def shift(pool, node_id, ctx, base_id, index, timeout=None):
         return query.reorder_edge(conn.cursor(), base_id, ctx, node_id, index)
 
 
+def respace_children(pool, base_id, ctx, timeout=None):
+    '''renumber the positions of a SPARSE list of child nodes with even gaps
+
+    like :func:`alias.respace <datahog.api.alias.respace>`, this is for
+    occasionally restoring the room that :func:`shift` and creating at an
+    index rely on in ``ordering.SPARSE`` lists. ``start`` values from earlier
+    :func:`list_children` calls don't carry over.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int base_id: the id of the parent node
+
+    :param int ctx: context of the child nodes
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns: the number of items that were renumbered
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises BadContext:
+        if ``ctx`` isn't a context for ``table.NODE`` with
+        ``ordering.SPARSE``
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if (util.ctx_tbl(ctx) != table.NODE
+            or util.ctx_ordering(ctx) != ordering.SPARSE):
+        raise error.BadContext(ctx)
+
+    with pool.get_by_id(base_id, timeout=timeout) as conn:
+        return query.respace(conn.cursor(), 'edge', 'base_id=%s and ctx=%s',
+                (base_id, ctx))
+
+
 def move(pool, node_id, ctx, base_id, new_base_id, index=None, timeout=None):
     '''move a node to underneath a new parent object
 
@@ -522,7 +780,7 @@ def move(pool, node_id, ctx, base_id, new_base_id, index=None, timeout=None):
             pool, node_id, ctx, base_id, new_base_id, index, timeout)
 
 
-def remove(pool, node_id, ctx, base_id=None, timeout=None):
+def remove(pool, node_id, ctx, base_id=None, timeout=None, defer=False):
     '''remove a node and all associated objects
 
     :param ConnectionPool pool:
@@ -539,6 +797,12 @@ def remove(pool, node_id, ctx, base_id=None, timeout=None):
         maximum time in seconds that the method is allowed to take; the default
         of ``None`` means no limit
 
+    :param bool defer:
+        if ``True``, only the node itself is removed right away, and it is
+        put in a queue on its shard for :func:`sweep` to clear out everything
+        under it later. this keeps the time taken independent of the size of
+        the subtree.
+
     :returns:
         boolean, whether a node was removed. this would be ``False`` if there
         is no node for the given ``node_id/ctx/base_id``
@@ -551,4 +815,49 @@ def remove(pool, node_id, ctx, base_id=None, timeout=None):
     if util.ctx_tbl(ctx) != table.NODE:
         return False
 
-    return txn.remove_node(pool, node_id, ctx, base_id, timeout)
+    return txn.remove_node(pool, node_id, ctx, base_id, timeout, defer)
+
+
+def sweep(pool, shard, limit=1000, timeout=None):
+    '''clear out a batch of the subtrees left behind by deferred removals
+
+    this takes up to ``limit`` nodes from the front of ``shard``'s queue (see
+    the ``defer`` argument to :func:`remove`) and removes the objects
+    directly under them, just as :func:`remove` would have. their child
+    nodes are removed too, but are queued on their own shards rather than
+    being recursed into. at most ``limit`` of those children are removed in
+    one call, and a queued node with more is left queued for the next, so
+    each call does a bounded amount of work. a sweeper process should call this repeatedly for every shard until
+    ``remaining`` comes back 0.
+
+    concurrent sweeps of the same shard take disjoint batches, skipping
+    over the queued nodes another sweep has already claimed. this relies on
+    ``for update skip locked``, so it requires postgres 9.5 or later.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int shard: the number of the shard whose queue to work from
+
+    :param int limit:
+        the maximum number of queued nodes to clear out, and of child nodes
+        to remove from under them
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a dict with ``swept``, the number of queued nodes cleared out by this
+        call, and ``remaining``, the number of nodes still queued on
+        ``shard`` afterwards (including any children that were just queued)
+
+    :raises ReadOnly: if given a read-only pool
+
+    :raises NoShard: if ``shard`` isn't one of the pool's shards
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    return txn.sweep_removals(pool, shard, limit, timeout)
@@ -7,7 +7,8 @@ from ..const import context, storage, table, util
 from ..db import query, txn
 
 
-__all__ = ['set', 'get', 'get_list', 'increment', 'set_flags', 'remove']
+__all__ = ['set', 'get', 'get_list', 'batch_get', 'increment', 'set_flags',
+        'remove']
 
 
 _missing = object()
@@ -103,7 +104,7 @@ def get(pool, base_id, ctx, timeout=None):
     if util.ctx_tbl(ctx) != table.PROPERTY or util.ctx_storage(ctx) is None:
         raise error.BadContext(ctx)
 
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         exists, value, flags = query.select_property(
                 conn.cursor(), base_id, ctx)
         if not exists:
@@ -138,7 +139,7 @@ def get_list(pool, base_id, ctx_list=None, timeout=None):
         ``base_id``, ``ctx``, ``flags``, and ``value`` keys) or ``None``s,
         depending on whether the property exists for a given context.
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         results = query.select_properties(conn.cursor(), base_id, ctx_list)
 
     for r in results:
@@ -148,6 +149,51 @@ def get_list(pool, base_id, ctx_list=None, timeout=None):
     return results
 
 
+def batch_get(pool, base_id_ctx_pairs, timeout=None):
+    '''fetch a list of properties, possibly from many different base_ids
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param list base_id_ctx_pairs:
+        list of ``(base_id, ctx)`` tuples describing the properties to fetch.
+        they are grouped by shard, and the shards are queried concurrently.
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list of property dicts containing ``base_id``, ``ctx``, ``flags``
+        and ``value`` keys. for any ``(base_id, ctx)`` pairs from
+        ``base_id_ctx_pairs`` for which no property could be found, a None
+        will be in that position in the results list
+
+    :raises BadContext:
+        if any of the contexts isn't a registered context associated with
+        ``table.PROPERTY``, or it doesn't have a configured ``storage``
+    '''
+    groups = {}
+    for base_id, ctx in base_id_ctx_pairs:
+        if (util.ctx_tbl(ctx) != table.PROPERTY
+                or util.ctx_storage(ctx) is None):
+            raise error.BadContext(ctx)
+        groups.setdefault(pool.shard_by_id(base_id), []).append((base_id, ctx))
+
+    found = {}
+    for props in pool.scatter(groups,
+            lambda conn, group: query.select_properties_batch(
+                conn.cursor(), group),
+            timeout, True).itervalues():
+        for prop in props:
+            prop['flags'] = util.int_to_flags(prop['ctx'], prop['flags'])
+            prop['value'] = util.storage_unwrap(prop['ctx'], prop['value'])
+            found[(prop['base_id'], prop['ctx'])] = prop
+
+    return [found.get((base_id, ctx)) for base_id, ctx in base_id_ctx_pairs]
+
+
 def increment(pool, base_id, ctx, by=1, limit=None, timeout=None):
     '''increment (or decrement) a numeric property's value
 
@@ -0,0 +1,86 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+from __future__ import absolute_import
+
+from .. import error
+from ..db import txn
+
+
+__all__ = ['TABLES', 'run']
+
+
+# every table that removes its rows by setting time_removed
+TABLES = ('property', 'alias', 'alias_lookup', 'relationship', 'node', 'edge',
+        'name', 'prefix_lookup', 'phonetic_lookup')
+
+
+def run(pool, retention, shards=None, tables=None, batchsize=1000,
+        pause=0.1, dry_run=False, progress=None, timeout=None):
+    '''permanently delete rows that were removed longer ago than ``retention``
+
+    nothing is ever deleted by the other functions, they only set
+    ``time_removed``. this reclaims those rows. each table on each shard is
+    purged ``batchsize`` rows at a time, with a transaction per batch and a
+    pause between batches to limit the load it puts on the database. the
+    shards are purged concurrently, and their tables one after another.
+
+    the batches walk each table's removed rows in ``time_removed`` order,
+    through the indexes added in ``schema/03.up.sql``, so each one carries
+    on from where the last left off instead of scanning the table again.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param retention:
+        the minimum age in seconds of the removals to purge. anything removed
+        more recently than this is left alone.
+
+    :param iterable shards:
+        the numbers of the shards to purge, the default ``None`` means all of
+        the pool's shards
+
+    :param iterable tables:
+        names of the tables to purge, which must be in :data:`TABLES`. the
+        default ``None`` means all of them.
+
+    :param int batchsize: the maximum number of rows to delete at once
+
+    :param pause:
+        time in seconds to wait between batches on the same shard
+
+    :param bool dry_run:
+        if ``True``, nothing is deleted, and the results are the numbers of
+        rows that would be
+
+    :param progress:
+        an optional function that is called as ``progress(shard, table,
+        count)`` after each batch, with the number of rows from ``table``
+        on ``shard`` purged so far. in a dry run it is called once per
+        table on each shard with the number that would be purged.
+
+    :param timeout:
+        maximum time in seconds that each batch is allowed to take; the
+        default of ``None`` means no limit
+
+    :returns:
+        a dict mapping ``(shard, table)`` pairs to the number of rows purged
+        (or that would be, in a dry run)
+
+    :raises ReadOnly: if given a read-only pool and ``dry_run`` is ``False``
+
+    :raises ValueError: if ``tables`` contains something not in :data:`TABLES`
+
+    :raises NoShard: if ``shards`` contains a shard the pool doesn't have
+    '''
+    if pool.readonly and not dry_run:
+        raise error.ReadOnly()
+
+    if tables is None:
+        tables = TABLES
+    for tbl in tables:
+        if tbl not in TABLES:
+            raise ValueError("not a purgeable table: %r" % (tbl,))
+
+    return txn.purge(pool, shards, tables, retention, batchsize, pause,
+            dry_run, progress, timeout)
@@ -3,11 +3,12 @@
 from __future__ import absolute_import
 
 from .. import error
-from ..const import table, util
+from ..const import ordering, table, util
 from ..db import query, txn
 
 
-__all__ = ['create', 'list', 'get', 'set_flags', 'shift', 'remove']
+__all__ = ['create', 'create_many', 'list', 'iter', 'get', 'batch_get',
+        'set_flags', 'shift', 'respace', 'remove']
 
 
 def create(pool, ctx, base_id, rel_id, forward_index=None, reverse_index=None,
@@ -84,6 +85,83 @@ def create(pool, ctx, base_id, rel_id, forward_index=None, reverse_index=None,
             forward_index, reverse_index, flags, timeout)
 
 
+def create_many(pool, ctx, base_id, rel_ids, flags=None, timeout=None):
+    '''relate one id object to many others at once
+
+    rather than a prepared transaction and two round trips for each
+    relationship as with :func:`create`, all of the forward relationships are
+    inserted in one statement, the reverse ones in one statement per shard of
+    their ``rel_id``, and there is one prepared transaction per shard
+    involved. the new relationships are appended to the end of their lists.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting database connections
+
+    :param int ctx: the context for the relationships
+
+    :param int base_id: the id of the object to relate the others to
+
+    :param iterable rel_ids:
+        the ids of the other objects. the forward relationships are added to
+        ``base_id``'s list in this order.
+
+    :param iterable flags:
+        the flags to set on the new relationships (default empty)
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list with a result for each of ``rel_ids``, in the same order. each
+        is ``True`` if the relationship was created, ``False`` if it already
+        existed (or ``rel_ids`` repeats an earlier id), or the ``NoObject``
+        exception that :func:`create` would have raised for a missing
+        ``rel_id`` object.
+
+    :raises ReadOnly: if given a read-only db connection pool
+
+    :raises BadContext:
+        if ``ctx`` is not a context associated with ``table.RELATIONSHIP``, or
+        it doesn't have both a ``base_ctx`` and a ``rel_ctx`` configured.
+
+    :raises BadFlag:
+        if ``flags`` contains something that is not a flag associated with the
+        given ``ctx``
+
+    :raises NoObject: if the object at ``base_ctx/base_id`` doesn't exist
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if (util.ctx_tbl(ctx) != table.RELATIONSHIP
+            or util.ctx_base_ctx(ctx) is None
+            or util.ctx_rel_ctx(ctx) is None):
+        raise error.BadContext(ctx)
+
+    flags = util.flags_to_int(ctx, flags or [])
+
+    rel_ids = tuple(rel_ids)
+    distinct = []
+    seen = set()
+    for rel_id in rel_ids:
+        if rel_id not in seen:
+            seen.add(rel_id)
+            distinct.append(rel_id)
+
+    if not distinct:
+        return []
+
+    results = txn.create_relationships(
+            pool, ctx, base_id, distinct, flags, timeout)
+
+    created = []
+    for rel_id in rel_ids:
+        created.append(results.pop(rel_id, False))
+    return created
+
+
 def list(pool, id, ctx, forward=True, limit=100, start=0, timeout=None):
     '''list the relationships associated with a id object
 
@@ -103,7 +181,9 @@ def list(pool, id, ctx, forward=True, limit=100, start=0, timeout=None):
 
     :param int start:
         an integer representing the index in the list of relationships from
-        which to start the results
+        which to start the results. for a context with ``ordering.SPARSE`` this
+        must be ``0`` or a value returned by a previous call, which acts as a
+        keyset cursor that removals don't disturb
 
     :param timeout:
         maximum time in seconds that the method is allowed to take; the default
@@ -115,8 +195,9 @@ def list(pool, id, ctx, forward=True, limit=100, start=0, timeout=None):
         that can be used as ``start`` in a subsequent call to page forward from
         after the end of this result list.
     '''
-    with pool.get_by_id(id, timeout=timeout) as conn:
-        results = query.select_relationships(conn.cursor(), id, ctx, forward, limit, start)
+    with pool.get_by_id(id, timeout=timeout, read=True) as conn:
+        results = query.select_relationships(
+                conn.cursor(), id, ctx, forward, limit, start)
 
     pos = 0
     for result in results:
@@ -126,6 +207,49 @@ def list(pool, id, ctx, forward=True, limit=100, start=0, timeout=None):
     return results, pos
 
 
+def iter(pool, id, ctx, forward=True, start=0, itersize=1000, timeout=None):
+    '''iterate over all the relationships associated with a id object
+
+    this runs a single query on a server-side cursor and fetches rows from it
+    ``itersize`` at a time, so even very long relationship lists can be
+    walked in bounded memory and without a new query per page. a connection
+    is held from the first item until the iterator is exhausted or closed.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int id: id of the parent object
+
+    :param int ctx: context of the relationships to fetch
+
+    :param bool forward:
+        if ``True``, then iterates over relationships which have ``id`` as
+        their ``base_id``, otherwise ``id`` refers to ``rel_id``
+
+    :param int start:
+        an integer representing the index in the list of relationships from
+        which to start, as with :func:`list`
+
+    :param int itersize: the number of rows to fetch from the server at once
+
+    :param timeout:
+        maximum time in seconds to wait for a database connection; the default
+        of ``None`` means no limit
+
+    :returns:
+        a generator of relationship dicts (containing ``ctx``, ``base_id``,
+        ``rel_id``, and ``flags`` keys)
+    '''
+    def rows(cursor):
+        for result in query.iter_relationships(
+                cursor, id, ctx, forward, start):
+            result['flags'] = util.int_to_flags(ctx, result['flags'])
+            yield result
+
+    return txn.iterate(pool, id, itersize, rows, timeout)
+
+
 def get(pool, ctx, base_id, rel_id, timeout=None):
     '''fetch the relationship between two ids
 
@@ -147,7 +271,7 @@ def get(pool, ctx, base_id, rel_id, timeout=None):
         a relationship dict (with ``ctx``, ``base_id``, ``rel_id``, and
         ``flags`` keys) or None if there is no such relationship
     '''
-    with pool.get_by_id(base_id, timeout=timeout) as conn:
+    with pool.get_by_id(base_id, timeout=timeout, read=True) as conn:
         rels = query.select_relationships(
                 conn.cursor(), base_id, ctx, True, 1, 0, rel_id)
 
@@ -159,6 +283,45 @@ def get(pool, ctx, base_id, rel_id, timeout=None):
     return rel
 
 
+def batch_get(pool, triples, timeout=None):
+    '''fetch the relationships between many pairs of ids
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param list triples:
+        list of ``(ctx, base_id, rel_id)`` tuples describing the relationships
+        to fetch. they are grouped by the shard of ``base_id``, and the shards
+        are queried concurrently.
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns:
+        a list of relationship dicts (with ``ctx``, ``base_id``, ``rel_id``,
+        and ``flags`` keys). for any triples for which there is no such
+        relationship, a None will be in that position in the results list
+    '''
+    groups = {}
+    for ctx, base_id, rel_id in triples:
+        groups.setdefault(pool.shard_by_id(base_id), []).append(
+                (ctx, base_id, rel_id))
+
+    found = {}
+    for rels in pool.scatter(groups,
+            lambda conn, group: query.select_relationships_batch(
+                conn.cursor(), group),
+            timeout, True).itervalues():
+        for rel in rels:
+            rel['flags'] = util.int_to_flags(rel['ctx'], rel['flags'])
+            found[(rel['ctx'], rel['base_id'], rel['rel_id'])] = rel
+
+    return [found.get((ctx, base_id, rel_id))
+            for ctx, base_id, rel_id in triples]
+
+
 def set_flags(pool, base_id, rel_id, ctx, add, clear, timeout=None):
     '''remove flags from a relationship
 
@@ -253,6 +416,52 @@ def shift(pool, base_id, rel_id, ctx, forward, index, timeout=None):
                 conn.cursor(), base_id, rel_id, ctx, forward, index)
 
 
+def respace(pool, id, ctx, forward=True, timeout=None):
+    '''renumber the positions of a SPARSE list of relationships with even gaps
+
+    like :func:`alias.respace <datahog.api.alias.respace>`, this is for
+    occasionally restoring the room that :func:`shift` and creating at an
+    index rely on in ``ordering.SPARSE`` lists. ``start`` values from earlier
+    :func:`list` calls don't carry over.
+
+    :param ConnectionPool pool:
+        a :class:`ConnectionPool <datahog.dbconn.ConnectionPool>` to use for
+        getting a database connection
+
+    :param int id: id of the object whose list to renumber
+
+    :param int ctx: context of the relationships
+
+    :param bool forward:
+        if ``True``, renumbers the relationships which have ``id`` as their
+        ``base_id``, otherwise those with ``id`` as their ``rel_id``
+
+    :param timeout:
+        maximum time in seconds that the method is allowed to take; the default
+        of ``None`` means no limit
+
+    :returns: the number of items that were renumbered
+
+    :raises ReadOnly: if given a read-only ``pool``
+
+    :raises BadContext:
+        if ``ctx`` isn't a context for ``table.RELATIONSHIP`` with
+        ``ordering.SPARSE``
+    '''
+    if pool.readonly:
+        raise error.ReadOnly()
+
+    if (util.ctx_tbl(ctx) != table.RELATIONSHIP
+            or util.ctx_ordering(ctx) != ordering.SPARSE):
+        raise error.BadContext(ctx)
+
+    with pool.get_by_id(id, timeout=timeout) as conn:
+        return query.respace(conn.cursor(), 'relationship',
+                '%s=%%s and ctx=%%s and forward=%%s' % (
+                    'base_id' if forward else 'rel_id',),
+                (id, ctx, forward))
+
+
 def remove(pool, base_id, rel_id, ctx, timeout=None):
     '''remove a relationship
 
@@ -0,0 +1,94 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import collections
+import threading
+import time
+
+
+__all__ = ['LRUCache']
+
+
+class LRUCache(object):
+    '''A size-bounded in-process cache with least-recently-used eviction
+
+    This is the reference implementation of the cache interface used by the
+    ``alias_cache`` key of a :class:`ConnectionPool`'s ``dbconf``. Anything
+    providing the same ``get``, ``set`` and ``delete`` methods can be plugged
+    in instead.
+
+    it is safe to share between the threads of a
+    :class:`ThreadedConnPool <datahog.pool.ThreadedConnPool>`: each operation
+    holds an internal lock.
+
+    :param int maxsize:
+        the maximum number of entries to hold before evicting the least
+        recently used one
+
+    :param ttl:
+        number of seconds after which a stored value expires. the default of
+        ``None`` means entries only leave the cache through eviction or
+        invalidation.
+
+    :param negative_ttl:
+        number of seconds after which a stored ``None`` (a cached miss)
+        expires. defaults to the same as ``ttl``, and ``0`` turns off negative
+        caching entirely.
+    '''
+    _missing = object()
+
+    def __init__(self, maxsize=10000, ttl=None, negative_ttl=_missing):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        if negative_ttl is self._missing:
+            negative_ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        '''fetch the value stored under ``key``
+
+        :returns:
+            the value, or ``default`` if there is nothing (unexpired) for it
+        '''
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                return default
+
+            # re-insert to mark it as most recently used
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        'store ``value`` under ``key``, evicting the oldest entry if full'
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl == 0:
+            self.delete(key)
+            return
+
+        expires = None if ttl is None else time.time() + ttl
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        'drop anything stored under ``key``'
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        'drop everything'
+        with self._lock:
+            self._data.clear()
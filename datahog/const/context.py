@@ -4,7 +4,7 @@ from __future__ import absolute_import
 
 import mummy
 
-from . import search, storage, table
+from . import ordering, search, storage, table
 
 
 META = {}
@@ -64,6 +64,22 @@ def set_context(value, tbl, meta=None):
             phonetic_loose
                 for ``table.NAME`` and ``search.PHONETIC``, setting this to
                 ``True`` (default ``False``) enables looser phonetic matching.
+
+            ordering
+                how positions are kept in the ordered lists of ``table.ALIAS``,
+                ``table.NAME``, ``table.RELATIONSHIP`` and child
+                ``table.NODE`` contexts. must be one of the ordering constants
+                ``DENSE`` (the default) or ``SPARSE``.
+
+                ``DENSE`` lists number their items consecutively, so removing,
+                shifting or inserting at an index renumbers every item in
+                between. ``SPARSE`` lists leave gaps between positions, so
+                removals touch only the removed row, shifts and inserts at an
+                index usually only the one being placed, and the ``start``
+                values returned by the list functions become keyset cursors
+                that later removals don't disturb. the gaps can be restored
+                with the ``respace`` functions. ``SPARSE`` requires the ``01``
+                schema migration.
     '''
     if value in META:
         raise ValueError("duplicate context value: %s" % value)
@@ -84,6 +100,9 @@ def set_context(value, tbl, meta=None):
         if meta.get('storage', storage.NULL) not in storage.ALL:
             raise ValueError("unrecognized storage type: %d" % meta['storage'])
 
+        if meta.get('ordering', ordering.DENSE) not in ordering.ALL:
+            raise ValueError("unrecognized ordering: %r" % meta['ordering'])
+
         if 'schema' in meta:
             meta['schema'] = type('Schema', (mummy.Message,),
                     {'SCHEMA': meta['schema']})
@@ -5,7 +5,7 @@ from __future__ import absolute_import
 import mummy
 import psycopg2
 from functools import wraps
-from . import context, flag, storage, table
+from . import context, flag, ordering, storage, table
 from .. import error
 
 
@@ -90,6 +90,12 @@ def ctx_phonetic_loose(ctx):
     return meta and meta[1].get('phonetic_loose')
 
 
+def ctx_ordering(ctx):
+    "return the list ordering mode for a context"
+    meta = context.META.get(ctx)
+    return (meta and meta[1] or {}).get('ordering', ordering.DENSE)
+
+
 def flags_to_int(ctx, flag_list):
     "convert an iterable of flag consts to a single bitmap integer"
     if ctx not in context.META:
@@ -2,13 +2,142 @@
 
 from __future__ import absolute_import
 
+import binascii
+import cStringIO
+import re
+
 import psycopg2
 
-from ..const import context, storage, table, util
+from ..const import context, ordering, storage, table, util
 
 
 _missing = object() # default argument sentinel
 
+# distance between the positions of consecutive appends to SPARSE lists
+_SPARSE_GAP = 1 << 16
+
+
+def _execute_prepared(cursor, sql, params):
+    # cursors from a pool configured with ``prepare_statements`` PREPARE each
+    # distinct statement text once per connection, then EXECUTE it after that
+    execute = getattr(cursor, 'execute_prepared', None)
+    if execute is None:
+        return cursor.execute(sql, params)
+    return execute(sql, params)
+
+
+def _pos_step(ctx):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        return _SPARSE_GAP
+    return 1
+
+
+def _sparse_insert_pos(cursor, tbl, where, params, index):
+    # pick a position for a new item at ``index`` in a SPARSE list, halfway
+    # between its new neighbors. None means the list is too short, so append.
+    cursor.execute("""
+select pos
+from %s
+where
+    time_removed is null
+    and %s
+order by pos asc
+offset %%s
+limit 2
+""" % (tbl, where), params + (max(index - 1, 0),))
+
+    positions = [row[0] for row in cursor.fetchall()]
+    if index > 0:
+        if len(positions) < 2:
+            return None
+        before, after = positions
+    else:
+        if not positions:
+            return None
+        before, after = 0, positions[0]
+
+    if after - before < 2:
+        # out of room between these two, so open up a gap
+        cursor.execute("""
+update %s
+set pos=pos + %d
+where
+    time_removed is null
+    and %s
+    and pos >= %%s
+""" % (tbl, _SPARSE_GAP, where), params + (after,))
+        after += _SPARSE_GAP
+
+    return before + (after - before) // 2
+
+
+def _sparse_move(cursor, tbl, where, params, key, key_params, index):
+    # shift the item matching ``key`` to ``index`` in a SPARSE list by only
+    # rewriting its own position (in the common case)
+    cursor.execute("""
+select 1
+from %s
+where
+    time_removed is null
+    and %s
+    and %s
+for update
+""" % (tbl, where, key), params + key_params)
+
+    # a missing item mustn't open up a gap under the rows after it
+    if not cursor.rowcount:
+        return False
+
+    others = '%s and not (%s)' % (where, key)
+    pos = _sparse_insert_pos(cursor, tbl, others, params + key_params, index)
+
+    if pos is None:
+        cursor.execute("""
+update %s
+set pos=coalesce((
+    select pos + %d
+    from %s
+    where
+        time_removed is null
+        and %s
+    order by pos desc
+    limit 1
+), %d)
+where
+    time_removed is null
+    and %s
+    and %s
+""" % (tbl, _SPARSE_GAP, tbl, others, _SPARSE_GAP, where, key),
+            params + key_params + params + key_params)
+    else:
+        cursor.execute("""
+update %s
+set pos=%%s
+where
+    time_removed is null
+    and %s
+    and %s
+""" % (tbl, where, key), (pos,) + params + key_params)
+
+    return bool(cursor.rowcount)
+
+
+def respace(cursor, tbl, where, params):
+    cursor.execute("""
+update %s t
+set pos=renumbered.n * %d
+from (
+    select ctid, row_number() over (order by pos asc) as n
+    from %s
+    where
+        time_removed is null
+        and %s
+) as renumbered
+where t.ctid=renumbered.ctid
+""" % (tbl, _SPARSE_GAP, tbl, where), params)
+
+    return cursor.rowcount
+
 
 def select_property(cursor, base_id, ctx):
     if util.ctx_storage(ctx) == storage.INT:
@@ -16,7 +145,7 @@ def select_property(cursor, base_id, ctx):
     else:
         val_field = 'value'
 
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select %s, flags
 from property
 where
@@ -62,6 +191,25 @@ where
     return map(results.get, ctxs)
 
 
+def select_properties_batch(cursor, pairs):
+    flat_pairs = reduce(lambda a, b: a.extend(b) or a, pairs, [])
+
+    cursor.execute("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and (base_id, ctx) in (%s)
+""" % (','.join('(%s, %s)' for pair in pairs),), flat_pairs)
+
+    return [{
+            'base_id': base_id,
+            'ctx': ctx,
+            'flags': flags,
+            'value': num if util.ctx_storage(ctx) == storage.INT else value,
+        } for base_id, ctx, num, value, flags in cursor.fetchall()]
+
+
 def upsert_property(cursor, base_id, ctx, value, flags):
     if util.ctx_storage(ctx) == storage.INT:
         val_field = 'num'
@@ -204,7 +352,7 @@ where
 
 def select_alias_lookup(cursor, digest, ctx):
     digest = psycopg2.Binary(digest)
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select base_id, flags
 from alias_lookup
 where
@@ -226,7 +374,7 @@ where
 
 
 def select_aliases(cursor, base_id, ctx, limit, start):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select flags, value, pos
 from alias
 where
@@ -247,6 +395,29 @@ limit %s
         } for flags, value, pos in cursor.fetchall()]
 
 
+def iter_aliases(cursor, base_id, ctx, start):
+    # ``cursor`` is a named (server-side) cursor, so iterating over it pulls
+    # rows down ``cursor.itersize`` at a time rather than all at once
+    cursor.execute("""
+select flags, value
+from alias
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (base_id, ctx, start))
+
+    for flags, value in cursor:
+        yield {
+            'base_id': base_id,
+            'flags': flags,
+            'ctx': ctx,
+            'value': value.decode('utf8'),
+        }
+
+
 def select_alias_batch(cursor, pairs):
     flat_pairs = reduce(lambda a, b: a.extend(b) or a, pairs, [])
 
@@ -303,12 +474,30 @@ from selectquery
 def insert_alias(cursor, base_id, ctx, value, index, flags):
     base_tbl, base_ctx = util.ctx_base(ctx)
     base_tbl = table.NAMES[base_tbl]
+    step = _pos_step(ctx)
+
+    if index is not None and step != 1:
+        index = _sparse_insert_pos(cursor, 'alias', 'base_id=%s and ctx=%s',
+                (base_id, ctx), index)
+        if index is not None:
+            cursor.execute("""
+insert into alias (base_id, ctx, value, pos, flags)
+select %%s, %%s, %%s, %%s, %%s
+where exists (
+    select 1 from %s
+    where
+        time_removed is null
+        and id=%%s
+        and ctx=%%s
+)
+""" % (base_tbl,), (base_id, ctx, value, index, flags, base_id, base_ctx))
+            return bool(cursor.rowcount)
 
     if index is None:
         cursor.execute("""
 insert into alias (base_id, ctx, value, pos, flags)
 select %%s, %%s, %%s, coalesce((
-    select pos + 1
+    select pos + %d
     from alias
     where
         time_removed is null
@@ -316,7 +505,7 @@ select %%s, %%s, %%s, coalesce((
         and ctx=%%s
     order by pos desc
     limit 1
-), 1), %%s
+), %d), %%s
 where exists (
     select 1 from %s
     where
@@ -324,7 +513,7 @@ where exists (
         and id=%%s
         and ctx=%%s
 )
-""" % (base_tbl,),
+""" % (step, step, base_tbl),
             (base_id, ctx, value, base_id, ctx, flags, base_id, base_ctx))
     else:
         cursor.execute("""
@@ -357,6 +546,10 @@ returning 1
 
 
 def reorder_alias(cursor, base_id, ctx, value, pos):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        return _sparse_move(cursor, 'alias', 'base_id=%s and ctx=%s',
+                (base_id, ctx), 'value=%s', (value,), pos)
+
     cursor.execute("""
 with oldpos as (
     select pos
@@ -428,6 +621,19 @@ where
 
 
 def remove_alias(cursor, base_id, ctx, value):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        cursor.execute("""
+update alias
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (base_id, ctx, value))
+
+        return bool(cursor.rowcount)
+
     cursor.execute("""
 with removal as (
     update alias
@@ -501,7 +707,53 @@ def insert_relationship(cursor, base_id, rel_id, ctx, forward, index, flags):
         forward = True
         id_col = 'base_id'
 
-    if index is None:
+    if index is not None and util.ctx_ordering(ctx) == ordering.SPARSE:
+        index = _sparse_insert_pos(cursor, 'relationship',
+                '%s=%%s and ctx=%%s and forward=%%s' % (id_col,),
+                (id, ctx, forward), index)
+        if index is not None:
+            cursor.execute("""
+insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+select %s, %s, %s, %s, %s, %s
+where exists (
+    select 1
+    from node
+    where
+        time_removed is null
+        and id=%s
+)
+returning 1
+""", (base_id, rel_id, ctx, forward, index, flags, id))
+            return cursor.rowcount
+
+    if index is None and util.ctx_ordering(ctx) == ordering.SPARSE:
+        cursor.execute("""
+insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+select %%s, %%s, %%s, %%s, coalesce((
+    select pos + %d
+    from relationship
+    where
+        time_removed is null
+        and %s=%%s
+        and ctx=%%s
+        and forward=%%s
+    order by pos desc
+    limit 1
+), %d), %%s
+where exists (
+    select 1
+    from node
+    where
+        time_removed is null
+        and id=%%s
+)
+returning 1
+""" % (_SPARSE_GAP, id_col, _SPARSE_GAP), (
+        base_id, rel_id, ctx, forward,
+        id, ctx, forward,
+        flags,
+        id))
+    elif index is None:
         cursor.execute("""
 insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
 select %%s, %%s, %%s, %%s, (
@@ -564,7 +816,91 @@ returning 1
     return cursor.rowcount
 
 
-def select_relationships(cursor, id, ctx, forward, limit, start, other_id=_missing):
+def insert_relationships(cursor, ctx, rows, forward, flags):
+    # rows are (n, base_id, rel_id), each appended to the end of the list it
+    # belongs to on this side, in the order of n. returns (n, nobase) pairs
+    # for the rows that weren't inserted, with nobase saying whether that was
+    # because the node on this side is missing (or else the relationship
+    # was already there).
+    id_col = 'base_id' if forward else 'rel_id'
+    step = _pos_step(ctx)
+    if step == 1:
+        start = """(
+        select count(*)
+        from relationship t
+        where
+            t.time_removed is null
+            and t.%s=fresh.id
+            and t.ctx=%%s
+            and t.forward=%%s
+    )""" % (id_col,)
+    else:
+        start = """coalesce((
+        select pos + %d
+        from relationship t
+        where
+            t.time_removed is null
+            and t.%s=fresh.id
+            and t.ctx=%%s
+            and t.forward=%%s
+        order by pos desc
+        limit 1
+    ), %d)""" % (step, id_col, step)
+
+    flat = []
+    for row in rows:
+        flat.extend(row)
+
+    cursor.execute("""
+with staged (n, base_id, rel_id) as (
+    values %s
+),
+eligible as (
+    select s.n, s.base_id, s.rel_id, s.%s as id
+    from staged s
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=s.%s
+    )
+),
+fresh as (
+    select e.n, e.base_id, e.rel_id, e.id
+    from eligible e
+    where not exists (
+        select 1
+        from relationship t
+        where
+            t.time_removed is null
+            and t.base_id=e.base_id
+            and t.rel_id=e.rel_id
+            and t.ctx=%%s
+            and t.forward=%%s
+    )
+),
+insertquery as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select fresh.base_id, fresh.rel_id, %%s, %%s, %s + (row_number() over (
+        partition by fresh.id
+        order by fresh.n
+    ) - 1)%s, %%s
+    from fresh
+    returning 1
+)
+select s.n, s.n not in (select n from eligible)
+from staged s
+where s.n not in (select n from fresh)
+""" % (', '.join('(%s, %s, %s)' for row in rows), id_col, id_col, start,
+        _step_factor(ctx)),
+        tuple(flat) + (ctx, forward, ctx, forward, ctx, forward, flags))
+
+    return cursor.fetchall()
+
+
+def select_relationships(cursor, id, ctx, forward, limit, start,
+        other_id=_missing):
     here_name = "base_id" if forward else "rel_id"
     other_name = "rel_id" if forward else "base_id"
 
@@ -575,7 +911,7 @@ def select_relationships(cursor, id, ctx, forward, limit, start, other_id=_missi
         clause = "and %s=%%s" % (other_name,)
         params = (id, ctx, forward, start, other_id, limit)
 
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select %s, flags, pos
 from relationship
 where
@@ -598,6 +934,52 @@ limit %%s
         for other_id, flags, pos in cursor.fetchall()]
 
 
+def iter_relationships(cursor, id, ctx, forward, start):
+    here_name = "base_id" if forward else "rel_id"
+    other_name = "rel_id" if forward else "base_id"
+
+    cursor.execute("""
+select %s, flags
+from relationship
+where
+    time_removed is null
+    and %s=%%s
+    and ctx=%%s
+    and forward=%%s
+    and pos >= %%s
+order by pos asc
+""" % (other_name, here_name), (id, ctx, forward, start))
+
+    for other_id, flags in cursor:
+        yield {
+            here_name: id,
+            'flags': flags,
+            other_name: other_id,
+            'ctx': ctx}
+
+
+def select_relationships_batch(cursor, triples):
+    flat = []
+    for ctx, base_id, rel_id in triples:
+        flat.extend((base_id, ctx, rel_id))
+
+    cursor.execute("""
+select base_id, ctx, rel_id, flags
+from relationship
+where
+    time_removed is null
+    and forward=true
+    and (base_id, ctx, rel_id) in (%s)
+""" % (','.join('(%s, %s, %s)' for t in triples),), flat)
+
+    return [{
+            'base_id': base_id,
+            'flags': flags,
+            'rel_id': rel_id,
+            'ctx': ctx,
+        } for base_id, ctx, rel_id, flags in cursor.fetchall()]
+
+
 @util.reorder_args_for_undirected_rels
 def remove_relationship(cursor, base_id, rel_id, ctx, forward):
     # TODO remove undirected rels (and other cases)
@@ -608,6 +990,20 @@ def remove_relationship(cursor, base_id, rel_id, ctx, forward):
         anchor_id = rel_id
         anchor_col = "rel_id"
 
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        cursor.execute("""
+update relationship
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and rel_id=%s
+""", (base_id, ctx, forward, rel_id))
+
+        return bool(cursor.rowcount)
+
     cursor.execute("""
 with removal as (
     update relationship
@@ -718,6 +1114,12 @@ def reorder_relationship(cursor, base_id, rel_id, ctx, forward, pos):
     anchor_col = "base_id" if forward else "rel_id"
     anchor_id = base_id if forward else rel_id
 
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        return _sparse_move(cursor, 'relationship',
+                '%s=%%s and ctx=%%s and forward=%%s' % (anchor_col,),
+                (anchor_id, ctx, forward),
+                'base_id=%s and rel_id=%s', (base_id, rel_id), pos)
+
     cursor.execute("""
 with oldpos as (
     select pos
@@ -804,6 +1206,92 @@ returning id
     }
 
 
+def insert_nodes(cursor, base_id, ctx, values, flags):
+    if util.ctx_storage(ctx) == storage.INT:
+        val_field, val_type = 'num', 'bigint'
+    else:
+        val_field, val_type = 'value', 'bytea'
+
+    if base_id is None:
+        existence = ""
+        existence_params = ()
+    else:
+        existence = """
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=%s
+            and ctx=%s
+    )"""
+        existence_params = (base_id, util.ctx_base_ctx(ctx))
+
+    flat = []
+    for i, value in enumerate(values):
+        flat.append(value)
+        flat.append(i)
+
+    # the ids are drawn up front so that each one comes back with the index
+    # of its value, rather than relying on the order the sequence hands them
+    # out in
+    cursor.execute("""
+with newnodes (id, v, n) as (
+    select nextval('node_ids'), v, n
+    from (values %s) as newvalues (v, n)%s
+), insertion as (
+    insert into node (id, ctx, %s, flags)
+    select id, %%s, v, %%s
+    from newnodes
+)
+select id, n
+from newnodes
+""" % (','.join('(%%s::%s, %%s)' % (val_type,) for v in values),
+            existence, val_field),
+        tuple(flat) + existence_params + (ctx, flags))
+
+    ids = dict((n, id) for id, n in cursor.fetchall())
+    if not ids:
+        return []
+
+    return [{
+            'id': ids[i],
+            'ctx': ctx,
+            'flags': flags,
+            'value': value,
+        } for i, value in enumerate(values)]
+
+
+def _step_factor(ctx):
+    step = _pos_step(ctx)
+    return '' if step == 1 else ' * %d' % (step,)
+
+
+def insert_edges(cursor, base_id, ctx, child_ids):
+    flat = []
+    for i, child_id in enumerate(child_ids):
+        flat.append(child_id)
+        flat.append(i + 1)
+
+    cursor.execute("""
+insert into edge (base_id, ctx, child_id, pos)
+select %%s, %%s, newedges.child_id, newedges.n%s + coalesce((
+    select pos
+    from edge
+    where
+        time_removed is null
+        and base_id=%%s
+        and ctx=%%s
+    order by pos desc
+    limit 1
+), 0)
+from (values %s) as newedges (child_id, n)
+""" % (_step_factor(ctx), ','.join('(%s, %s)' for c in child_ids)),
+        (base_id, ctx, base_id, ctx) + tuple(flat))
+
+    return cursor.rowcount
+
+
 def insert_edge(cursor, base_id, ctx, child_id, pos=None, check=False):
     if check:
         where = '''exists(
@@ -816,12 +1304,24 @@ def insert_edge(cursor, base_id, ctx, child_id, pos=None, check=False):
         where_params = (base_id, util.ctx_base_ctx(ctx))
     else:
         where, where_params = 'true', ()
+    step = _pos_step(ctx)
+
+    if pos is not None and step != 1:
+        pos = _sparse_insert_pos(cursor, 'edge', 'base_id=%s and ctx=%s',
+                (base_id, ctx), pos)
+        if pos is not None:
+            cursor.execute('''
+insert into edge (base_id, ctx, child_id, pos)
+select %%s, %%s, %%s, %%s
+where %s
+''' % (where,), (base_id, ctx, child_id, pos) + where_params)
+            return bool(cursor.rowcount)
 
     if pos is None:
         cursor.execute('''
 insert into edge (base_id, ctx, child_id, pos)
 select %%s, %%s, %%s, coalesce((
-    select pos + 1
+    select pos + %d
     from edge
     where
         time_removed is null
@@ -829,9 +1329,10 @@ select %%s, %%s, %%s, coalesce((
         and ctx=%%s
     order by pos desc
     limit 1
-), 1)
+), %d)
 where %s
-''' % (where,), (base_id, ctx, child_id, base_id, ctx) + where_params)
+''' % (step, step, where), (base_id, ctx, child_id, base_id, ctx) +
+            where_params)
     else:
         cursor.execute('''
 with bump as (
@@ -860,7 +1361,7 @@ def select_node(cursor, nid, ctx):
     else:
         val_field = 'value'
 
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select flags, %s
 from node
 where
@@ -883,7 +1384,7 @@ where
 
 
 def select_edge_exists(cursor, child_id, ctx, base_id):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select 1
 from edge
 where
@@ -916,7 +1417,7 @@ where
 
 
 def select_node_ids(cursor, base_id, limit, pos, ctx):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select child_id, ctx, pos
 from edge
 where
@@ -931,6 +1432,78 @@ limit %s
     return cursor.fetchall()
 
 
+def iter_node_ids(cursor, base_id, ctx, start):
+    cursor.execute("""
+select child_id
+from edge
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (base_id, ctx, start))
+
+    for row in cursor:
+        yield row[0]
+
+
+def select_children_batch(cursor, pairs, limit, with_nodes):
+    flat_pairs = reduce(lambda a, b: a.extend(b) or a, pairs, [])
+
+    if with_nodes:
+        # only finds the children that live on this same shard
+        node_fields = ", n.flags, n.num, n.value"
+        node_join = """
+left join node n
+on
+    n.time_removed is null
+    and n.id=w.child_id
+    and n.ctx=w.ctx"""
+    else:
+        node_fields = node_join = ""
+
+    cursor.execute("""
+with window_query as (
+    select base_id, ctx, child_id, pos, row_number() over (
+        partition by base_id, ctx
+        order by pos
+    ) as r
+    from edge
+    where
+        time_removed is null
+        and (base_id, ctx) in (%s)
+)
+select w.base_id, w.ctx, w.child_id, w.pos%s
+from window_query w%s
+where w.r <= %%s
+order by w.base_id, w.ctx, w.pos
+""" % (','.join('(%s, %s)' for pair in pairs), node_fields, node_join),
+        flat_pairs + [limit])
+
+    if not with_nodes:
+        return [{
+                'base_id': base_id,
+                'ctx': ctx,
+                'child_id': child_id,
+                'pos': pos,
+            } for base_id, ctx, child_id, pos in cursor.fetchall()]
+
+    return [{
+            'base_id': base_id,
+            'ctx': ctx,
+            'child_id': child_id,
+            'pos': pos,
+            'node': None if flags is None else {
+                'id': child_id,
+                'ctx': ctx,
+                'flags': flags,
+                'value': num if util.ctx_storage(ctx) == storage.INT else val,
+            },
+        } for base_id, ctx, child_id, pos, flags, num, val
+            in cursor.fetchall()]
+
+
 def update_node(cursor, nid, ctx, value, old_value=_missing):
     int_storage = util.ctx_storage(ctx) == storage.INT
     if int_storage:
@@ -995,6 +1568,10 @@ returning num
 
 
 def reorder_edge(cursor, base_id, ctx, child_id, pos):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        return _sparse_move(cursor, 'edge', 'base_id=%s and ctx=%s',
+                (base_id, ctx), 'child_id=%s', (child_id,), pos)
+
     cursor.execute("""
 with oldpos as (
     select pos
@@ -1050,6 +1627,19 @@ select exists (select 1 from move)
 
 
 def remove_edge(cursor, base_id, ctx, child_id):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        cursor.execute("""
+update edge
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and child_id=%s
+""", (base_id, ctx, child_id))
+
+        return bool(cursor.rowcount)
+
     cursor.execute("""
 with removal as (
     update edge
@@ -1076,8 +1666,9 @@ select 1 from removal
     return bool(cursor.rowcount)
 
 
-def remove_edges_multiple_bases(cursor, base_ids):
-    cursor.execute("""
+def remove_edges_multiple_bases(cursor, base_ids, limit=None):
+    if limit is None:
+        cursor.execute("""
 update edge
 set time_removed=now()
 where
@@ -1085,6 +1676,21 @@ where
     and base_id in (%s)
 returning child_id
 """ % (','.join('%s' for b in base_ids),), base_ids)
+    else:
+        cursor.execute("""
+update edge
+set time_removed=now()
+where ctid in (
+    select ctid
+    from edge
+    where
+        time_removed is null
+        and base_id in (%s)
+    limit %%s
+    for update
+)
+returning child_id
+""" % (','.join('%s' for b in base_ids),), tuple(base_ids) + (limit,))
 
     return [r[0] for r in cursor.fetchall()]
 
@@ -1102,15 +1708,76 @@ returning id
     return [r[0] for r in cursor.fetchall()]
 
 
+def enqueue_removals(cursor, ids):
+    cursor.execute("""
+insert into remove_queue (id)
+values %s
+""" % (','.join('(%s)' for id in ids),), ids)
+
+
+def requeue_unswept(cursor, ids):
+    cursor.execute("""
+insert into remove_queue (id)
+select distinct base_id
+from edge
+where
+    time_removed is null
+    and base_id in (%s)
+""" % (','.join('%s' for id in ids),), ids)
+
+
+def dequeue_removals(cursor, limit):
+    cursor.execute("""
+delete from remove_queue
+where ctid in (
+    select ctid
+    from remove_queue
+    order by time_queued
+    limit %s
+    for update skip locked
+)
+returning id
+""", (limit,))
+
+    return [r[0] for r in cursor.fetchall()]
+
+
+def count_removals(cursor):
+    cursor.execute("""
+select count(*)
+from remove_queue
+""", ())
+
+    return cursor.fetchone()[0]
+
+
 def insert_name(cursor, base_id, ctx, value, flags, index):
     base_tbl, base_ctx = util.ctx_base(ctx)
     base_tbl = table.NAMES[base_tbl]
+    step = _pos_step(ctx)
+
+    if index is not None and step != 1:
+        index = _sparse_insert_pos(cursor, 'name', 'base_id=%s and ctx=%s',
+                (base_id, ctx), index)
+        if index is not None:
+            cursor.execute("""
+insert into name (base_id, ctx, value, flags, pos)
+select %%s, %%s, %%s, %%s, %%s
+where exists (
+    select 1 from %s
+    where
+        time_removed is null
+        and id=%%s
+        and ctx=%%s
+)
+""" % (base_tbl,), (base_id, ctx, value, flags, index, base_id, base_ctx))
+            return cursor.rowcount
 
     if index is None:
         cursor.execute("""
 insert into name (base_id, ctx, value, flags, pos)
 select %%s, %%s, %%s, %%s, coalesce((
-    select pos + 1
+    select pos + %d
     from name
     where
         time_removed is null
@@ -1118,7 +1785,7 @@ select %%s, %%s, %%s, %%s, coalesce((
         and ctx=%%s
     order by pos desc
     limit 1
-), 1)
+), %d)
 where exists (
     select 1 from %s
     where
@@ -1126,7 +1793,7 @@ where exists (
         and id=%%s
         and ctx=%%s
 )
-""" % (base_tbl,), (
+""" % (step, step, base_tbl), (
             base_id, ctx, value, flags,
             base_id, ctx,
             base_id, base_ctx))
@@ -1179,7 +1846,7 @@ values (%s, %s, %s, %s, %s)
 
 
 def select_names(cursor, base_id, ctx, limit, start):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select flags, value, pos
 from name
 where
@@ -1200,6 +1867,27 @@ limit %s
         } for flags, value, pos in cursor.fetchall()]
 
 
+def iter_names(cursor, base_id, ctx, start):
+    cursor.execute("""
+select flags, value
+from name
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (base_id, ctx, start))
+
+    for flags, value in cursor:
+        yield {
+            'base_id': base_id,
+            'flags': flags,
+            'ctx': ctx,
+            'value': value,
+        }
+
+
 def select_prefix_lookups(cursor, value, ctx, base_id=None):
     if base_id is None:
         bid_where = ""
@@ -1208,7 +1896,7 @@ def select_prefix_lookups(cursor, value, ctx, base_id=None):
         bid_where = "and base_id=%s"
         params = (ctx, value, base_id)
 
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select base_id, flags
 from prefix_lookup
 where
@@ -1227,7 +1915,7 @@ where
 
 
 def find_phonetic_lookup(cursor, code, ctx, value, base_id):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select 1
 from phonetic_lookup
 where
@@ -1242,7 +1930,7 @@ where
 
 
 def search_prefixes(cursor, value, ctx, limit, start):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select base_id, flags, value
 from prefix_lookup
 where
@@ -1263,7 +1951,7 @@ limit %s
 
 
 def search_phonetics(cursor, code, ctx, limit, start):
-    cursor.execute("""
+    _execute_prepared(cursor, """
 select base_id, flags, value
 from phonetic_lookup
 where
@@ -1285,6 +1973,10 @@ limit %s
 
 
 def reorder_name(cursor, base_id, ctx, value, index):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        return _sparse_move(cursor, 'name', 'base_id=%s and ctx=%s',
+                (base_id, ctx), 'value=%s', (value,), index)
+
     cursor.execute("""
 with oldpos as (
     select pos
@@ -1340,6 +2032,19 @@ select 1 from move
 
 
 def remove_name(cursor, base_id, ctx, value):
+    if util.ctx_ordering(ctx) == ordering.SPARSE:
+        cursor.execute("""
+update name
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (base_id, ctx, value))
+
+        return bool(cursor.rowcount)
+
     cursor.execute("""
 with removal as (
     update name
@@ -1471,3 +2176,355 @@ returning flags
 """ % (table, s_clause, w_clause), s_values + w_values)
 
     return [x[0] for x in cursor.fetchall()]
+
+
+_copy_escapes = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+_copy_special = re.compile(r'[\\\t\n\r]')
+
+
+def _copy_field(value):
+    # render a single value in COPY's text format
+    if value is None:
+        return '\\N'
+
+    if isinstance(value, util._Binary):
+        return '\\\\x' + binascii.hexlify(value.adapted)
+
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    else:
+        value = str(value)
+
+    return _copy_special.sub(lambda m: _copy_escapes[m.group()], value)
+
+
+def copy_rows(cursor, tbl, columns, rows):
+    buf = cStringIO.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(_copy_field, row)))
+        buf.write('\n')
+    buf.seek(0)
+
+    cursor.copy_from(buf, tbl, columns=columns)
+
+
+_staging_columns = {
+    'property': 'base_id bigint, ctx smallint, num bigint, value bytea, '
+            'flags smallint',
+    'alias_lookup': 'hash bytea, ctx smallint, base_id bigint, flags smallint',
+    'alias': 'base_id bigint, ctx smallint, value varchar(255), '
+            'flags smallint',
+    'name': 'base_id bigint, ctx smallint, value varchar(255), '
+            'flags smallint',
+    'prefix_lookup': 'value varchar(255), flags smallint, ctx smallint, '
+            'base_id bigint',
+    'phonetic_lookup': 'value varchar(255), code varchar(4), '
+            'flags smallint, ctx smallint, base_id bigint',
+}
+
+
+def create_staging_table(cursor, tbl):
+    # staging rows carry their index ``n`` in the load, for error reporting
+    name = 'bulk_%s' % (tbl,)
+    cursor.execute("""
+create temporary table %s (n int not null, %s)
+on commit drop
+""" % (name, _staging_columns[tbl]))
+
+    return name
+
+
+def merge_staged_properties(cursor, staging, ctx):
+    base_tbl, base_ctx = util.ctx_base(ctx)
+    base_tbl = table.NAMES[base_tbl]
+
+    cursor.execute("""
+with missing as (
+    select s.n
+    from %s s
+    where
+        s.ctx=%%s
+        and not exists (
+            select 1
+            from %s b
+            where
+                b.time_removed is null
+                and b.id=s.base_id
+                and b.ctx=%%s
+        )
+),
+staged as (
+    select distinct on (s.base_id) s.base_id, s.num, s.value, s.flags
+    from %s s
+    where
+        s.ctx=%%s
+        and s.n not in (select n from missing)
+    order by s.base_id, s.n desc
+),
+updatequery as (
+    update property p
+    set num=staged.num, value=staged.value
+    from staged
+    where
+        p.time_removed is null
+        and p.base_id=staged.base_id
+        and p.ctx=%%s
+    returning p.base_id
+),
+insertquery as (
+    insert into property (base_id, ctx, num, value, flags)
+    select staged.base_id, %%s, staged.num, staged.value, staged.flags
+    from staged
+    where staged.base_id not in (select base_id from updatequery)
+    returning 1
+)
+select n
+from missing
+""" % (staging, base_tbl, staging), (ctx, base_ctx, ctx, ctx, ctx))
+
+    return [r[0] for r in cursor.fetchall()]
+
+
+def select_alias_lookups(cursor, pairs):
+    flat = []
+    for digest, ctx in pairs:
+        flat.append(psycopg2.Binary(digest))
+        flat.append(ctx)
+
+    cursor.execute("""
+select hash, ctx, base_id
+from alias_lookup
+where
+    time_removed is null
+    and (hash, ctx) in (%s)
+""" % (','.join('(%s, %s)' for pair in pairs),), flat)
+
+    return [(str(digest), ctx, base_id)
+            for digest, ctx, base_id in cursor.fetchall()]
+
+
+def merge_staged_alias_lookups(cursor, staging):
+    return _merge_alias_lookups(cursor, staging, "", ())
+
+
+def insert_alias_lookups(cursor, rows):
+    # the same merge as above, but from a values list rather than a staging
+    # table, since a transaction that touched a temporary table can't be
+    # prepared. rows are (n, digest, ctx, base_id, flags)
+    flat = []
+    for n, digest, ctx, base_id, flags in rows:
+        flat.extend((n, psycopg2.Binary(digest), ctx, base_id, flags))
+
+    values = """staged (n, hash, ctx, base_id, flags) as (
+    values %s
+),
+""" % (', '.join('(%s, %s, %s, %s, %s)' for row in rows),)
+
+    return _merge_alias_lookups(cursor, 'staged', values, flat)
+
+
+def _merge_alias_lookups(cursor, staging, values, params):
+    # returns (n, base_id) pairs of the rows that lost to an existing lookup,
+    # or to an earlier row for the same hash/ctx
+    cursor.execute("""
+with %sexisting as (
+    select s.n, l.base_id
+    from %s s
+    join alias_lookup l
+    on
+        l.time_removed is null
+        and l.hash=s.hash
+        and l.ctx=s.ctx
+),
+winners as (
+    select distinct on (s.hash, s.ctx) s.n, s.hash, s.ctx, s.base_id
+    from %s s
+    where s.n not in (select n from existing)
+    order by s.hash, s.ctx, s.n
+),
+insertquery as (
+    insert into alias_lookup (hash, ctx, base_id, flags)
+    select s.hash, s.ctx, s.base_id, s.flags
+    from %s s
+    where s.n in (select n from winners)
+    returning 1
+)
+select s.n, coalesce(e.base_id, w.base_id)
+from %s s
+left join existing e on e.n=s.n
+left join winners w on w.hash=s.hash and w.ctx=s.ctx
+where s.n not in (select n from winners)
+""" % (values, staging, staging, staging, staging), params)
+
+    return cursor.fetchall()
+
+
+def merge_staged_list(cursor, staging, tbl, ctx, uniq=False):
+    return _merge_list(cursor, staging, "", (), tbl, ctx, uniq)
+
+
+def insert_list_rows(cursor, tbl, rows, ctx):
+    # the same merge as above, but from a values list rather than a staging
+    # table, since a transaction that touched a temporary table can't be
+    # prepared. rows are (n, base_id, ctx, value, flags)
+    flat = []
+    for row in rows:
+        flat.extend(row)
+
+    values = """incoming (n, base_id, ctx, value, flags) as (
+    values %s
+),
+""" % (', '.join('(%s, %s, %s, %s, %s)' for row in rows),)
+
+    return _merge_list(cursor, 'incoming', values, flat, tbl, ctx, False)
+
+
+def _merge_list(cursor, staging, values, params, tbl, ctx, uniq):
+    # returns (n, missing) pairs of the rows that weren't inserted, with
+    # ``missing`` true when that was for lack of a base object
+    base_tbl, base_ctx = util.ctx_base(ctx)
+    base_tbl = table.NAMES[base_tbl]
+
+    if uniq:
+        # the same value can't appear twice under one base_id/ctx
+        dedupe = """
+        and not exists (
+            select 1
+            from %s t
+            where
+                t.time_removed is null
+                and t.base_id=s.base_id
+                and t.ctx=s.ctx
+                and t.value=s.value
+        )""" % (tbl,)
+        distinct = "distinct on (s.base_id, s.value)"
+        order = "order by s.base_id, s.value, s.n"
+    else:
+        dedupe = distinct = order = ""
+
+    cursor.execute("""
+with %smissing as (
+    select s.n
+    from %s s
+    where
+        s.ctx=%%s
+        and not exists (
+            select 1
+            from %s b
+            where
+                b.time_removed is null
+                and b.id=s.base_id
+                and b.ctx=%%s
+        )
+),
+staged as (
+    select %s s.n, s.base_id, s.value, s.flags
+    from %s s
+    where
+        s.ctx=%%s
+        and s.n not in (select n from missing)%s
+    %s
+),
+insertquery as (
+    insert into %s (base_id, ctx, value, flags, pos)
+    select staged.base_id, %%s, staged.value, staged.flags, row_number() over (
+        partition by staged.base_id
+        order by staged.n
+    )%s + coalesce((
+        select pos
+        from %s t
+        where
+            t.time_removed is null
+            and t.base_id=staged.base_id
+            and t.ctx=%%s
+        order by pos desc
+        limit 1
+    ), 0)
+    from staged
+    returning 1
+)
+select s.n, s.n in (select n from missing)
+from %s s
+where
+    s.ctx=%%s
+    and s.n not in (select n from staged)
+""" % (values, staging, base_tbl, distinct, staging, dedupe, order, tbl,
+        _step_factor(ctx), tbl, staging),
+        tuple(params) + (ctx, base_ctx, ctx, ctx, ctx, ctx))
+
+    return cursor.fetchall()
+
+
+def merge_staged_lookups(cursor, staging, tbl):
+    # only the lookups that aren't there yet, once each
+    match = ['ctx', 'base_id', 'value']
+    columns = ['value', 'flags', 'ctx', 'base_id']
+    if tbl == 'phonetic_lookup':
+        match.append('code')
+        columns.insert(1, 'code')
+
+    cursor.execute("""
+insert into %s (%s)
+select distinct on (%s) %s
+from %s s
+where not exists (
+    select 1
+    from %s l
+    where
+        l.time_removed is null
+        and %s
+)
+order by %s, s.n
+""" % (tbl, ', '.join(columns),
+            ', '.join('s.' + col for col in match),
+            ', '.join('s.' + col for col in columns),
+            staging, tbl,
+            '\n        and '.join('l.%s=s.%s' % (col, col) for col in match),
+            ', '.join('s.' + col for col in match)))
+
+
+def purge_cutoff(cursor, retention):
+    cursor.execute("""
+select now() - %s * interval '1 second'
+""", (retention,))
+
+    return cursor.fetchone()[0]
+
+
+def purge_removed(cursor, tbl, cutoff, after, limit):
+    # batches walk the <tbl>_removed index from ``after``, the latest
+    # time_removed of the previous batch, rather than starting over each time
+    if after is None:
+        start = ""
+        params = (cutoff, limit)
+    else:
+        start = "\n        and time_removed >= %s"
+        params = (cutoff, after, limit)
+
+    cursor.execute("""
+with batch as (
+    select ctid, time_removed
+    from %s
+    where
+        time_removed < %%s%s
+    order by time_removed
+    limit %%s
+), removal as (
+    delete from %s
+    where ctid = any(array(select ctid from batch))
+)
+select count(*), max(time_removed)
+from batch
+""" % (tbl, start, tbl), params)
+
+    return cursor.fetchone()
+
+
+def count_purgeable(cursor, tbl, retention):
+    cursor.execute("""
+select count(*)
+from %s
+where time_removed < now() - %%s * interval '1 second'
+""" % (tbl,), (retention,))
+
+    return cursor.fetchone()[0]
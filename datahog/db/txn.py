@@ -14,17 +14,23 @@ import psycopg2.extensions
 
 from . import query
 from .. import error
-from ..const import search, table, util
+from ..const import ordering, search, storage, table, util
 
 
 class TwoPhaseCommit(object):
-    def __init__(self, pool, shard, name, uniq_data):
+    # with ``local``, the writes that would go "elsewhere" are known to be on
+    # this same shard. then no transaction is prepared: this one is left open
+    # on its connection, :meth:`get_by_id` and :meth:`get_by_shard` hand that
+    # connection to the other writes, and :meth:`commit` is an ordinary one.
+    def __init__(self, pool, shard, name, uniq_data, local=False):
         self._pool = pool
         self._shard = shard
         self._name = name
         self._uniq_data = uniq_data
         self._conn = None
         self._failed = False
+        self.local = local
+        self._held = None
 
     def _free_conn(self):
         self._pool.put(self._conn)
@@ -38,6 +44,10 @@ class TwoPhaseCommit(object):
         return self._conn
 
     def rollback(self):
+        if self.local:
+            self._finish_local(False)
+            return
+
         conn = self._get_conn()
         try:
             conn.tpc_rollback(self._xid)
@@ -50,6 +60,10 @@ class TwoPhaseCommit(object):
             self._free_conn()
 
     def commit(self):
+        if self.local:
+            self._finish_local(True)
+            return
+
         conn = self._get_conn()
         try:
             conn.tpc_commit(self._xid)
@@ -61,12 +75,50 @@ class TwoPhaseCommit(object):
         finally:
             self._free_conn()
 
+    def _finish_local(self, commit):
+        conn, self._held = self._held, None
+        if conn is None:
+            # already rolled back on leaving the with block
+            return
+
+        try:
+            if commit:
+                conn.commit()
+            else:
+                conn.rollback()
+        finally:
+            self._pool.put(conn)
+
     def fail(self):
         self._failed = True
 
+    def release(self, conn):
+        # give back the connection from the with block, unless it is still
+        # holding the open local transaction
+        if conn is not self._held:
+            self._pool.put(conn)
+
+    def get_by_id(self, id, replace=True):
+        return self.get_by_shard(self._pool.shard_by_id(id), replace)
+
+    def get_by_shard(self, shard, replace=True):
+        if self._held is None or shard != self._shard:
+            return self._pool.get_by_shard(shard, replace=replace)
+
+        if not replace:
+            return self._held
+        return self._held_context()
+
+    @contextlib.contextmanager
+    def _held_context(self):
+        # unlike the pool's context, leaves committing to commit()
+        yield self._held
+
     def __enter__(self):
         intxn = False
         conn = self._get_conn()
+        if self.local:
+            return conn
 
         xid = []
         for ud in self._uniq_data:
@@ -79,7 +131,13 @@ class TwoPhaseCommit(object):
 
     def __exit__(self, klass=None, exc=None, tb=None):
         try:
-            if self._failed or exc is not None:
+            if self.local:
+                if self._failed or exc is not None:
+                    self._conn.rollback()
+                    self._failed = True
+                else:
+                    self._held = self._conn
+            elif self._failed or exc is not None:
                 self._conn.tpc_rollback()
                 self._failed = True
             else:
@@ -113,13 +171,21 @@ class TwoPhaseCommit(object):
                 self.commit()
 
 
+def _local(pool, *shards):
+    # whether the writes of a two-phase commit can share one ordinary
+    # transaction instead, because they all land on the same shard
+    return pool.one_phase_local and len(set(shards)) == 1
+
+
 class Timer(object):
     def __init__(self, pool, timeout, conn):
         self.pool = pool
         self.timeout = timeout
         self.conn = conn
+        self.deadline = None
 
     def __enter__(self):
+        self.deadline = time.time() + self.timeout
         self.t = self.pool._timer(self.timeout, self.ding)
         self.t.start()
         return self
@@ -133,6 +199,40 @@ class Timer(object):
         if self.conn is not None:
             self.conn.cancel()
 
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+
+def _probe_shards(pool, shards, probe, timer, read=False):
+    # run probe(cursor) against candidate lookup shards, returning the
+    # (shard, result) of the first truthy result in plan priority order
+    shards = list(shards)
+
+    if not pool.concurrent_lookups or len(shards) < 2:
+        for shard in shards:
+            with pool.get_by_shard(shard, read=read) as conn:
+                timer.conn = conn
+                try:
+                    result = probe(conn.cursor())
+                finally:
+                    timer.conn = None
+
+            if result:
+                return shard, result
+
+        return None, None
+
+    results = pool.scatter(dict.fromkeys(shards),
+            lambda conn, group: probe(conn.cursor()), timer.remaining(), read)
+
+    for shard in shards:
+        if results.get(shard):
+            return shard, results[shard]
+
+    return None, None
+
 
 def set_property(conn, base_id, ctx, value, flags):
     cursor = conn.cursor()
@@ -146,7 +246,41 @@ def set_property(conn, base_id, ctx, value, flags):
         return False, bool(updated)
 
 
+_missing = object() # default argument sentinel
+
+
+def _uncache_alias(pool, digest, ctx):
+    if pool.alias_cache is None:
+        return
+
+    # lookups that started before this won't write back their results. the
+    # pool lock makes the bump and delete one step against lookup_alias's
+    # compare and set, under a ThreadedConnPool
+    with pool._lock:
+        pool.alias_cache_epoch += 1
+        pool.alias_cache.delete((digest, ctx))
+
+
 def lookup_alias(pool, digest, ctx, timeout):
+    cache = pool.alias_cache
+    if cache is None:
+        return _timed_lookup_alias(pool, digest, ctx, timeout)
+
+    alias = cache.get((digest, ctx), _missing)
+    if alias is not _missing:
+        # callers decorate the dict, so never hand out the cached one
+        return alias and dict(alias)
+
+    epoch = pool.alias_cache_epoch
+    alias = _timed_lookup_alias(pool, digest, ctx, timeout)
+
+    with pool._lock:
+        if pool.alias_cache_epoch == epoch:
+            cache.set((digest, ctx), alias and dict(alias))
+
+    return alias
+
+def _timed_lookup_alias(pool, digest, ctx, timeout):
     timer = Timer(pool, timeout, None)
     if timeout is None:
         return _lookup_alias(pool, digest, ctx, timer)
@@ -154,48 +288,42 @@ def lookup_alias(pool, digest, ctx, timeout):
         return _lookup_alias(pool, digest, ctx, timer)
 
 def _lookup_alias(pool, digest, ctx, timer):
-    for shard in pool.shards_for_lookup_hash(digest):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
+    # with an alias cache, a lagging replica's answer could be cached past
+    # the invalidation for a write it hadn't seen yet
+    shard, alias = _probe_shards(pool, pool.shards_for_lookup_hash(digest),
+            lambda cursor: query.select_alias_lookup(cursor, digest, ctx),
+            timer, pool.alias_cache is None)
 
-            alias = query.select_alias_lookup(conn.cursor(), digest, ctx)
-            if alias is not None:
-                return alias
+    return alias
 
-            timer.conn = None
 
-    return None
+def _alias_digest(pool, alias):
+    return hmac.new(pool.digestkey, alias.encode('utf8'),
+            hashlib.sha1).digest()
 
 
 def set_alias(pool, base_id, ctx, alias, flags, index, timeout):
     timer = Timer(pool, timeout, None)
-    if timeout is None:
-        return _set_alias(pool, base_id, ctx, alias, flags, index, timer)
-    with timer:
-        return _set_alias(pool, base_id, ctx, alias, flags, index, timer)
+    try:
+        if timeout is None:
+            return _set_alias(pool, base_id, ctx, alias, flags, index, timer)
+        with timer:
+            return _set_alias(pool, base_id, ctx, alias, flags, index, timer)
+    finally:
+        if pool.alias_cache is not None:
+            _uncache_alias(pool, _alias_digest(pool, alias), ctx)
 
 def _set_alias(pool, base_id, ctx, alias, flags, index, timer):
-    digest = hmac.new(pool.digestkey, alias.encode('utf8'),
-            hashlib.sha1).digest()
+    digest = _alias_digest(pool, alias)
     digest_b64 = digest.encode('base64').strip()
 
     # look up pre-existing aliases on any but the current insert shard
     insert_shard = pool.shard_for_alias_write(digest)
-    owner = None
-    for shard in pool.shards_for_lookup_hash(digest):
-        if shard == insert_shard:
-            continue
-
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-            try:
-                owner = query.select_alias_lookup(conn.cursor(), digest, ctx)
-            finally:
-                timer.conn = None
-        del conn
-
-        if owner is not None:
-            break
+    shard, owner = _probe_shards(pool,
+            [s for s in pool.shards_for_lookup_hash(digest)
+                if s != insert_shard],
+            lambda cursor: query.select_alias_lookup(cursor, digest, ctx),
+            timer)
 
     if owner is not None:
         if owner['base_id'] == base_id:
@@ -204,7 +332,8 @@ def _set_alias(pool, base_id, ctx, alias, flags, index, timer):
         raise error.AliasInUse(alias, ctx)
 
     tpc = TwoPhaseCommit(pool, insert_shard, 'set_alias',
-            (base_id, ctx, digest_b64))
+            (base_id, ctx, digest_b64),
+            _local(pool, insert_shard, pool.shard_by_id(base_id)))
     conn = None
     try:
         with tpc as conn:
@@ -232,11 +361,11 @@ def _set_alias(pool, base_id, ctx, alias, flags, index, timer):
 
     finally:
         if conn is not None:
-            pool.put(conn)
+            tpc.release(conn)
         timer.conn = None
 
     with tpc.elsewhere():
-        with pool.get_by_id(base_id) as conn:
+        with tpc.get_by_id(base_id) as conn:
             timer.conn = conn
             try:
                 result = query.insert_alias(
@@ -255,39 +384,203 @@ def _set_alias(pool, base_id, ctx, alias, flags, index, timer):
     return True
 
 
-def set_alias_flags(pool, base_id, ctx, alias, add, clear, timeout):
+def set_aliases(pool, rows, timeout):
     timer = Timer(pool, timeout, None)
-    if timeout is None:
-        return _set_alias_flags(pool, base_id, ctx, alias, add, clear, timer)
-    with timer:
-        return _set_alias_flags(pool, base_id, ctx, alias, add, clear, timer)
+    try:
+        if timeout is None:
+            return _set_aliases(pool, rows, timer)
+        with timer:
+            return _set_aliases(pool, rows, timer)
+    finally:
+        if pool.alias_cache is not None:
+            for n, base_id, ctx, alias, flags in rows:
+                _uncache_alias(pool, _alias_digest(pool, alias), ctx)
+
+def _set_aliases(pool, rows, timer):
+    # rows are (n, base_id, ctx, alias, flags). returns {n: result}, with
+    # results as _set_alias would have returned or raised them
+    digests = dict((row[0], _alias_digest(pool, row[3])) for row in rows)
+    results = {}
+
+    # look up pre-existing aliases on any but the current insert shards
+    probes = {}
+    for n, base_id, ctx, alias, flags in rows:
+        insert_shard = pool.shard_for_alias_write(digests[n])
+        for shard in pool.shards_for_lookup_hash(digests[n]):
+            if shard != insert_shard:
+                probes.setdefault(shard, set()).add((digests[n], ctx))
+
+    owners = {}
+    if probes:
+        found = pool.scatter(probes, lambda conn, pairs:
+                query.select_alias_lookups(conn.cursor(), sorted(pairs)),
+                timer.remaining())
+        for lookups in found.itervalues():
+            for digest, ctx, base_id in lookups:
+                owners[(digest, ctx)] = base_id
+
+    pending = []
+    for row in rows:
+        n, base_id, ctx, alias, flags = row
+        owner = owners.get((digests[n], ctx))
+        if owner is None:
+            pending.append(row)
+        else:
+            results[n] = _alias_refusal(owner, base_id, alias, ctx)
 
-def _set_alias_flags(pool, base_id, ctx, alias, add, clear, timer):
-    digest = hmac.new(pool.digestkey, alias.encode('utf8'),
-            hashlib.sha1).digest()
-    digest_b64 = digest.encode('base64').strip()
+    # normally a single round. if any base objects turn out to be missing,
+    # everything is rolled back and tried again without those rows, so no
+    # lookup is ever committed without its alias.
+    while pending:
+        tpcs, written = {}, []
+        try:
+            refused = _claim_alias_lookups(pool, tpcs, pending, digests, timer)
+
+            claimed = []
+            for row in pending:
+                n, base_id, ctx, alias, flags = row
+                if n in refused:
+                    results[n] = _alias_refusal(
+                            refused[n], base_id, alias, ctx)
+                else:
+                    claimed.append(row)
+
+            missing = _insert_aliases(pool, written, claimed, timer)
+        except Exception:
+            klass, exc, tb = sys.exc_info()
+            for tpc in tpcs.values() + written:
+                try:
+                    tpc.rollback()
+                except Exception:
+                    pass
+            raise klass, exc, tb
+
+        # every alias and lookup is prepared by now, so they are committed
+        # (or rolled back) together
+        if not missing:
+            for shard, tpc in sorted(tpcs.iteritems()):
+                tpc.commit()
+            for tpc in written:
+                tpc.commit()
+            for n, base_id, ctx, alias, flags in claimed:
+                results[n] = True
+            break
 
-    for shard in pool.shards_for_lookup_hash(digest):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
+        for shard, tpc in sorted(tpcs.iteritems()):
+            tpc.rollback()
+        for tpc in written:
+            tpc.rollback()
+
+        pending = []
+        for row in claimed:
+            n, base_id, ctx, alias, flags = row
+            if n in missing:
+                results[n] = _no_base(ctx, base_id)
+            else:
+                pending.append(row)
+
+    return results
+
+def _alias_refusal(owner, base_id, alias, ctx):
+    if owner == base_id:
+        return False
+    return error.AliasInUse(alias, ctx)
+
+def _claim_alias_lookups(pool, tpcs, rows, digests, timer):
+    # prepare a transaction on each lookup shard that inserts all of its
+    # lookups, adding them to ``tpcs``. the shards are taken in order so
+    # that concurrent batches can't deadlock on each other's lookups.
+    # returns {n: owning base_id} for the rows that were refused.
+    refused = {}
+    groups = _by_shard(rows,
+            lambda row: pool.shard_for_alias_write(digests[row[0]]))
+
+    for shard, group in sorted(groups.iteritems()):
+        lookups = [(n, digests[n], ctx, base_id, flags)
+                for n, base_id, ctx, alias, flags in group]
+
+        # a unique violation means a concurrent insert of one of the same
+        # lookups got in first, and a second try will see it as taken
+        for attempt in (0, 1):
+            tpc = TwoPhaseCommit(pool, shard, 'set_aliases',
+                    (group[0][1], shard, len(group)))
+            conn = None
             try:
-                owner = query.select_alias_lookup(conn.cursor(), digest, ctx)
+                with tpc as conn:
+                    timer.conn = conn
+                    found = query.insert_alias_lookups(conn.cursor(), lookups)
+                    if len(found) == len(group):
+                        tpc.fail()
+                break
+            except psycopg2.IntegrityError:
+                if attempt:
+                    raise
             finally:
+                if conn is not None:
+                    pool.put(conn)
                 timer.conn = None
 
-            if owner is None:
-                continue
+        refused.update(found)
+        if len(found) < len(group):
+            tpcs[shard] = tpc
+
+    return refused
+
+def _insert_aliases(pool, tpcs, rows, timer):
+    # prepare a transaction on each base shard that writes its alias rows,
+    # adding them to ``tpcs``. returns the set of ``n`` whose base object is
+    # missing, in which case the caller rolls everything back.
+    missing = set()
+    groups = _by_shard(rows, lambda row: pool.shard_by_id(row[1]))
+    for shard, group in sorted(groups.iteritems()):
+        tpc = TwoPhaseCommit(pool, shard, 'set_aliases_base',
+                (group[0][1], shard, len(group)))
+        tpcs.append(tpc)
+        conn = None
+        try:
+            with tpc as conn:
+                timer.conn = conn
+                cursor = conn.cursor()
+                for ctx in sorted(set(row[2] for row in group)):
+                    missing.update(n for n, nobase in query.insert_list_rows(
+                        cursor, 'alias',
+                        [row for row in group if row[2] == ctx], ctx))
+        finally:
+            if conn is not None:
+                pool.put(conn)
+            timer.conn = None
 
-            if owner['base_id'] != base_id:
-                return None
+    return missing
 
-            lookup_shard = shard
-            break
-    else:
+
+def set_alias_flags(pool, base_id, ctx, alias, add, clear, timeout):
+    timer = Timer(pool, timeout, None)
+    try:
+        if timeout is None:
+            return _set_alias_flags(
+                    pool, base_id, ctx, alias, add, clear, timer)
+        with timer:
+            return _set_alias_flags(
+                    pool, base_id, ctx, alias, add, clear, timer)
+    finally:
+        if pool.alias_cache is not None:
+            _uncache_alias(pool, _alias_digest(pool, alias), ctx)
+
+def _set_alias_flags(pool, base_id, ctx, alias, add, clear, timer):
+    digest = _alias_digest(pool, alias)
+    digest_b64 = digest.encode('base64').strip()
+
+    lookup_shard, owner = _probe_shards(pool,
+            pool.shards_for_lookup_hash(digest),
+            lambda cursor: query.select_alias_lookup(cursor, digest, ctx),
+            timer)
+
+    if owner is None or owner['base_id'] != base_id:
         return None
 
     tpc = TwoPhaseCommit(pool, lookup_shard, 'set_alias_flags',
-            (base_id, ctx, digest_b64, add, clear))
+            (base_id, ctx, digest_b64, add, clear),
+            _local(pool, lookup_shard, pool.shard_by_id(base_id)))
     try:
         with tpc as conn:
             cursor = conn.cursor()
@@ -302,12 +595,12 @@ def _set_alias_flags(pool, base_id, ctx, alias, add, clear, timer):
                 tpc.fail()
                 return None
     finally:
-        pool.put(conn)
+        tpc.release(conn)
 
     result_flags = result[0]
 
     with tpc.elsewhere():
-        with pool.get_by_id(base_id) as conn:
+        with tpc.get_by_id(base_id) as conn:
             timer.conn = conn
             try:
                 result = query.set_flags(conn.cursor(), 'alias', add, clear,
@@ -325,33 +618,25 @@ def _set_alias_flags(pool, base_id, ctx, alias, add, clear, timer):
 
 def remove_alias(pool, base_id, ctx, alias, timeout):
     timer = Timer(pool, timeout, None)
-    if timeout is None:
-        return _remove_alias(pool, base_id, ctx, alias, timer)
-    with timer:
-        return _remove_alias(pool, base_id, ctx, alias, timer)
+    try:
+        if timeout is None:
+            return _remove_alias(pool, base_id, ctx, alias, timer)
+        with timer:
+            return _remove_alias(pool, base_id, ctx, alias, timer)
+    finally:
+        if pool.alias_cache is not None:
+            _uncache_alias(pool, _alias_digest(pool, alias), ctx)
 
 def _remove_alias(pool, base_id, ctx, alias, timer):
-    digest = hmac.new(pool.digestkey, alias.encode('utf8'),
-            hashlib.sha1).digest()
+    digest = _alias_digest(pool, alias)
     digest_b64 = digest.encode('base64').strip()
 
-    for shard in pool.shards_for_lookup_hash(digest):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-            try:
-                owner = query.select_alias_lookup(conn.cursor(), digest, ctx)
-            finally:
-                timer.conn = None
-
-            if owner is None:
-                continue
-
-            if owner['base_id'] != base_id:
-                return False
+    lookup_shard, owner = _probe_shards(pool,
+            pool.shards_for_lookup_hash(digest),
+            lambda cursor: query.select_alias_lookup(cursor, digest, ctx),
+            timer)
 
-            lookup_shard = shard
-            break
-    else:
+    if owner is None or owner['base_id'] != base_id:
         return False
 
     tpc = TwoPhaseCommit(
@@ -401,7 +686,8 @@ def create_relationship_pair(pool, base_id, rel_id, ctx, forw_idx, rev_idx,
 def _create_relationship_pair(pool, base_id, rel_id, ctx, forw_idx, rev_idx,
         flags, timer):
     tpc = TwoPhaseCommit(pool, pool.shard_by_id(base_id),
-            'create_relationship_pair', (base_id, rel_id, ctx))
+            'create_relationship_pair', (base_id, rel_id, ctx),
+            _local(pool, pool.shard_by_id(base_id), pool.shard_by_id(rel_id)))
     try:
         with tpc as conn:
             timer.conn = conn
@@ -423,11 +709,11 @@ def _create_relationship_pair(pool, base_id, rel_id, ctx, forw_idx, rev_idx,
         return False
 
     finally:
-        pool.put(conn)
+        tpc.release(conn)
 
     try:
         with tpc.elsewhere():
-            with pool.get_by_id(rel_id) as conn:
+            with tpc.get_by_id(rel_id) as conn:
                 timer.conn = conn
                 try:
                     inserted = query.insert_relationship(conn.cursor(),
@@ -449,6 +735,147 @@ def _create_relationship_pair(pool, base_id, rel_id, ctx, forw_idx, rev_idx,
     return True
 
 
+def create_relationships(pool, ctx, base_id, rel_ids, flags, timeout):
+    timer = Timer(pool, timeout, None)
+    if timeout is None:
+        return _create_relationships(
+                pool, ctx, base_id, rel_ids, flags, timer)
+    with timer:
+        return _create_relationships(
+                pool, ctx, base_id, rel_ids, flags, timer)
+
+def _create_relationships(pool, ctx, base_id, rel_ids, flags, timer):
+    # rel_ids must be distinct. returns {rel_id: result}, with results as
+    # _create_relationship_pair would have returned or raised them
+    results = {}
+    pending = list(rel_ids)
+    retried = False
+
+    # normally a single round. if any rel_id nodes turn out to be missing,
+    # or a concurrent create collides with this one, everything is rolled
+    # back and tried again, so no forward row is committed without its
+    # reverse row.
+    while pending:
+        tpcs = []
+        try:
+            created, missing = _insert_relationship_rows(
+                    pool, tpcs, ctx, base_id, pending, flags, timer)
+        except psycopg2.IntegrityError:
+            _rollback_all(tpcs)
+            if retried:
+                raise
+            retried = True
+            continue
+        except Exception:
+            klass, exc, tb = sys.exc_info()
+            _rollback_all(tpcs)
+            raise klass, exc, tb
+
+        for rel_id in pending:
+            if rel_id not in created:
+                results[rel_id] = False
+
+        if not missing:
+            for tpc in tpcs:
+                tpc.commit()
+            for rel_id in created:
+                results[rel_id] = True
+            break
+
+        _rollback_all(tpcs)
+
+        rel_ctx = util.ctx_rel_ctx(ctx)
+        rel_tbl = table.NAMES[util.ctx_tbl(rel_ctx)]
+        for rel_id in missing:
+            results[rel_id] = error.NoObject("%s<%d/%d>" %
+                    (rel_tbl, rel_ctx, rel_id))
+        pending = [rel_id for rel_id in created if rel_id not in missing]
+
+    return results
+
+def _insert_relationship_rows(pool, tpcs, ctx, base_id, rel_ids, flags,
+        timer):
+    # prepare a transaction on the base_id shard with all of the forward
+    # rows, and one on each rel_id shard with its reverse rows, adding them to
+    # ``tpcs``. returns the rel_ids that were newly related, and the set of
+    # those whose reverse row couldn't be written for lack of a node.
+    base_shard = pool.shard_by_id(base_id)
+    order = dict((rel_id, n) for n, rel_id in enumerate(rel_ids))
+    missing = set()
+
+    def insert_reverse(cursor, group):
+        # undirected relationships store the reverse row as a forward one
+        # from the rel_id node's side, as insert_relationship does
+        if util.ctx_directed(ctx):
+            forward = False
+            rows = [(order[rel_id], base_id, rel_id) for rel_id in group]
+        else:
+            forward = True
+            rows = [(order[rel_id], rel_id, base_id) for rel_id in group]
+
+        for n, nobase in query.insert_relationships(
+                cursor, ctx, rows, forward, flags):
+            if nobase:
+                missing.add(rel_ids[n])
+
+    tpc = TwoPhaseCommit(pool, base_shard, 'create_relationships',
+            (base_id, ctx, len(rel_ids)))
+    conn = None
+    try:
+        with tpc as conn:
+            timer.conn = conn
+            cursor = conn.cursor()
+            skipped = dict(query.insert_relationships(cursor, ctx,
+                [(n, base_id, rel_id) for n, rel_id in enumerate(rel_ids)],
+                True, flags))
+
+            if skipped and all(skipped.itervalues()):
+                tpc.fail()
+                base_ctx = util.ctx_base_ctx(ctx)
+                base_tbl = table.NAMES[util.ctx_tbl(base_ctx)]
+                raise error.NoObject("%s<%d/%d>" %
+                        (base_tbl, base_ctx, base_id))
+
+            created = [rel_id for n, rel_id in enumerate(rel_ids)
+                    if n not in skipped]
+            if not created:
+                tpc.fail()
+                return created, missing
+
+            groups = _by_shard(created, pool.shard_by_id)
+            if base_shard in groups:
+                insert_reverse(cursor, groups.pop(base_shard))
+    finally:
+        if conn is not None:
+            pool.put(conn)
+        timer.conn = None
+    tpcs.append(tpc)
+
+    # in shard order, so that concurrent batches can't deadlock
+    for shard, group in sorted(groups.iteritems()):
+        tpc = TwoPhaseCommit(pool, shard, 'create_relationships',
+                (base_id, ctx, len(group)))
+        conn = None
+        try:
+            with tpc as conn:
+                timer.conn = conn
+                insert_reverse(conn.cursor(), group)
+        finally:
+            if conn is not None:
+                pool.put(conn)
+            timer.conn = None
+        tpcs.append(tpc)
+
+    return created, missing
+
+def _rollback_all(tpcs):
+    for tpc in tpcs:
+        try:
+            tpc.rollback()
+        except Exception:
+            pass
+
+
 def set_relationship_flags(pool, base_id, rel_id, ctx, add, clear, timeout):
     timer = Timer(pool, timeout, None)
     if timeout is None:
@@ -460,7 +887,8 @@ def set_relationship_flags(pool, base_id, rel_id, ctx, add, clear, timeout):
 
 def _set_relationship_flags(pool, base_id, rel_id, ctx, add, clear, timer):
     tpc = TwoPhaseCommit(pool, pool.shard_by_id(base_id),
-            'set_relationship_flags', (base_id, rel_id, ctx, add, clear))
+            'set_relationship_flags', (base_id, rel_id, ctx, add, clear),
+            _local(pool, pool.shard_by_id(base_id), pool.shard_by_id(rel_id)))
 
     # hacks for undirected rels
     directed = util.ctx_directed(ctx)
@@ -481,12 +909,12 @@ def _set_relationship_flags(pool, base_id, rel_id, ctx, add, clear, timer):
                 return None
 
     finally:
-        pool.put(conn)
+        tpc.release(conn)
 
     result_flags = result[0]
 
     with tpc.elsewhere():
-        with pool.get_by_id(rel_id) as conn:
+        with tpc.get_by_id(rel_id) as conn:
             timer.conn = conn
             try:
                 where = {'base_id': base_id, 'rel_id': rel_id, 'ctx': ctx,
@@ -516,7 +944,8 @@ def remove_relationship_pair(pool, base_id, rel_id, ctx, timeout):
 
 def _remove_relationship_pair(pool, base_id, rel_id, ctx, timer):
     tpc = TwoPhaseCommit(pool, pool.shard_by_id(base_id),
-            'remove_relationship_pair', (base_id, rel_id, ctx))
+            'remove_relationship_pair', (base_id, rel_id, ctx),
+            _local(pool, pool.shard_by_id(base_id), pool.shard_by_id(rel_id)))
     try:
         with tpc as conn:
             timer.conn = conn
@@ -530,10 +959,10 @@ def _remove_relationship_pair(pool, base_id, rel_id, ctx, timer):
                 tpc.fail()
                 return False
     finally:
-        pool.put(conn)
+        tpc.release(conn)
 
     with tpc.elsewhere():
-        conn = pool.get_by_id(rel_id, replace=False)
+        conn = tpc.get_by_id(rel_id, replace=False)
         timer.conn = conn
         # manually managing commits/rollbacks and replacing on the pool
         # so we don't get an extra COMMIT when we just ROLLBACKed
@@ -545,14 +974,15 @@ def _remove_relationship_pair(pool, base_id, rel_id, ctx, timer):
             tpc.fail()
             return False
         else:
-            if removed:
-                conn.commit()
-            else:
+            if not removed:
                 conn.rollback()
                 tpc.fail()
+            elif not tpc.local:
+                # a local tpc commits this along with its own half
+                conn.commit()
             return removed
         finally:
-            pool.put(conn)
+            tpc.release(conn)
 
 
 def create_node(pool, base_id, ctx, value, index, flags, timeout):
@@ -574,6 +1004,41 @@ def create_node(pool, base_id, ctx, value, index, flags, timeout):
         return node
 
 
+# rows per multi-row INSERT statement in the bulk creation functions
+_BULK_CHUNK = 1000
+
+
+def create_nodes(pool, base_id, ctx, values, flags, timeout):
+    # a batch goes on one shard in one transaction, so that it either all
+    # lands or none of it does. roots can be on any shard, children have to
+    # be with their parent.
+    if base_id is None:
+        shard = pool.shard_for_root_insert()
+    else:
+        shard = pool.shard_by_id(base_id)
+
+    results = []
+    with pool.get_by_shard(shard, timeout=timeout) as conn:
+        cursor = conn.cursor()
+        for start in xrange(0, len(values), _BULK_CHUNK):
+            nodes = query.insert_nodes(cursor, base_id, ctx,
+                    values[start:start + _BULK_CHUNK], flags)
+
+            if not nodes:
+                # the parent doesn't exist, or stopped existing after an
+                # earlier chunk went in. either way none of them stay.
+                conn.rollback()
+                raise _no_base(ctx, base_id)
+
+            if base_id is not None:
+                query.insert_edges(
+                        cursor, base_id, ctx, [node['id'] for node in nodes])
+
+            results.extend(nodes)
+
+    return results
+
+
 def move_node(pool, node_id, ctx, base_id, new_base_id, index, timeout):
     if pool.shard_by_id(base_id) == pool.shard_by_id(new_base_id):
         with pool.get_by_id(base_id, timeout=timeout) as conn:
@@ -635,9 +1100,16 @@ def create_name(pool, base_id, ctx, value, flags, index, timeout):
 
 def _create_name(pool, base_id, ctx, value, flags, index, timer):
     base_ctx = util.ctx_base_ctx(ctx)
+    base_shard = pool.shard_by_id(base_id)
+
+    # only prefix lookups can share the name's transaction, phonetic ones
+    # are a two-phase commit of their own
+    local = util.ctx_search(ctx) == search.PREFIX and _local(pool,
+            base_shard, pool.shard_for_prefix_write(value.encode('utf8')))
 
-    tpc = TwoPhaseCommit(pool, pool.shard_by_id(base_id), 'create_name',
-            (base_id, ctx, value.encode('ascii', 'ignore'), flags, index))
+    tpc = TwoPhaseCommit(pool, base_shard, 'create_name',
+            (base_id, ctx, value.encode('ascii', 'ignore'), flags, index),
+            local)
     conn = None
     try:
         with tpc as conn:
@@ -655,7 +1127,7 @@ def _create_name(pool, base_id, ctx, value, flags, index, timer):
 
     finally:
         if conn is not None:
-            pool.put(conn)
+            tpc.release(conn)
         timer.conn = None
 
     with tpc.elsewhere():
@@ -671,7 +1143,8 @@ def _write_name_lookup(pool, tpc, base_id, ctx, value, flags, timer):
     sclass = util.ctx_search(ctx)
 
     if sclass == search.PREFIX:
-        return _write_prefix_lookup(pool, base_id, ctx, value, flags, timer)
+        return _write_prefix_lookup(
+                pool, tpc, base_id, ctx, value, flags, timer)
 
     if sclass == search.PHONETIC:
         return _write_phonetic_lookups(pool, base_id, ctx, value, flags, timer)
@@ -680,8 +1153,8 @@ def _write_name_lookup(pool, tpc, base_id, ctx, value, flags, timer):
         raise error.BadContext(ctx)
 
 
-def _write_prefix_lookup(pool, base_id, ctx, value, flags, timer):
-    with pool.get_by_shard(
+def _write_prefix_lookup(pool, tpc, base_id, ctx, value, flags, timer):
+    with tpc.get_by_shard(
             pool.shard_for_prefix_write(value.encode('utf8'))) as conn:
         timer.conn = conn
         try:
@@ -756,7 +1229,7 @@ def _search_prefix(pool, value, ctx, limit, start, timer):
     names = []
     shards = list(pool.shards_for_lookup_prefix(value.encode('utf8')))
     for shard in shards:
-        with pool.get_by_shard(shard) as conn:
+        with pool.get_by_shard(shard, read=True) as conn:
             try:
                 timer.conn = conn
                 names.extend(query.search_prefixes(
@@ -789,7 +1262,7 @@ def _search_phonetic(pool, value, ctx, limit, start, timer):
     dm, dmalt = util.dmetaphone(value)
     results = []
     for shard in pool.shards_for_lookup_phonetic(dm):
-        with pool.get_by_shard(shard) as conn:
+        with pool.get_by_shard(shard, read=True) as conn:
             timer.conn = conn
             try:
                 results.extend(query.search_phonetics(
@@ -801,7 +1274,7 @@ def _search_phonetic(pool, value, ctx, limit, start, timer):
         return results, _phontoken(results)
 
     for shard in pool.shards_for_lookup_phonetic(dmalt):
-        with pool.get_by_shard(shard) as conn:
+        with pool.get_by_shard(shard, read=True) as conn:
             timer.conn = conn
             try:
                 results.extend(query.search_phonetics(
@@ -840,8 +1313,13 @@ def _set_name_flags(pool, base_id, ctx, value, add, clear, timer):
     if lookup_shard is None:
         return None
 
-    tpc = TwoPhaseCommit(pool, pool.shard_by_id(base_id), 'set_name_flags',
-            (base_id, ctx, value.encode('ascii', 'ignore'), add, clear))
+    base_shard = pool.shard_by_id(base_id)
+    local = (util.ctx_search(ctx) == search.PREFIX and
+            _local(pool, base_shard, lookup_shard))
+
+    tpc = TwoPhaseCommit(pool, base_shard, 'set_name_flags',
+            (base_id, ctx, value.encode('ascii', 'ignore'), add, clear),
+            local)
 
     try:
         with tpc as conn:
@@ -853,7 +1331,7 @@ def _set_name_flags(pool, base_id, ctx, value, add, clear, timer):
                 return None
 
     finally:
-        pool.put(conn)
+        tpc.release(conn)
         timer.conn = None
 
     result_flags = result[0]
@@ -861,7 +1339,7 @@ def _set_name_flags(pool, base_id, ctx, value, add, clear, timer):
     with tpc.elsewhere():
         sclass = util.ctx_search(ctx)
         if sclass == search.PREFIX:
-            if not _apply_flags_to_prefix_lookup(pool, lookup_shard,
+            if not _apply_flags_to_prefix_lookup(pool, tpc, lookup_shard,
                     add, clear, base_id, ctx, value, timer, result_flags):
                 return None
         elif sclass == search.PHONETIC:
@@ -887,58 +1365,41 @@ def _find_name_lookup_shard(pool, base_id, ctx, value, timer):
 
 
 def _find_prefix_lookup_shard(pool, base_id, ctx, value, timer):
-    for shard in pool.shards_for_lookup_prefix(value):
-        with pool.get_by_shard(shard) as conn:
-            try:
-                timer.conn = conn
-                if query.select_prefix_lookups(
-                        conn.cursor(), value, ctx, base_id):
-                    return shard
-
-            finally:
-                timer.conn = None
+    shard, found = _probe_shards(pool, pool.shards_for_lookup_prefix(value),
+            lambda cursor: query.select_prefix_lookups(
+                cursor, value, ctx, base_id),
+            timer)
 
-    return None
+    return shard
 
 
 def _find_phonetic_lookup_shards(pool, base_id, ctx, value, timer):
     dm, dmalt = util.dmetaphone(value)
 
-    for shard in pool.shards_for_lookup_phonetic(dm):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-            try:
-                if query.find_phonetic_lookup(
-                        conn.cursor(), dm, ctx, value, base_id):
-                    dmshard = shard
-                    break
-            finally:
-                timer.conn = None
-    else: 
+    dmshard, found = _probe_shards(pool, pool.shards_for_lookup_phonetic(dm),
+            lambda cursor: query.find_phonetic_lookup(
+                cursor, dm, ctx, value, base_id),
+            timer)
+    if not found:
         return None
 
     if (dmalt is None) or not util.ctx_phonetic_loose:
         return (dmshard, None)
 
-    for shard in pool.shards_for_lookup_phonetic(dmalt):
-        with pool.get_by_shard(shard) as conn:
-            timer.conn = conn
-            try:
-                if query.find_phonetic_lookup(
-                        conn.cursor(), dmalt, ctx, value, base_id):
-                    dmashard = shard
-                    break
-            finally:
-                timer.conn = None
-    else:
+    dmashard, found = _probe_shards(pool,
+            pool.shards_for_lookup_phonetic(dmalt),
+            lambda cursor: query.find_phonetic_lookup(
+                cursor, dmalt, ctx, value, base_id),
+            timer)
+    if not found:
         return None
 
     return dmshard, dmashard
 
 
-def _apply_flags_to_prefix_lookup(
-        pool, lookup_shard, add, clear, base_id, ctx, value, timer, expected):
-    with pool.get_by_shard(lookup_shard) as conn:
+def _apply_flags_to_prefix_lookup(pool, tpc, lookup_shard,
+        add, clear, base_id, ctx, value, timer, expected):
+    with tpc.get_by_shard(lookup_shard) as conn:
         timer.conn = conn
         try:
             result = query.set_flags(
@@ -1171,7 +1632,8 @@ def _remove_lookups(cursor, triples):
     return removed
 
 
-def _remove_local_estates(shard, pool, cursor, estate, node_base):
+def _remove_local_estates(shard, pool, cursor, estate, node_base,
+        uncache=None, defer=False, pending=None, edge_limit=None):
     ids = estate[shard][3][:]
     del estate[shard][3][:]
 
@@ -1180,6 +1642,10 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
             ids = query.remove_nodes(cursor, ids)
             if not ids:
                 break
+            if defer:
+                # leave what's under these nodes to the sweeper
+                query.enqueue_removals(cursor, ids)
+                break
         node_base = False
 
         query.remove_properties_multiple_bases(cursor, ids)
@@ -1187,6 +1653,8 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
         aliases = query.remove_aliases_multiple_bases(cursor, ids)
         for value, ctx in aliases:
             digest = hmac.new(pool.digestkey, value, hashlib.sha1).digest()
+            if uncache is not None:
+                uncache.append((digest, ctx))
             # add each alias_lookup to every shard it *might* live on
             for s in pool.shards_for_lookup_hash(digest):
                 group = estate.setdefault(s, (set(), set(), [], []))[0]
@@ -1210,7 +1678,11 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
             item = (base_id, ctx, not forward, rel_id)
             estate.setdefault(s, (set(), set(), [], []))[2].append(item)
 
-        children = query.remove_edges_multiple_bases(cursor, ids)
+        children = query.remove_edges_multiple_bases(cursor, ids, edge_limit)
+        if edge_limit is not None and len(children) >= edge_limit:
+            # the rest of these nodes' children wait for a later sweep
+            query.requeue_unswept(cursor, ids)
+        edge_limit = None
         for id in children:
             # append each child node to its shard
             s = pool.shard_by_id(id)
@@ -1223,25 +1695,27 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
 
     if alias_lookups:
         removed = query.remove_alias_lookups_multi(cursor, list(alias_lookups))
-        for pair in removed:
-            for s in pool.shards_for_lookup_hash(pair[0]):
-                if s == shard:
-                    continue
-                estate[s][0].discard(pair)
+        for digest, alias_ctx in removed:
+            # bytea comes back as a buffer, which never equals the str digest
+            pair = (str(digest), alias_ctx)
+            _prune_lookup(pool, shard, pool.shards_for_lookup_hash(pair[0]),
+                    0, pair, estate, pending)
 
     if name_lookups:
         removed = _remove_lookups(cursor, name_lookups)
         for triple in removed:
-            for s in pool.shards_for_lookup_prefix(triple[2]):
-                if s == shard:
-                    continue
-                estate[s][1].discard(triple)
+            _prune_lookup(pool, shard,
+                    pool.shards_for_lookup_prefix(triple[2]),
+                    1, triple, estate, pending)
 
     if rels:
         query.remove_relationships_multi(cursor, rels)
 
         forw, rev = set(), set()
         for base_id, ctx, forward, rel_id in rels:
+            if util.ctx_ordering(ctx) == ordering.SPARSE:
+                # sparse lists are fine with the holes
+                continue
             if forward:
                 forw.add((base_id, ctx))
             else:
@@ -1255,17 +1729,78 @@ def _remove_local_estates(shard, pool, cursor, estate, node_base):
     estate.pop(shard)
 
 
-def remove_node(pool, id, ctx, base_id, timeout):
+def _prune_lookup(pool, shard, candidates, i, item, estate, pending):
+    # a lookup found on ``shard`` needn't be looked for on its other
+    # candidate shards, whether in this transaction's estate or among the
+    # work a cascade is holding back for later waves
+    for s in candidates:
+        if s == shard:
+            continue
+        if s in estate:
+            estate[s][i].discard(item)
+        if pending is not None and s in pending:
+            with pool._lock:
+                pending[s][i].discard(item)
+
+
+def _held_lookups(pool, shard, work, estates):
+    # the lookups in ``work`` that an earlier candidate shard in ``estates``
+    # is also due to look for, so ``shard`` can wait to see if it finds them
+    held = (set(), set())
+    for pair in work[0]:
+        if _pending_earlier(shard, pool.shards_for_lookup_hash(pair[0]),
+                0, pair, estates):
+            held[0].add(pair)
+    for triple in work[1]:
+        if _pending_earlier(shard, pool.shards_for_lookup_prefix(triple[2]),
+                1, triple, estates):
+            held[1].add(triple)
+    return held
+
+
+def _pending_earlier(shard, candidates, i, item, estates):
+    for s in candidates:
+        if s == shard:
+            return False
+        if s in estates and item in estates[s][i]:
+            return True
+    return False
+
+
+def _merge_estates(estates, estate):
+    for shard, (alias_lookups, name_lookups, rels, ids) in estate.iteritems():
+        if not (alias_lookups or name_lookups or rels or ids):
+            # lookups that were all removed from another candidate shard
+            continue
+        into = estates.setdefault(shard, (set(), set(), [], []))
+        into[0].update(alias_lookups)
+        into[1].update(name_lookups)
+        into[2].extend(rels)
+        into[3].extend(ids)
+
+
+def remove_node(pool, id, ctx, base_id, timeout, defer=False):
     timer = Timer(pool, timeout, None)
-    if timeout is None:
-        return _remove_node(pool, id, ctx, base_id, timer)
-    with timer:
-        return _remove_node(pool, id, ctx, base_id, timer)
+    uncache = [] if pool.alias_cache is not None else None
+    try:
+        if timeout is None:
+            return _remove_node(pool, id, ctx, base_id, timer, uncache, defer)
+        with timer:
+            return _remove_node(pool, id, ctx, base_id, timer, uncache, defer)
+    finally:
+        for digest, alias_ctx in uncache or ():
+            _uncache_alias(pool, digest, alias_ctx)
 
-def _remove_node(pool, id, ctx, base_id, timer):
+def _remove_node(pool, id, ctx, base_id, timer, uncache=None, defer=False):
     shard = pool.shard_by_id(base_id)
+    estates = {pool.shard_by_id(id): (set(), set(), [], [id])}
+
+    # when the node is on its parent's shard, its own removal shares the
+    # edge's transaction. if the cascade then reaches other shards, that one
+    # is committed first and the prepared ones only if it succeeds.
+    local = _local(pool, shard, pool.shard_by_id(id))
     tpc = TwoPhaseCommit(pool, shard, "remove_node_edge",
-            (id, ctx, base_id, shard))
+            (id, ctx, base_id, shard), local)
     tpcs = [tpc]
 
     try:
@@ -1275,25 +1810,109 @@ def _remove_node(pool, id, ctx, base_id, timer):
                     conn.cursor(), base_id, ctx, id):
                 tpc.fail()
                 return False
+
+            if local:
+                _remove_local_estates(shard, pool, conn.cursor(), estates,
+                        False, uncache, defer)
+                estate, estates = estates, {}
+                _merge_estates(estates, estate)
     finally:
-        pool.put(conn)
+        tpc.release(conn)
         timer.conn = None
 
-    estates = {pool.shard_by_id(id): (set(), set(), [], [id])}
+    _cascade(pool, tpcs, estates, 'remove_node_shard', (id, ctx, base_id),
+            uncache, defer)
+
+    return True
 
+
+def sweep_removals(pool, shard, limit, timeout):
+    timer = Timer(pool, timeout, None)
+    uncache = [] if pool.alias_cache is not None else None
     try:
-        while estates:
-            shard = next(iter(estates))
-            tpc = TwoPhaseCommit(pool, shard, 'remove_node_shard',
-                    (id, ctx, base_id, shard))
-            tpcs.append(tpc)
+        if timeout is None:
+            return _sweep_removals(pool, shard, limit, timer, uncache)
+        with timer:
+            return _sweep_removals(pool, shard, limit, timer, uncache)
+    finally:
+        for digest, alias_ctx in uncache or ():
+            _uncache_alias(pool, digest, alias_ctx)
 
-            try:
-                with tpc as conn:
-                    _remove_local_estates(next(iter(estates)),
-                            pool, conn.cursor(), estates, False)
-            finally:
-                pool.put(conn)
+def _sweep_removals(pool, shard, limit, timer, uncache):
+    tpc = TwoPhaseCommit(pool, shard, "sweep_removals", (shard, limit))
+    tpcs = [tpc]
+    conn = None
+
+    try:
+        with tpc as conn:
+            timer.conn = conn
+            cursor = conn.cursor()
+            ids = query.dequeue_removals(cursor, limit)
+            if not ids:
+                tpc.fail()
+                return {'swept': 0, 'remaining': 0}
+
+            # the dequeued nodes themselves were removed when they were
+            # queued, it's the objects under them that get cleared now.
+            # their child nodes are removed and queued in turn, up to
+            # ``limit`` of them, and a node with more is queued again.
+            estates = {shard: (set(), set(), [], ids[:])}
+            _remove_local_estates(shard, pool, cursor, estates, True,
+                    uncache, True, edge_limit=limit)
+            remaining = query.count_removals(cursor)
+    finally:
+        if conn is not None:
+            pool.put(conn)
+        timer.conn = None
+
+    _cascade(pool, tpcs, estates, 'sweep_removals_shard', (shard, limit),
+            uncache, True)
+
+    return {'swept': len(ids), 'remaining': remaining}
+
+
+def _cascade(pool, tpcs, estates, name, uniq_data, uncache, defer):
+    # clear out everything in ``estates``, then commit all of ``tpcs`` along
+    # with the transactions that did it (or roll them all back on failure)
+    def clear(shard, estate):
+        tpc = TwoPhaseCommit(pool, shard, name, uniq_data + (shard,))
+        tpcs.append(tpc)
+
+        try:
+            with tpc as conn:
+                _remove_local_estates(shard, pool, conn.cursor(), estate,
+                        False, uncache, defer, later)
+        finally:
+            pool.put(conn)
+
+    try:
+        # drop the shards whose lookups were all found before the cascade
+        initial, estates = estates, {}
+        _merge_estates(estates, initial)
+
+        # the cascade goes in waves: every shard with work pending clears it
+        # concurrently with the others, each into its own estate dict, and
+        # whatever they turn up for other shards makes up the next wave.
+        # a lookup only goes to its earliest pending candidate shard, the
+        # others hold it back to see if that one finds it, so that shards
+        # with nothing else to do don't each cost a prepared transaction.
+        while estates:
+            wave, later = {}, {}
+            for shard, work in estates.iteritems():
+                held = _held_lookups(pool, shard, work, estates)
+                ready = (work[0] - held[0], work[1] - held[1],
+                        work[2], work[3])
+                if any(ready):
+                    wave[shard] = {shard: ready}
+                    later[shard] = held + ([], [])
+                else:
+                    later[shard] = work
+            pool._fan_out(wave, clear)
+
+            estates = {}
+            _merge_estates(estates, later)
+            for estate in wave.itervalues():
+                _merge_estates(estates, estate)
     except Exception:
         klass, exc, tb = sys.exc_info()
         for tpc in tpcs:
@@ -1303,7 +1922,355 @@ def _remove_node(pool, id, ctx, base_id, timer):
                 pass
         raise klass, exc, tb
     else:
+        if tpcs and tpcs[0].local:
+            # a one-phase transaction can still fail to commit, so it goes
+            # first and decides for the prepared ones
+            try:
+                tpcs[0].commit()
+            except Exception:
+                klass, exc, tb = sys.exc_info()
+                for tpc in tpcs[1:]:
+                    try:
+                        tpc.rollback()
+                    except Exception:
+                        pass
+                raise klass, exc, tb
+            tpcs = tpcs[1:]
+
         for tpc in tpcs:
             tpc.commit()
 
-    return True
+
+def _no_base(ctx, base_id):
+    base_ctx = util.ctx_base_ctx(ctx)
+    base_tbl = table.NAMES[util.ctx_tbl(base_ctx)]
+    return error.NoObject("%s<%d/%d>" % (base_tbl, base_ctx, base_id))
+
+
+def _storage_columns(ctx, value):
+    if util.ctx_storage(ctx) == storage.INT:
+        return value, None
+    return None, value
+
+
+def _by_shard(rows, shard_for):
+    groups = {}
+    for row in rows:
+        groups.setdefault(shard_for(row), []).append(row)
+    return groups
+
+
+def bulk_load_properties(pool, rows, timeout):
+    timer = Timer(pool, timeout, None)
+    if timeout is None:
+        return _bulk_load_properties(pool, rows, timer)
+    with timer:
+        return _bulk_load_properties(pool, rows, timer)
+
+def _bulk_load_properties(pool, rows, timer):
+    # rows are (n, base_id, ctx, value, flags) with the values already wrapped
+    byindex = dict((row[0], row) for row in rows)
+
+    def load(conn, group):
+        cursor = conn.cursor()
+        staging = query.create_staging_table(cursor, 'property')
+        query.copy_rows(cursor, staging,
+                ('n', 'base_id', 'ctx', 'num', 'value', 'flags'),
+                ((n, base_id, ctx) + _storage_columns(ctx, value) + (flags,)
+                    for n, base_id, ctx, value, flags in group))
+
+        missing = []
+        for ctx in sorted(set(row[2] for row in group)):
+            missing.extend(
+                    query.merge_staged_properties(cursor, staging, ctx))
+        return missing
+
+    results = pool.scatter(
+            _by_shard(rows, lambda row: pool.shard_by_id(row[1])),
+            load, timer.remaining())
+
+    conflicts = []
+    for missing in results.itervalues():
+        for n in missing:
+            conflicts.append((n, _no_base(byindex[n][2], byindex[n][1])))
+
+    return conflicts
+
+
+def bulk_load_aliases(pool, rows, timeout):
+    timer = Timer(pool, timeout, None)
+    try:
+        if timeout is None:
+            return _bulk_load_aliases(pool, rows, timer)
+        with timer:
+            return _bulk_load_aliases(pool, rows, timer)
+    finally:
+        if pool.alias_cache is not None:
+            for n, base_id, ctx, alias, flags in rows:
+                _uncache_alias(pool, _alias_digest(pool, alias), ctx)
+
+def _bulk_load_aliases(pool, rows, timer):
+    # rows are (n, base_id, ctx, alias, flags)
+    digests = dict((row[0], _alias_digest(pool, row[3])) for row in rows)
+    conflicts = []
+
+    # find aliases already claimed on shards from older insertion plans
+    probes = {}
+    for n, base_id, ctx, alias, flags in rows:
+        insert_shard = pool.shard_for_alias_write(digests[n])
+        for shard in pool.shards_for_lookup_hash(digests[n]):
+            if shard != insert_shard:
+                probes.setdefault(shard, set()).add((digests[n], ctx))
+
+    owners = {}
+    if probes:
+        results = pool.scatter(probes, lambda conn, pairs:
+                query.select_alias_lookups(conn.cursor(), sorted(pairs)),
+                timer.remaining())
+        for shard, found in results.iteritems():
+            for digest, ctx, base_id in found:
+                owners[(digest, ctx)] = (shard, base_id)
+
+    # the shard holding each row's lookup, once it is claimed or found
+    lookup_shards = {}
+
+    # lookups already held by the same base_id still get their alias rows
+    # written below (those that are already there are skipped). that way a
+    # chunk that failed after claiming its lookups can just be loaded again.
+    held = []
+    unclaimed = []
+    for row in rows:
+        n, base_id, ctx, alias, flags = row
+        shard, owner = owners.get((digests[n], ctx), (None, None))
+        if owner is None:
+            unclaimed.append(row)
+        elif owner == base_id:
+            lookup_shards[n] = shard
+            held.append(row)
+        else:
+            conflicts.append((n, error.AliasInUse(alias, ctx)))
+
+    # claim the lookups on their current insert shards
+    def claim(conn, group):
+        cursor = conn.cursor()
+        staging = query.create_staging_table(cursor, 'alias_lookup')
+        query.copy_rows(cursor, staging,
+                ('n', 'hash', 'ctx', 'base_id', 'flags'),
+                ((n, psycopg2.Binary(digests[n]), ctx, base_id, flags)
+                    for n, base_id, ctx, alias, flags in group))
+        return query.merge_staged_alias_lookups(cursor, staging)
+
+    refused = {}
+    if unclaimed:
+        results = pool.scatter(_by_shard(unclaimed,
+                lambda row: pool.shard_for_alias_write(digests[row[0]])),
+                claim, timer.remaining())
+        for found in results.itervalues():
+            refused.update(found)
+
+    claimed = held
+    for row in unclaimed:
+        n, base_id, ctx, alias, flags = row
+        if refused.get(n, base_id) == base_id:
+            lookup_shards[n] = pool.shard_for_alias_write(digests[n])
+            claimed.append(row)
+        else:
+            conflicts.append((n, error.AliasInUse(alias, ctx)))
+
+    # then write the alias rows themselves alongside their base objects
+    def insert(conn, group):
+        cursor = conn.cursor()
+        staging = query.create_staging_table(cursor, 'alias')
+        query.copy_rows(cursor, staging,
+                ('n', 'base_id', 'ctx', 'value', 'flags'),
+                ((n, base_id, ctx, alias, flags)
+                    for n, base_id, ctx, alias, flags in group))
+
+        missing = []
+        for ctx in sorted(set(row[2] for row in group)):
+            missing.extend(n for n, nobase in query.merge_staged_list(
+                    cursor, staging, 'alias', ctx, True) if nobase)
+        return missing
+
+    missing = set()
+    if claimed:
+        results = pool.scatter(
+                _by_shard(claimed, lambda row: pool.shard_by_id(row[1])),
+                insert, timer.remaining())
+        for found in results.itervalues():
+            missing.update(found)
+
+    if missing:
+        # release the lookups claimed for rows whose base object is gone
+        orphans = [row for row in claimed if row[0] in missing]
+        pool.scatter(_by_shard(orphans, lambda row: lookup_shards[row[0]]),
+                lambda conn, group: query.remove_alias_lookups_multi(
+                    conn.cursor(),
+                    [(digests[row[0]], row[2]) for row in group]),
+                timer.remaining())
+
+        for n, base_id, ctx, alias, flags in orphans:
+            conflicts.append((n, _no_base(ctx, base_id)))
+
+    return conflicts
+
+
+def bulk_load_names(pool, rows, timeout):
+    timer = Timer(pool, timeout, None)
+    if timeout is None:
+        return _bulk_load_names(pool, rows, timer)
+    with timer:
+        return _bulk_load_names(pool, rows, timer)
+
+def _bulk_load_names(pool, rows, timer):
+    # rows are (n, base_id, ctx, value, flags)
+    def insert(conn, group):
+        cursor = conn.cursor()
+        staging = query.create_staging_table(cursor, 'name')
+        query.copy_rows(cursor, staging,
+                ('n', 'base_id', 'ctx', 'value', 'flags'),
+                ((n, base_id, ctx, value, flags)
+                    for n, base_id, ctx, value, flags in group))
+
+        skipped = []
+        for ctx in sorted(set(row[2] for row in group)):
+            skipped.extend(query.merge_staged_list(
+                    cursor, staging, 'name', ctx, True))
+        return skipped
+
+    results = pool.scatter(
+            _by_shard(rows, lambda row: pool.shard_by_id(row[1])),
+            insert, timer.remaining())
+
+    skipped = {}
+    for found in results.itervalues():
+        skipped.update(found)
+
+    conflicts = []
+    lookups = {}
+    for n, base_id, ctx, value, flags in rows:
+        # names that are already present are left alone, as in create, but
+        # their lookups are still written where they're missing. that way a
+        # chunk that failed before its lookups went in can be loaded again.
+        present = n in skipped
+        if present and skipped[n]:
+            conflicts.append((n, _no_base(ctx, base_id)))
+            continue
+
+        if util.ctx_search(ctx) == search.PREFIX:
+            shard = pool.shard_for_prefix_write(value.encode('utf8'))
+            lookups.setdefault(shard, {}).setdefault(
+                    ('prefix_lookup', present), []).append(
+                        (value, flags, ctx, base_id))
+            continue
+
+        dm, dmalt = util.dmetaphone(value)
+        codes = [dm]
+        if dmalt is not None and util.ctx_phonetic_loose(ctx):
+            codes.append(dmalt)
+        for code in codes:
+            shard = pool.shard_for_phonetic_write(code)
+            lookups.setdefault(shard, {}).setdefault(
+                    ('phonetic_lookup', present), []).append(
+                        (value, code, flags, ctx, base_id))
+
+    def write(conn, tables):
+        # the new names' lookups go first, straight into the lookup table,
+        # so that the merge for the present ones sees them
+        cursor = conn.cursor()
+        for (tbl, present), lookup_rows in sorted(tables.iteritems()):
+            if not present:
+                query.copy_rows(
+                        cursor, tbl, _lookup_columns[tbl], lookup_rows)
+                continue
+
+            staging = query.create_staging_table(cursor, tbl)
+            query.copy_rows(cursor, staging, ('n',) + _lookup_columns[tbl],
+                    ((i,) + row for i, row in enumerate(lookup_rows)))
+            query.merge_staged_lookups(cursor, staging, tbl)
+
+    if lookups:
+        pool.scatter(lookups, write, timer.remaining())
+
+    return conflicts
+
+_lookup_columns = {
+    'prefix_lookup': ('value', 'flags', 'ctx', 'base_id'),
+    'phonetic_lookup': ('value', 'code', 'flags', 'ctx', 'base_id'),
+}
+
+
+_ITER_CURSOR = 'datahog_iter'
+
+def iterate(pool, id, itersize, rows, timeout):
+    # ``rows(cursor)`` runs on a named cursor, which the server walks in
+    # batches of ``itersize``. the connection and the transaction the cursor
+    # lives in are held until the iteration ends or is abandoned.
+    conn = pool.get_by_id(id, replace=False, timeout=timeout, read=True)
+    finished = False
+    try:
+        cursor = conn.cursor(_ITER_CURSOR)
+        cursor.itersize = itersize
+        for row in rows(cursor):
+            yield row
+        finished = True
+    finally:
+        # closing the generator early lands here with GeneratorExit, which
+        # the pool's connection context wouldn't roll back
+        try:
+            if finished:
+                conn.commit()
+            else:
+                conn.rollback()
+
+        except Exception:
+            if not conn.closed:
+                conn.reset()
+            raise
+
+        finally:
+            # a connection that broke along the way is replaced by put()
+            pool.put(conn)
+
+
+def purge(pool, shards, tables, retention, batchsize, pause, dry_run,
+        progress, timeout):
+    if shards is None:
+        shards = sorted(s['shard'] for s in pool._dbconf['shards'])
+    results = {}
+
+    def run(shard, group):
+        for tbl in tables:
+            if dry_run:
+                with pool.get_by_shard(shard, timeout=timeout) as conn:
+                    total = query.count_purgeable(
+                            conn.cursor(), tbl, retention)
+                if progress is not None:
+                    progress(shard, tbl, total)
+                results[(shard, tbl)] = total
+                continue
+
+            total = 0
+            cutoff = after = None
+            while 1:
+                # a transaction per batch, so no one of them holds its locks
+                # or its share of the WAL for long
+                with pool.get_by_shard(shard, timeout=timeout) as conn:
+                    cursor = conn.cursor()
+                    if cutoff is None:
+                        # fixed for the table, so the batches have an end
+                        cutoff = query.purge_cutoff(cursor, retention)
+                    count, after = query.purge_removed(
+                            cursor, tbl, cutoff, after, batchsize)
+                total += count
+                if progress is not None:
+                    progress(shard, tbl, total)
+                if count < batchsize:
+                    break
+                if pause:
+                    pool._pause(pause * 1000)
+            results[(shard, tbl)] = total
+
+    pool._fan_out(dict.fromkeys(shards), run)
+
+    return results
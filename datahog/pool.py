@@ -1,10 +1,31 @@
 # vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
 
+import binascii
 import bisect
 import contextlib
+import fractions
+import os
 import Queue
 import random
+import re
+import select
+import sys
+import threading
 import time
+import weakref
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
 
 try:
     import greenhouse
@@ -29,7 +50,7 @@ import psycopg2.extensions
 from . import error
 from .const import util
 
-__all__ = []
+__all__ = ["ThreadedConnPool"]
 
 
 class ConnectionPool(object):
@@ -45,13 +66,26 @@ class ConnectionPool(object):
             these dicts:
 
             - ``shard``: shard number
-            - ``count``: number of connections to build for this shard
+            - ``count``: number of connections to build for this shard at
+              startup, and the fewest it will be reaped down to
             - ``host``: hostname of the db
             - ``port``: db's port
             - ``user``: username to connect with
             - ``password``: user's password
             - ``database``: database name
 
+            And optionally:
+
+            - ``max``: the most connections the shard may grow to. when a
+              caller finds no idle connection and the shard is below this,
+              another connection is opened in the background. it defaults
+              to ``count``, which keeps the shard at a fixed size.
+            - ``replicas``: a list of dicts describing streaming replicas of
+              the shard, with any of the keys above (other than ``shard``)
+              that differ from the primary's. the API functions that only
+              read go to whichever replica has the fewest connections
+              checked out, and everything else goes to the primary.
+
         ``lookup_insertion_plans``
             Lists of lists of two-tuples of shard numbers, and their integer
             weights. This is used for the associated lookup tables of aliases
@@ -87,6 +121,71 @@ class ConnectionPool(object):
             optional, the default implementation performs exponential backoff
             with random jitter, trying for a total of around 20 seconds.
 
+        ``concurrent_lookups``
+            When ``True``, alias and name lookups that have more than one
+            candidate shard (because ``lookup_insertion_plans`` has grown past
+            a single plan) probe all of the candidates at once and take the
+            first hit in plan priority order, rather than trying them one at a
+            time. This key is optional and defaults to ``False``.
+
+        ``prepare_statements``
+            When ``True``, each connection PREPAREs the hot point-read
+            statements (property, node, alias and name selects and the like)
+            the first time it sees each distinct statement text, and EXECUTEs
+            the prepared statement from then on. This spares the database
+            re-parsing and re-planning them on every call. This key is
+            optional and defaults to ``False``.
+
+        ``alias_cache``
+            A cache object (such as a :class:`datahog.cache.LRUCache`) placed
+            in front of alias lookups, keyed by ``(digest, ctx)``. Misses are
+            cached too, and the alias-modifying functions invalidate the
+            affected entries. This key is optional, by default there is no
+            caching.
+
+        ``check_idle``
+            A number of seconds. Connections that have been sitting unused in
+            the pool for longer than this are checked with a trivial query
+            before being handed out. This key is optional, by default
+            connections are only checked for having been closed.
+
+        ``max_lifetime``
+            A number of seconds after which a connection is closed rather than
+            reused. This key is optional, by default connections are kept
+            until they break.
+
+            Whenever a connection is found to be closed, failing its check, or
+            too old, it is dropped and a replacement is connected in the
+            background (using ``connection_backoff``), and the caller is
+            given the next connection from the pool.
+
+        ``idle_timeout``
+            A number of seconds. On shards that have grown past ``count``,
+            connections that have been idle for longer than this are closed,
+            until the shard is back down to ``count``. Idle connections are
+            handed out most recently used first, so that the surplus ones do
+            sit idle, and are swept for this every ``idle_timeout`` seconds
+            as well as when they come up for checkout. This key is optional
+            and defaults to 300.
+
+        ``max_staleness``
+            A number of seconds. Replicas whose replay lag is more than this
+            aren't used for reads, which go to the primary instead until the
+            replica catches up. A replica's lag is measured on one of its
+            connections at most once a second, and a replica that has
+            replayed everything it received counts as having no lag, even
+            while its primary is idle. This key is optional, by
+            default replicas are used however far behind they are.
+
+        ``one_phase_local``
+            When ``True``, writes that would otherwise be tied together with
+            a two-phase commit (an alias and its lookup, the two halves of a
+            relationship, a name and its prefix lookup, a node and its
+            parent's edge) are done in one ordinary transaction whenever
+            they all fall on the same shard. That spares the PREPARE
+            TRANSACTION and COMMIT PREPARED round trips. This key is optional
+            and defaults to ``False``.
+
     :param bool readonly:
         Whether to disallow data-modifying methods against this connection
         pool. Can be useful for querying replication slaves to take some read
@@ -98,13 +197,33 @@ class ConnectionPool(object):
         self._dbconf = dbconf
         self._conns = {}
         self._out = {}
+        self._shard_info = {}
+        self._size = {}
+        self._stats = {}
+        self._in_use = {}
+        self._replicas = {}
+        self._lag = {}
         self._ready_evs = []
+        # guards the checkout accounting in pools that use real threads
+        self._lock = self._mutex()
+        self._pid = os.getpid()
 
         self._init_conf()
 
         self.shardbits = self._dbconf['shard_bits']
         self.digestkey = self._dbconf['digest_key']
 
+        self.concurrent_lookups = self._dbconf.get(
+                'concurrent_lookups', False)
+        self.alias_cache = self._dbconf.get('alias_cache')
+        self.prepare_statements = self._dbconf.get('prepare_statements', False)
+        self.alias_cache_epoch = 0
+        self.check_idle = self._dbconf.get('check_idle')
+        self.max_lifetime = self._dbconf.get('max_lifetime')
+        self.idle_timeout = self._dbconf.get('idle_timeout', 300)
+        self.max_staleness = self._dbconf.get('max_staleness')
+        self.one_phase_local = self._dbconf.get('one_phase_local', False)
+
         if 'connection_backoff' in self._dbconf:
             self.backoff = self._dbconf['connection_backoff']
 
@@ -118,12 +237,17 @@ class ConnectionPool(object):
 
         for plan in conf['lookup_insertion_plans']:
             _prepare_plan(plan)
+        self._lookup_routes = _compile_routes(conf['lookup_insertion_plans'])
 
         for shard in conf['shards']:
             for key in ('shard', 'count', 'host', 'port', 'user', 'password',
                     'database'):
                 if key not in shard:
                     raise Exception("missing shard dict key %r" % key)
+            shard.setdefault('max', shard['count'])
+            if shard['max'] < shard['count']:
+                raise Exception("shard %r max is below its count" % (
+                    shard['shard'],))
 
         if 'root_insertion_plan' not in conf:
             conf['root_insertion_plan'] = [(s['shard'], 1)
@@ -136,12 +260,70 @@ class ConnectionPool(object):
         This method won't block, use :meth:`wait_ready` to wait until the
         connections have all been established.
         '''
+        self._pid = os.getpid()
         for shard in self._dbconf['shards']:
-            self._conns[shard['shard']] = self._q()
-            for i in xrange(shard['count']):
-                ev = self._ev()
-                self._ready_evs.append(ev)
-                self._start_conn(shard, ev)
+            self._start_slot(shard)
+
+            # each replica gets its own pool, keyed by (shard, index)
+            for i, replica in enumerate(shard.get('replicas', ())):
+                info = dict(shard, **replica)
+                info.pop('replicas')
+                info['shard'] = (shard['shard'], i)
+                if 'count' in replica and 'max' not in replica:
+                    info['max'] = replica['count']
+                self._replicas.setdefault(shard['shard'], []).append(
+                        info['shard'])
+                self._start_slot(info)
+
+        self._start_sweeper()
+
+    def _start_slot(self, info):
+        slot = info['shard']
+        self._conns[slot] = self._q()
+        self._shard_info[slot] = info
+        self._size[slot] = info['count']
+        self._in_use[slot] = 0
+        self._stats[slot] = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+        }
+        for i in xrange(info['count']):
+            ev = self._ev()
+            self._ready_evs.append(ev)
+            self._start_conn(info, ev)
+
+    def after_fork(self):
+        '''Drop the connections inherited from a parent process and reconnect
+
+        A pool that was started before the process forked shares its
+        connections' sockets with the parent, and both sides using them would
+        corrupt the sessions. Each checkout notices when it is running in a
+        new process and calls this first, so a pre-forking server can create
+        and start one pool in the master and just keep using it in the
+        workers. The configuration, compiled insertion plans and contexts
+        aren't rebuilt, so they stay shared with the master copy-on-write.
+
+        This can also be called directly from a post-fork hook, to begin
+        connecting before the first request arrives. Either way, the new
+        connections are made in the background, the same as in
+        :meth:`start`.
+        '''
+        self._pid = os.getpid()
+        # a thread in the parent may have held the lock as it forked
+        self._lock = self._mutex()
+        self._out = {}
+        self._lag = {}
+        self._ready_evs = []
+
+        for slot, queue in self._conns.items():
+            while not queue.empty():
+                self._disown(queue.get())
+            self._start_slot(self._shard_info[slot])
+
+        # the parent's sweeper (if it even survived the fork) stops itself
+        self._start_sweeper()
 
     def wait_ready(self, timeout=None):
         '''Block until all dB connections are ready (or have exhausted retries)
@@ -168,39 +350,40 @@ class ConnectionPool(object):
         return True
 
     def put(self, conn):
-        shard = self._out.pop(id(conn))
-        self._conns[shard].put(conn)
+        if conn.pid != self._pid:
+            # checked out before a fork, the pool has since moved on
+            self._disown(conn)
+            return
+
+        with self._lock:
+            shard = self._out.pop(id(conn))
+            self._in_use[shard] -= 1
+        conn.last_used = time.time()
+        if conn.closed or self._expired(conn):
+            self._replace(shard, conn)
+        else:
+            self._conns[shard].put(conn)
 
     def shard_by_id(self, id):
         return id >> (64 - self.shardbits)
 
+    def _lookup_route(self, num):
+        modulus, routes = self._lookup_routes
+        if modulus is not None:
+            return routes[num % modulus]
+        return _route_from_plans(routes, num)
+
     def shards_for_lookup_hash(self, digest):
-        num = _int_hash(digest)
-        seen = set()
-        for plan in self._dbconf['lookup_insertion_plans'][::-1]:
-            shard = _pick_from_plan(digest, plan, num)
-            if shard in seen:
-                continue
-            seen.add(shard)
-            yield shard
+        return self._lookup_route(_int_hash(digest))
 
     def shards_for_lookup_prefix(self, value):
-        num = ord(value[0])
-        seen = set()
-        for plan in self._dbconf['lookup_insertion_plans'][::-1]:
-            shard = _pick_from_plan(None, plan, num)
-            if shard in seen:
-                continue
-            seen.add(shard)
-            yield shard
+        return self._lookup_route(ord(value[0]))
 
     def shard_for_alias_write(self, digest):
-        return _pick_from_plan(digest,
-                self._dbconf['lookup_insertion_plans'][-1])
+        return self._lookup_route(_int_hash(digest))[0]
 
     def shard_for_prefix_write(self, value):
-        return _pick_from_plan(None,
-                self._dbconf['lookup_insertion_plans'][-1], ord(value[0]))
+        return self._lookup_route(ord(value[0]))[0]
 
     # pass in the dmetaphone code, then these implementations are identical
     shard_for_phonetic_write = shard_for_prefix_write
@@ -212,22 +395,30 @@ class ConnectionPool(object):
         index = bisect.bisect_right(plan, (rand, 99999999999))
         return plan[index][1]
 
-    def get_by_shard(self, shard, replace=True, timeout=None):
+    def get_by_shard(self, shard, replace=True, timeout=None, read=False):
         if shard not in self._conns:
             raise error.NoShard(shard)
 
+        if os.getpid() != self._pid:
+            self.after_fork()
+
         if timeout is not None:
             deadline = time.time() + timeout
 
-        try:
-            conn = self._conns[shard].get(timeout)
-        except Queue.Empty:
-            raise error.Timeout()
+        slot = shard
+        if read and shard in self._replicas:
+            slot = self._route_read(shard)
 
-        if timeout is not None:
-            timeout = deadline - time.time()
+        conn = self._checkout(slot, timeout)
 
-        self._out[id(conn)] = shard
+        if slot != shard and self._too_stale(slot, conn):
+            self.put(conn)
+            if timeout is not None:
+                timeout = max(0, deadline - time.time())
+            conn = self._checkout(shard, timeout)
+
+        if timeout is not None:
+            timeout = max(0, deadline - time.time())
 
         if replace:
             if timeout is not None:
@@ -236,13 +427,213 @@ class ConnectionPool(object):
 
         return conn
 
-    def get_by_id(self, id, replace=True, timeout=None):
-        return self.get_by_shard(self.shard_by_id(id), replace, timeout)
+    def _checkout(self, slot, timeout):
+        queue = self._conns[slot]
+        stats = self._stats[slot]
+        with self._lock:
+            stats['checkouts'] += 1
+        start = time.time()
+        waited = False
+
+        if timeout is not None:
+            deadline = start + timeout
+
+        while 1:
+            if queue.empty():
+                waited = True
+                self._grow(slot)
+
+            try:
+                # once the deadline has passed only an idle connection will
+                # do, and a blocking get() won't take a negative timeout
+                conn = queue.get(timeout is None or timeout > 0, timeout)
+            except Queue.Empty:
+                with self._lock:
+                    stats['timeouts'] += 1
+                    stats['waits'] += 1
+                    stats['wait_time'] += time.time() - start
+                raise error.Timeout()
+
+            if timeout is not None:
+                timeout = deadline - time.time()
+
+            if not self._healthy(conn):
+                self._replace(slot, conn)
+            elif not self._reap(slot, conn):
+                break
+
+        with self._lock:
+            if waited:
+                stats['waits'] += 1
+                stats['wait_time'] += time.time() - start
+
+            self._out[id(conn)] = slot
+            self._in_use[slot] += 1
+
+        return conn
+
+    def _route_read(self, shard):
+        # least outstanding requests, among the replicas not known to be
+        # too far behind. falls back to the primary if there are none.
+        now = time.time()
+        best, fewest = [], None
+        for slot in self._replicas[shard]:
+            if not self._size[slot]:
+                continue
+            if self.max_staleness is not None:
+                lag, checked = self._lag.get(slot, (0, 0))
+                if (lag > self.max_staleness and
+                        now - checked < _LAG_CHECK_INTERVAL):
+                    continue
+            if fewest is None or self._in_use[slot] < fewest:
+                best, fewest = [slot], self._in_use[slot]
+            elif self._in_use[slot] == fewest:
+                best.append(slot)
+
+        if not best:
+            return shard
+        return random.choice(best)
+
+    def _too_stale(self, slot, conn):
+        if self.max_staleness is None:
+            return False
+
+        now = time.time()
+        lag, checked = self._lag.get(slot, (0, 0))
+        if now - checked >= _LAG_CHECK_INTERVAL:
+            try:
+                try:
+                    cursor = conn.conn.cursor()
+                    if conn.conn.server_version >= 100000:
+                        names = {'log': 'wal', 'pos': 'lsn'}
+                    else:
+                        names = {'log': 'xlog', 'pos': 'location'}
+                    cursor.execute(_LAG_QUERY % names)
+                    lag = cursor.fetchone()[0]
+                finally:
+                    # a failed rollback leaves the connection closed, so the
+                    # put() that follows replaces it
+                    conn.conn.rollback()
+            except psycopg2.Error:
+                lag = float('inf')
+            self._lag[slot] = (lag, now)
+
+        return lag > self.max_staleness
+
+    def stats(self):
+        '''Report the state of each shard's connections
+
+        :returns:
+            A dict mapping shard numbers (and ``(shard, index)`` pairs for
+            replicas) to dicts with these keys:
+
+            - ``size``: connections open or being opened
+            - ``idle``: connections waiting in the pool
+            - ``in_use``: connections checked out
+            - ``checkouts``: total number of checkouts
+            - ``waits``: checkouts that found no idle connection
+            - ``wait_time``: total seconds those checkouts spent waiting
+            - ``timeouts``: checkouts that gave up with a ``Timeout``
+        '''
+        results = {}
+        for shard, queue in self._conns.iteritems():
+            results[shard] = dict(self._stats[shard],
+                    size=self._size[shard],
+                    idle=queue.qsize(),
+                    in_use=self._in_use[shard])
+        return results
+
+    def get_by_id(self, id, replace=True, timeout=None, read=False):
+        return self.get_by_shard(self.shard_by_id(id), replace, timeout, read)
 
     def get_for_root_insert(self, replace=True, timeout=None):
         return self.get_by_shard(
                 self.shard_for_root_insert(), replace, timeout)
 
+    def scatter(self, groups, func, timeout=None, read=False):
+        '''run a function against a connection on several shards at once
+
+        Each shard's work runs in its own coroutine (via ``_background``), so
+        the total latency is that of the slowest shard rather than the sum of
+        all of them.
+
+        :param dict groups:
+            maps shard numbers to the piece of work for that shard
+
+        :param func:
+            called as ``func(conn, group)`` with a connection from the shard
+            and the shard's value from ``groups``
+
+        :param timeout:
+            maximum time in seconds for the whole operation, shared by all of
+            the shards. the default ``None`` means no limit.
+
+        :param bool read:
+            whether ``func`` only reads, and so may be run against replicas
+
+        :returns: a dict mapping shard numbers to the return values of ``func``
+
+        :raises Timeout: if any shard failed to finish within ``timeout``
+
+        if ``func`` raises for any shard, the first such exception is
+        re-raised once all the shards have finished.
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = {}
+
+        def run(shard, group):
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise error.Timeout()
+
+            with self.get_by_shard(
+                    shard, timeout=remaining, read=read) as conn:
+                results[shard] = func(conn, group)
+
+        self._fan_out(groups, run)
+        return results
+
+    def _fan_out(self, groups, run):
+        # call ``run(shard, group)`` for each item in ``groups``, each in its
+        # own coroutine when there is more than one, and wait for them all.
+        # the first exception raised (if any) is re-raised at the end.
+        if len(groups) == 1:
+            run(*next(groups.iteritems()))
+            return
+
+        failures = []
+
+        def background(shard, group, done):
+            @self._background
+            def f():
+                try:
+                    run(shard, group)
+                except Exception:
+                    failures.append(sys.exc_info())
+                finally:
+                    done.set()
+
+        evs = []
+        for shard, group in groups.iteritems():
+            ev = self._ev()
+            evs.append(ev)
+            background(shard, group, ev)
+
+        for ev in evs:
+            ev.wait()
+
+        if failures:
+            klass, exc, tb = failures[0]
+            raise klass, exc, tb
+
+    @staticmethod
+    def _mutex():
+        return _NullLock()
+
     def backoff(self):
         yield 0 # single immediate retry
         jitter = 0.25
@@ -252,6 +643,123 @@ class ConnectionPool(object):
             n *= 2 + (jitter * (random.random() - 0.5))
             yield n
 
+    def _expired(self, conn):
+        return (self.max_lifetime is not None and
+                time.time() - conn.created > self.max_lifetime)
+
+    def _healthy(self, conn):
+        if conn.closed or self._expired(conn):
+            return False
+
+        if (self.check_idle is None or
+                time.time() - conn.last_used <= self.check_idle):
+            return True
+
+        try:
+            conn.conn.cursor().execute('select 1')
+            conn.conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _replace(self, shard, conn):
+        # drop a dead or worn-out connection, and start making a new one
+        self._close(conn)
+        self._start_conn(self._shard_info[shard])
+
+    def _grow(self, shard):
+        with self._lock:
+            # an idle sweep may have put its connections back in the meantime
+            if (not self._conns[shard].empty() or
+                    self._size[shard] >= self._shard_info[shard]['max']):
+                return
+            self._size[shard] += 1
+        self._start_conn(self._shard_info[shard])
+
+    def _reap(self, shard, conn):
+        # close ``conn`` if the shard has grown and it has been idle too long,
+        # but never the last idle connection, as the caller would only have
+        # to wait for another one to be opened
+        with self._lock:
+            if (self._size[shard] <= self._shard_info[shard]['count'] or
+                    self._conns[shard].empty() or
+                    time.time() - conn.last_used <= self.idle_timeout):
+                return False
+            self._size[shard] -= 1
+        self._close(conn)
+        return True
+
+    def _start_sweeper(self):
+        # reaping at checkout alone never gets to a shard with no traffic,
+        # so a background loop sweeps every idle_timeout as well. it only
+        # holds a weak reference to the pool between sweeps, and quits once
+        # the pool is gone or the process has forked.
+        if self.idle_timeout is None or all(info['max'] == info['count']
+                for info in self._shard_info.itervalues()):
+            return
+
+        ref = weakref.ref(self)
+        pid = self._pid
+        pause = self._pause
+        interval = self.idle_timeout * 1000
+
+        @self._background
+        def sweep():
+            while 1:
+                pause(interval)
+                pool = ref()
+                if pool is None or pool._pid != pid:
+                    return
+                pool._sweep_idle()
+                del pool
+
+    def _sweep_idle(self):
+        # close the idle connections that have gone unused for idle_timeout,
+        # oldest first, as far as each shard is above its count
+        now = time.time()
+        for slot, queue in self._conns.items():
+            # with the queue drained, a checkout would take it for an empty
+            # shard and grow it, so hold the lock that _grow takes throughout
+            with self._lock:
+                idle = []
+                while not queue.empty():
+                    try:
+                        idle.append(queue.get(False))
+                    except Queue.Empty:
+                        break
+
+                # most recently used first
+                while (idle and
+                        now - idle[-1].last_used > self.idle_timeout and
+                        self._size[slot] > self._shard_info[slot]['count']):
+                    self._size[slot] -= 1
+                    self._close(idle.pop())
+
+                for conn in reversed(idle):
+                    queue.put(conn)
+
+    def _disown(self, conn):
+        # close a connection inherited from the parent process. closing sends
+        # the server a goodbye on the shared socket which would end the
+        # parent's session too, so first point our copy of the descriptor at
+        # /dev/null, and if that can't be done just never close it
+        try:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            try:
+                os.dup2(devnull, conn.fileno())
+            finally:
+                os.close(devnull)
+        except (EnvironmentError, psycopg2.Error):
+            _disowned.append(conn)
+            return
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
     @contextlib.contextmanager
     def _replacement_context(self, conn):
         c = None
@@ -282,11 +790,11 @@ class ConnectionPool(object):
                     port=info['port'],
                     user=info['user'],
                     password=info['password'],
-                    database=info['database']))
+                    database=info['database']), self.prepare_statements)
         except psycopg2.OperationalError:
             return None
 
-    def _start_conn(self, shard, done):
+    def _start_conn(self, shard, done=None):
         @self._background
         def f():
             conn = self._try_conn(shard)
@@ -299,18 +807,70 @@ class ConnectionPool(object):
 
             if conn is not None:
                 self._conns[shard['shard']].put(conn)
-            done.set()
+            else:
+                # gave up, so it no longer counts towards the shard's size
+                with self._lock:
+                    self._size[shard['shard']] -= 1
+            if done is not None:
+                done.set()
+
+
+# inherited connections that couldn't be safely closed
+_disowned = []
+
+
+class _NullLock(object):
+    # the cooperative pools only switch coroutines on I/O, so their
+    # accounting doesn't need a real lock
+    def __enter__(self):
+        return self
+
+    def __exit__(self, klass=None, exc=None, tb=None):
+        pass
+
+
+# how often a replica's replay lag is measured, when there's a max_staleness
+_LAG_CHECK_INTERVAL = 1
+
+# the last replayed transaction only ages on a replica with nothing left to
+# replay when the primary is idle, so that case counts as no lag at all.
+# postgres 10 renamed the functions that report the replica's position.
+_LAG_QUERY = """
+select case
+    when pg_last_%(log)s_receive_%(pos)s() =
+        pg_last_%(log)s_replay_%(pos)s() then 0
+    else coalesce(
+        extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+end
+"""
 
 
 class PsycoConn(object):
-    def __init__(self, conn):
+    def __init__(self, conn, prepare=False):
         self.conn = conn
+        # statement text -> name of the server-side prepared statement
+        self.prepared = {} if prepare else None
+        self.created = self.last_used = time.time()
+        self.pid = os.getpid()
 
     def __getattr__(self, k):
         if k == 'conn':
             return self.conn
         return getattr(self.conn, k)
 
+    def reset(self):
+        # psycopg2 resets with DISCARD ALL, which deallocates every prepared
+        # statement on the server side as well
+        self.conn.reset()
+        if self.prepared is not None:
+            self.prepared.clear()
+
+    def cursor(self, *args, **kwargs):
+        cursor = self.conn.cursor(*args, **kwargs)
+        if self.prepared is None or args or kwargs:
+            return cursor
+        return PreparingCursor(cursor, self.prepared)
+
     def __enter__(self):
         self.conn.__enter__()
         return self
@@ -325,6 +885,62 @@ class PsycoConn(object):
         return self
 
 
+class PreparingCursor(object):
+    '''a cursor wrapper that can run statements through PREPARE/EXECUTE
+
+    ``execute`` is passed straight through, only ``execute_prepared`` uses
+    (and fills) the connection's registry of prepared statements.
+    '''
+    MAX_PREPARED = 256
+
+    def __init__(self, cursor, registry):
+        self._cursor = cursor
+        self._registry = registry
+
+    def __getattr__(self, k):
+        return getattr(self._cursor, k)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args):
+        return self._cursor.execute(*args)
+
+    def execute_prepared(self, sql, params=()):
+        name = self._registry.get(sql)
+
+        if name is None:
+            if len(self._registry) >= self.MAX_PREPARED:
+                return self._cursor.execute(sql, params)
+
+            name = 'datahog_%d' % len(self._registry)
+            self._cursor.execute(
+                    'prepare %s as %s' % (name, _number_params(sql)))
+
+            # PREPARE isn't undone by a rollback, so this is safe to keep
+            # even if the surrounding transaction is later aborted
+            self._registry[sql] = name
+
+        if not params:
+            return self._cursor.execute('execute %s' % (name,))
+
+        return self._cursor.execute('execute %s (%s)' % (
+                name, ','.join(['%s'] * len(params))), params)
+
+
+_param_re = re.compile('%(%|s)')
+
+def _number_params(sql):
+    # turn psycopg2's %s placeholders into postgres' $1, $2, ...
+    counter = [0]
+    def sub(match):
+        if match.group(1) == '%':
+            return '%'
+        counter[0] += 1
+        return '$%d' % counter[0]
+    return _param_re.sub(sub, sql)
+
+
 if greenhouse:
     __all__.append("GreenhouseConnPool")
 
@@ -339,7 +955,7 @@ if greenhouse:
 
         @staticmethod
         def _q():
-            return greenhouse.Queue()
+            return greenhouse.LifoQueue()
 
         @staticmethod
         def _ev():
@@ -398,7 +1014,7 @@ if gevent:
 
         @staticmethod
         def _q():
-            return gevent.queue.Queue()
+            return gevent.queue.LifoQueue()
 
         @staticmethod
         def _ev():
@@ -415,18 +1031,283 @@ if gevent:
         _timer = _gevent_timer
 
 
+class ThreadedConnPool(ConnectionPool):
+    '''a :class:`ConnectionPool` for use from ordinary threads
+
+    for thread-per-request servers. blocking calls are plain blocking calls,
+    background work (connecting, concurrent queries across shards) gets its
+    own threads, and checkouts and returns are accounted under a lock.
+    '''
+    @staticmethod
+    def _background(f):
+        t = threading.Thread(target=f)
+        t.daemon = True
+        t.start()
+
+    @staticmethod
+    def _q():
+        return Queue.LifoQueue()
+
+    @staticmethod
+    def _ev():
+        return threading.Event()
+
+    @staticmethod
+    def _pause(ms):
+        time.sleep(ms / 1000.0)
+
+    @staticmethod
+    def _mutex():
+        return threading.RLock()
+
+    # threading.Timer is a factory function in python 2
+    _timer = staticmethod(threading.Timer)
+
+
+if greenlet:
+    __all__.append("AsyncioConnPool")
+
+    class _AioTask(greenlet.greenlet):
+        # a greenlet that parks on its event loop whenever it would block
+        def __init__(self, run, loop, parent):
+            super(_AioTask, self).__init__(run, parent)
+            self.loop = loop
+
+    class _AioWaiter(object):
+        # one suspension of the current task, until wake() or a timeout
+        def __init__(self):
+            self.task = greenlet.getcurrent()
+            if not isinstance(self.task, _AioTask):
+                raise RuntimeError("blocking AsyncioConnPool calls have to "
+                        "be made through AsyncioConnPool.run")
+            self.loop = self.task.loop
+            self.done = False
+
+        def wake(self, value=True):
+            # runs as a loop callback, in the loop's greenlet
+            if not self.done:
+                self.done = True
+                self.task.switch(value)
+
+        def wait(self, timeout=None):
+            handle = None
+            if timeout is not None:
+                handle = self.loop.call_later(
+                        max(timeout, 0), self.wake, False)
+            try:
+                return self.task.parent.switch()
+            finally:
+                self.done = True
+                if handle is not None:
+                    handle.cancel()
+
+    def _aio_wait_fd(fd, add, remove):
+        waiter = _AioWaiter()
+        add(waiter.loop)(fd, waiter.wake)
+        try:
+            waiter.wait()
+        finally:
+            remove(waiter.loop)(fd)
+
+    def _aio_wait_callback(conn):
+        # outside of a task (a plain thread, say) just block on the socket
+        task = greenlet.getcurrent()
+        parked = isinstance(task, _AioTask)
+        while 1:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                break
+            elif state == psycopg2.extensions.POLL_READ:
+                if parked:
+                    _aio_wait_fd(conn.fileno(), lambda loop: loop.add_reader,
+                            lambda loop: loop.remove_reader)
+                else:
+                    select.select([conn.fileno()], [], [])
+            elif state == psycopg2.extensions.POLL_WRITE:
+                if parked:
+                    _aio_wait_fd(conn.fileno(), lambda loop: loop.add_writer,
+                            lambda loop: loop.remove_writer)
+                else:
+                    select.select([], [conn.fileno()], [])
+            else:
+                raise psycopg2.OperationalError(
+                        'Bad result from poll: %r' % state)
+
+    class _AioQueue(object):
+        # a LIFO queue whose blocking gets park the calling task
+        def __init__(self, loop):
+            self._loop = loop
+            self._data = []
+            self._waiters = []
+
+        def empty(self):
+            return not self._data
+
+        def qsize(self):
+            return len(self._data)
+
+        def put(self, item):
+            self._data.append(item)
+            if self._waiters:
+                self._loop.call_soon(self._waiters.pop(0).wake)
+
+        def get(self, block=True, timeout=None):
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._data:
+                if not block:
+                    raise Queue.Empty()
+                waiter = _AioWaiter()
+                self._waiters.append(waiter)
+                try:
+                    if timeout is None:
+                        waiter.wait()
+                    elif not waiter.wait(deadline - time.time()):
+                        if not self._data:
+                            raise Queue.Empty()
+                finally:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+            return self._data.pop()
+
+    class _AioEvent(object):
+        def __init__(self, loop):
+            self._loop = loop
+            self._flag = False
+            self._waiters = []
+
+        def is_set(self):
+            return self._flag
+
+        def set(self):
+            self._flag = True
+            waiters, self._waiters = self._waiters, []
+            for waiter in waiters:
+                self._loop.call_soon(waiter.wake)
+
+        def wait(self, timeout=None):
+            if not self._flag:
+                waiter = _AioWaiter()
+                self._waiters.append(waiter)
+                try:
+                    waiter.wait(timeout)
+                finally:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+            return self._flag
+
+    class _AioTimer(object):
+        def __init__(self, loop, timeout, func):
+            self._loop = loop
+            self._timeout = timeout
+            self._func = func
+            self._handle = None
+
+        def start(self):
+            if self._handle is None:
+                self._handle = self._loop.call_later(self._timeout, self._func)
+
+        def cancel(self):
+            if self._handle is not None:
+                self._handle.cancel()
+
+    class AsyncioConnPool(ConnectionPool):
+        '''a :class:`ConnectionPool` for use from asyncio/trollius coroutines
+
+        every blocking call runs in a greenlet, and waits on the event loop
+        instead of blocking it: postgres sockets through ``add_reader`` and
+        ``add_writer`` (by way of psycopg2's wait callback, just as the
+        greenhouse and gevent pools do), and pool checkouts, pauses and
+        timeouts through the loop's own callbacks. so any number of calls
+        can be in flight on the loop's one thread, without an executor.
+
+        the calls have to be made through :meth:`run`, which hands back a
+        future for the result. :mod:`datahog.aio` wraps the whole api that
+        way. :meth:`start` only schedules the connecting, so wait for the pool
+        through :meth:`run` as well::
+
+            pool = datahog.AsyncioConnPool(dbconf)
+            pool.start()
+            yield trollius.From(pool.run(datahog.AsyncioConnPool.wait_ready))
+
+        it needs greenlet, and on python 2 trollius, which the ``asyncio``
+        extra installs (``pip install datahog[asyncio]``).
+
+        :param loop:
+            the event loop to run on, by default the current loop of
+            trollius_ (or asyncio, where that exists)
+
+        :raises RuntimeError:
+            if no ``loop`` is given and neither trollius nor asyncio is
+            installed
+
+        .. _trollius: https://pypi.python.org/pypi/trollius
+        '''
+        def __init__(self, dbconf, readonly=False, loop=None):
+            if loop is None:
+                if asyncio is None:
+                    raise RuntimeError(
+                            "no loop given, and no asyncio or trollius")
+                loop = asyncio.get_event_loop()
+
+            self._loop = loop
+            super(AsyncioConnPool, self).__init__(dbconf, readonly)
+
+        def _background(self, f):
+            # tasks always return to the loop's greenlet, even when spawned
+            # from inside another task
+            parent = greenlet.getcurrent()
+            if isinstance(parent, _AioTask):
+                parent = parent.parent
+            self._loop.call_soon(_AioTask(f, self._loop, parent).switch)
+
+        def _q(self):
+            return _AioQueue(self._loop)
+
+        def _ev(self):
+            return _AioEvent(self._loop)
+
+        @staticmethod
+        def _pause(ms):
+            _AioWaiter().wait(ms / 1000.0)
+
+        def _timer(self, timeout, func):
+            return _AioTimer(self._loop, timeout, func)
+
+        def start(self):
+            psycopg2.extensions.set_wait_callback(_aio_wait_callback)
+            super(AsyncioConnPool, self).start()
+
+        def run(self, func, *args, **kwargs):
+            '''run ``func(pool, *args, **kwargs)`` in a task on the loop
+
+            :param func:
+                a function that takes the pool as its first argument, like
+                those in :mod:`datahog.api`
+
+            :returns:
+                a future for the result of ``func``, to be awaited from a
+                coroutine on the pool's loop
+            '''
+            future = asyncio.Future(loop=self._loop)
+
+            @self._background
+            def task():
+                try:
+                    result = func(self, *args, **kwargs)
+                except Exception as exc:
+                    if not future.cancelled():
+                        future.set_exception(exc)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+
+            return future
+
+
 def _int_hash(digest):
-    n = 0
-    for c in digest:
-        n <<= 8
-        n |= ord(c)
-    return n
-
-def _pick_from_plan(digest, plan, num=None):
-    if num is None:
-        num = _int_hash(digest)
-    index = bisect.bisect_right(plan, (num % plan[-1][0], 999999999))
-    return plan[index][1]
+    # big-endian bytes to int, without a python-level loop
+    return int(binascii.hexlify(digest), 16)
 
 # convert a [(shard, weight)] plan to a [(partialsum, shard)] plan
 def _prepare_plan(plan):
@@ -434,3 +1315,35 @@ def _prepare_plan(plan):
     for i, (shard, weight) in enumerate(plan):
         partial += weight
         plan[i] = (partial, shard)
+
+# largest lcm of plan totals for which a full routing table gets built
+_MAX_ROUTE_TABLE = 1 << 16
+
+# a plan's pick only depends on num % (its total weight), so the ordered and
+# de-duplicated shard tuple for every lookup depends only on num modulo the
+# lcm of all the plans' totals. when that is small enough, precompute them all
+# into (lcm, routes), otherwise (None, plans) for _route_from_plans.
+def _compile_routes(plans):
+    plans = [(plan[-1][0], plan) for plan in plans[::-1]]
+
+    modulus = 1
+    for total, plan in plans:
+        modulus = modulus * total // fractions.gcd(modulus, total)
+        if modulus > _MAX_ROUTE_TABLE:
+            return None, plans
+
+    interned = {}
+    routes = []
+    for num in xrange(modulus):
+        route = _route_from_plans(plans, num)
+        routes.append(interned.setdefault(route, route))
+
+    return modulus, tuple(routes)
+
+def _route_from_plans(plans, num):
+    route = ()
+    for total, plan in plans:
+        shard = plan[bisect.bisect_right(plan, (num % total, 999999999))][1]
+        if shard not in route:
+            route += (shard,)
+    return route
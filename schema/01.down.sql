@@ -0,0 +1,4 @@
+alter table name alter column pos type int;
+alter table edge alter column pos type int;
+alter table relationship alter column pos type int;
+alter table alias alter column pos type int;
@@ -0,0 +1,6 @@
+-- SPARSE ordered lists space their positions far apart, so they need room
+
+alter table alias alter column pos type bigint;
+alter table relationship alter column pos type bigint;
+alter table edge alter column pos type bigint;
+alter table name alter column pos type bigint;
@@ -0,0 +1 @@
+drop table remove_queue;
@@ -0,0 +1,15 @@
+-- nodes removed with node.remove(..., defer=True) whose subtrees are still to
+-- be cleared out by node.sweep
+
+create table remove_queue (
+  id bigint not null,
+  time_queued timestamp default now() not null
+);
+
+create index remove_queue_id on remove_queue (
+  id
+);
+
+create index remove_queue_time on remove_queue (
+  time_queued
+);
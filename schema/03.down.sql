@@ -0,0 +1,9 @@
+drop index phonetic_lookup_removed;
+drop index prefix_lookup_removed;
+drop index name_removed;
+drop index edge_removed;
+drop index node_removed;
+drop index relationship_removed;
+drop index alias_lookup_removed;
+drop index alias_removed;
+drop index property_removed;
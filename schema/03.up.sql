@@ -0,0 +1,39 @@
+-- purge.run walks the removed rows of each table in time_removed order,
+-- which the indexes for live rows (all "where time_removed is null") can't
+-- help with
+
+create index property_removed on property (
+  time_removed
+) where time_removed is not null;
+
+create index alias_removed on alias (
+  time_removed
+) where time_removed is not null;
+
+create index alias_lookup_removed on alias_lookup (
+  time_removed
+) where time_removed is not null;
+
+create index relationship_removed on relationship (
+  time_removed
+) where time_removed is not null;
+
+create index node_removed on node (
+  time_removed
+) where time_removed is not null;
+
+create index edge_removed on edge (
+  time_removed
+) where time_removed is not null;
+
+create index name_removed on name (
+  time_removed
+) where time_removed is not null;
+
+create index prefix_lookup_removed on prefix_lookup (
+  time_removed
+) where time_removed is not null;
+
+create index phonetic_lookup_removed on phonetic_lookup (
+  time_removed
+) where time_removed is not null;
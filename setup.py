@@ -9,6 +9,7 @@ VERSION = (0, 0, 2, "")
 
 install_deps = ['psycopg2', 'mummy']
 test_deps = install_deps + ['greenhouse', 'fuzzy', 'nose']
+extras = {'asyncio': ['trollius', 'greenlet']}
 
 setup(
     name="datahog",
@@ -16,6 +17,7 @@ setup(
     packages=["datahog", "datahog.api", "datahog.const", "datahog.db"],
     version='.'.join(filter(None, map(str, VERSION))),
     install_requires=install_deps,
+    extras_require=extras,
     tests_require=test_deps,
     test_suite='nose.collector',
 )
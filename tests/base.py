@@ -36,6 +36,19 @@ class TestCase(unittest.TestCase):
         self.p.wait_ready()
         reset()
 
+    def shard_pool(self, shards, **extra):
+        "build and start a second pool spanning shards 0 through shards-1"
+        conf = copy.deepcopy(self.CONFIG)
+        conf['shards'] = [dict(conf['shards'][0], shard=i)
+                for i in xrange(shards)]
+        conf['lookup_insertion_plans'] = [[(i, 1) for i in xrange(shards)]]
+        conf.update(extra)
+        p = datahog.GreenhouseConnPool(conf)
+        p.start()
+        p.wait_ready()
+        reset()
+        return p
+
     def tearDown(self):
         self.assertEqual(len(self.p._conns[0]._data), 2)
         self.p = None
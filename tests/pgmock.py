@@ -9,9 +9,10 @@ import psycopg2
 
 __all__ = ["activate", "deactivate", "reset", "connect_fail", "query_fail",
         "add_fetch_result", "eventlog", "CONNECT", "CONNECT_FAIL",
-        "GET_CURSOR", "COMMIT", "ROLLBACK", "RESET", "TPC_BEGIN", "TPC_COMMIT",
-        "TPC_ROLLBACK", "TPC_PREPARE", "FETCH_ONE", "FETCH_ALL", "ROWCOUNT",
-        "EXECUTE", "EXECUTE_FAILURE"]
+        "GET_CURSOR", "GET_NAMED_CURSOR", "COMMIT", "ROLLBACK", "RESET",
+        "TPC_BEGIN", "TPC_COMMIT", "TPC_ROLLBACK", "TPC_PREPARE", "FETCH_ONE",
+        "FETCH_ALL", "FETCH_MANY", "ROWCOUNT", "EXECUTE", "EXECUTE_FAILURE",
+        "COPY"]
 
 
 def activate():
@@ -58,6 +59,7 @@ class pgevent(object):
 CONNECT = pgevent("CONNECT")
 CONNECT_FAIL = pgevent("CONNECT_FAIL")
 GET_CURSOR = pgevent("GET_CURSOR")
+GET_NAMED_CURSOR = pgevent("GET_NAMED_CURSOR")
 COMMIT = pgevent("COMMIT")
 ROLLBACK = pgevent("ROLLBACK")
 RESET = pgevent("RESET")
@@ -67,6 +69,7 @@ TPC_ROLLBACK = pgevent("TPC_ROLLBACK")
 TPC_PREPARE = pgevent("TPC_PREPARE")
 FETCH_ONE = pgevent("FETCH_ONE")
 FETCH_ALL = pgevent("FETCH_ALL")
+FETCH_MANY = pgevent("FETCH_MANY")
 ROWCOUNT = pgevent("ROWCOUNT")
 class EXECUTE(object):
     def __init__(self, pattern, args):
@@ -85,11 +88,32 @@ class EXECUTE(object):
                 self.args == other.args)
 class EXECUTE_FAILURE(EXECUTE):
     pass
+class COPY(object):
+    def __init__(self, table, columns, data):
+        self.table = table
+        self.columns = tuple(columns)
+        self.data = data
+
+    def __repr__(self):
+        return '<%s table: %s, columns: %r, data: %r>' % (
+                type(self).__name__, self.table, self.columns, self.data)
+
+    def __eq__(self, other):
+        return (isinstance(other, type(self)) and
+                self.table == other.table and
+                self.columns == other.columns and
+                self.data == other.data)
 
 
 class FakePGConn(object):
-    def cursor(self):
-        _log(GET_CURSOR)
+    closed = 0
+    server_version = 100000
+
+    def close(self):
+        self.closed = 1
+
+    def cursor(self, name=None):
+        _log(GET_CURSOR if name is None else GET_NAMED_CURSOR)
         return FakePGCursor()
 
     def commit(self): _log(COMMIT)
@@ -114,6 +138,8 @@ class FakePGConn(object):
 
 
 class FakePGCursor(object):
+    itersize = 2000
+
     def execute(self, pattern, args=()):
         args = tuple(
                 x.adapted if isinstance(x, type(psycopg2.Binary(''))) else x
@@ -124,6 +150,10 @@ class FakePGCursor(object):
         _log(EXECUTE(pattern, args))
         _fetch[0] += 1
 
+    def copy_from(self, fp, table, sep='\t', null='\\N', size=8192,
+            columns=None):
+        _log(COPY(table, columns or (), fp.read()))
+
     def fetchone(self):
         _log(FETCH_ONE)
         if not _fetch:
@@ -138,6 +168,18 @@ class FakePGCursor(object):
         _fetch[1][i][:] = []
         return results
 
+    def __iter__(self):
+        # like a named cursor, pull results down ``itersize`` at a time
+        i = _fetch[0]
+        while 1:
+            _log(FETCH_MANY)
+            results = _fetch[1][i][:self.itersize]
+            _fetch[1][i][:self.itersize] = []
+            for result in results:
+                yield result
+            if len(results) < self.itersize:
+                break
+
     @property
     def rowcount(self):
         _log(ROWCOUNT)
@@ -0,0 +1,168 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import copy
+import os
+import sys
+import unittest
+
+import datahog
+import datahog.aio
+from datahog import pool as dbpool
+import psycopg2.extensions
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+needs_loop = unittest.skipIf(
+        dbpool.asyncio is None or dbpool.greenlet is None,
+        "the asyncio extra (trollius, greenlet) isn't installed")
+
+
+class RecordingPool(object):
+    def __init__(self):
+        self.calls = []
+
+    def run(self, func, *args, **kwargs):
+        self.calls.append((func, args, kwargs))
+        return 'future'
+
+
+class PollingConn(object):
+    # stands in for a psycopg2 connection in async mode, waiting to read
+    def __init__(self, fd):
+        self.fd = fd
+        self.states = [psycopg2.extensions.POLL_READ]
+
+    def fileno(self):
+        return self.fd
+
+    def poll(self):
+        if self.states:
+            return self.states.pop(0)
+        return psycopg2.extensions.POLL_OK
+
+
+class AioTests(base.TestCase):
+    def setUp(self):
+        super(AioTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE,
+                {'base_ctx': 1, 'storage': datahog.storage.INT})
+
+    def test_wraps_through_run(self):
+        p = RecordingPool()
+        self.assertEqual(
+                datahog.aio.alias.lookup(p, u'value', 3, timeout=5), 'future')
+        self.assertEqual(p.calls, [
+            (datahog.alias.lookup, (u'value', 3), {'timeout': 5})])
+
+    def test_namespaces(self):
+        self.assertEqual(datahog.aio.node.create.__name__, 'create')
+        self.assertEqual(datahog.aio.purge.TABLES, datahog.purge.TABLES)
+        self.assertFalse(hasattr(datahog.aio.alias, 'iter'))
+        self.assertFalse(hasattr(datahog.aio.node, 'iter_children'))
+
+    def test_needs_a_loop(self):
+        if dbpool.greenlet is None:
+            raise unittest.SkipTest("greenlet isn't installed")
+        if dbpool.asyncio is not None:
+            raise unittest.SkipTest("asyncio or trollius is installed")
+        self.assertRaises(RuntimeError,
+                datahog.AsyncioConnPool, copy.deepcopy(self.CONFIG))
+
+    def aio_pool(self, **extra):
+        self.loop = dbpool.asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        conf = copy.deepcopy(self.CONFIG)
+        conf.update(extra)
+        p = datahog.AsyncioConnPool(conf, loop=self.loop)
+        p.start()
+        self.assertTrue(self.wait(p.run(datahog.AsyncioConnPool.wait_ready)))
+        reset()
+        return p
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    @needs_loop
+    def test_query(self):
+        p = self.aio_pool()
+        add_fetch_result([(0, 7)])
+
+        self.assertEqual(self.wait(datahog.aio.node.get(p, 1234, 2)),
+                {'id': 1234, 'ctx': 2, 'value': 7, 'flags': set()})
+        self.assertEqual(eventlog[-1], COMMIT)
+        self.assertEqual(p.stats()[0]['idle'], 2)
+
+    @needs_loop
+    def test_checkout_parks_on_the_loop(self):
+        p = self.aio_pool()
+        held = [p.get_by_shard(0, replace=False, timeout=0)
+                for i in xrange(2)]
+        order = []
+
+        def checkout(pool):
+            conn = pool.get_by_shard(0, replace=False)
+            order.append('checked out')
+            pool.put(conn)
+
+        def give_back():
+            order.append('returned')
+            p.put(held.pop())
+
+        # the call waits for a connection without holding up the loop, which
+        # goes on to run the callback that returns one
+        future = p.run(checkout)
+        self.loop.call_later(0.01, give_back)
+        self.wait(future)
+        p.put(held.pop())
+
+        self.assertEqual(order, ['returned', 'checked out'])
+        self.assertEqual(p.stats()[0]['idle'], 2)
+
+    @needs_loop
+    def test_checkout_timeout(self):
+        p = self.aio_pool()
+        held = [p.get_by_shard(0, replace=False, timeout=0)
+                for i in xrange(2)]
+
+        self.assertRaises(datahog.error.Timeout, self.wait,
+                p.run(datahog.AsyncioConnPool.get_by_shard, 0, False, 0.01))
+        for conn in held:
+            p.put(conn)
+
+    @needs_loop
+    def test_wait_callback_parks_on_reader(self):
+        p = self.aio_pool()
+        rfd, wfd = os.pipe()
+        self.addCleanup(os.close, rfd)
+        self.addCleanup(os.close, wfd)
+        conn = PollingConn(rfd)
+        order = []
+
+        def query(pool):
+            dbpool._aio_wait_callback(conn)
+            order.append('readable')
+
+        def write():
+            order.append('written')
+            os.write(wfd, 'x')
+
+        future = p.run(query)
+        self.loop.call_later(0.01, write)
+        self.wait(future)
+
+        self.assertEqual(order, ['written', 'readable'])
+        self.assertEqual(conn.states, [])
+
+    @needs_loop
+    def test_blocking_outside_run(self):
+        p = self.aio_pool()
+        self.assertRaises(RuntimeError, p._pause, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,7 @@ import psycopg2
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import base
+import pgmock
 from pgmock import *
 
 
@@ -80,6 +81,69 @@ where exists (
             COMMIT,
             TPC_COMMIT])
 
+    def test_set_sparse_at_index(self):
+        datahog.set_context(3, datahog.ALIAS, {
+            'base_ctx': 1, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([])
+        add_fetch_result([(65536,), (131072,)])
+        add_fetch_result([None])
+
+        self.assertEqual(
+                datahog.alias.set(self.p, 123, 3, 'value', index=1),
+                True)
+
+        h = hmac.new(self.p.digestkey, 'value', hashlib.sha1).digest()
+
+        self.assertEqual(eventlog, [
+            TPC_BEGIN,
+            GET_CURSOR,
+            EXECUTE("""
+with selectquery (base_id) as (
+    select base_id
+    from alias_lookup
+    where
+        time_removed is null
+        and hash=%s
+        and ctx=%s
+),
+insertquery as (
+    insert into alias_lookup (hash, ctx, base_id, flags)
+    select %s, %s, %s, %s
+    where not exists (select 1 from selectquery)
+)
+select base_id
+from selectquery
+""", (h, 3, h, 3, 123, 0)),
+            ROWCOUNT,
+            TPC_PREPARE,
+            RESET,
+            GET_CURSOR,
+            EXECUTE("""
+select pos
+from alias
+where
+    time_removed is null
+    and base_id=%s and ctx=%s
+order by pos asc
+offset %s
+limit 2
+""", (123, 3, 0)),
+            FETCH_ALL,
+            EXECUTE("""
+insert into alias (base_id, ctx, value, pos, flags)
+select %s, %s, %s, %s, %s
+where exists (
+    select 1 from node
+    where
+        time_removed is null
+        and id=%s
+        and ctx=%s
+)
+""", (123, 3, 'value', 98304, 0, 123, 1)),
+            ROWCOUNT,
+            COMMIT,
+            TPC_COMMIT])
+
     def test_set_failure_already_exists(self):
         add_fetch_result([(123,)])
 
@@ -193,6 +257,249 @@ where
             FETCH_ONE,
             ROLLBACK])
 
+    def test_set_one_phase_local(self):
+        self.p.one_phase_local = True
+        add_fetch_result([])
+        add_fetch_result([None])
+
+        self.assertEqual(
+                datahog.alias.set(self.p, 123, 2, 'value'),
+                True)
+
+        h = hmac.new(self.p.digestkey, 'value', hashlib.sha1).digest()
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with selectquery (base_id) as (
+    select base_id
+    from alias_lookup
+    where
+        time_removed is null
+        and hash=%s
+        and ctx=%s
+),
+insertquery as (
+    insert into alias_lookup (hash, ctx, base_id, flags)
+    select %s, %s, %s, %s
+    where not exists (select 1 from selectquery)
+)
+select base_id
+from selectquery
+""", (h, 2, h, 2, 123, 0)),
+            ROWCOUNT,
+            GET_CURSOR,
+            EXECUTE("""
+insert into alias (base_id, ctx, value, pos, flags)
+select %s, %s, %s, coalesce((
+    select pos + 1
+    from alias
+    where
+        time_removed is null
+        and base_id=%s
+        and ctx=%s
+    order by pos desc
+    limit 1
+), 1), %s
+where exists (
+    select 1 from node
+    where
+        time_removed is null
+        and id=%s
+        and ctx=%s
+)
+""", (123, 2, 'value', 123, 2, 0, 123, 1)),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_set_one_phase_local_claimed(self):
+        self.p.one_phase_local = True
+        add_fetch_result([(124,)])
+
+        self.assertRaises(error.AliasInUse,
+                datahog.alias.set, self.p, 123, 2, 'value')
+
+        h = hmac.new(self.p.digestkey, 'value', hashlib.sha1).digest()
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with selectquery (base_id) as (
+    select base_id
+    from alias_lookup
+    where
+        time_removed is null
+        and hash=%s
+        and ctx=%s
+),
+insertquery as (
+    insert into alias_lookup (hash, ctx, base_id, flags)
+    select %s, %s, %s, %s
+    where not exists (select 1 from selectquery)
+)
+select base_id
+from selectquery
+""", (h, 2, h, 2, 123, 0)),
+            ROWCOUNT,
+            FETCH_ONE,
+            ROLLBACK])
+
+    def test_set_one_phase_local_no_base(self):
+        self.p.one_phase_local = True
+        add_fetch_result([])
+        add_fetch_result([])
+
+        self.assertRaises(error.NoObject,
+                datahog.alias.set, self.p, 123, 2, 'value')
+
+        self.assertEqual(eventlog[-1], ROLLBACK)
+        self.assertNotIn(TPC_BEGIN, eventlog)
+        self.assertNotIn(COMMIT, eventlog)
+
+    def test_set_many(self):
+        add_fetch_result([(1, 999), (2, 123)])
+        add_fetch_result([])
+
+        results = datahog.alias.set_many(self.p, [
+            (123, 2, u'a'),
+            (124, 2, u'b'),
+            (123, 2, u'c', [])])
+
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], error.AliasInUse)
+        self.assertEqual(results[2], False)
+
+        h = lambda v: hmac.new(self.p.digestkey, v, hashlib.sha1).digest()
+
+        self.assertEqual(eventlog, [
+            TPC_BEGIN,
+            GET_CURSOR,
+            EXECUTE("""
+with staged (n, hash, ctx, base_id, flags) as (
+    values (%s, %s, %s, %s, %s), (%s, %s, %s, %s, %s), (%s, %s, %s, %s, %s)
+),
+existing as (
+    select s.n, l.base_id
+    from staged s
+    join alias_lookup l
+    on
+        l.time_removed is null
+        and l.hash=s.hash
+        and l.ctx=s.ctx
+),
+winners as (
+    select distinct on (s.hash, s.ctx) s.n, s.hash, s.ctx, s.base_id
+    from staged s
+    where s.n not in (select n from existing)
+    order by s.hash, s.ctx, s.n
+),
+insertquery as (
+    insert into alias_lookup (hash, ctx, base_id, flags)
+    select s.hash, s.ctx, s.base_id, s.flags
+    from staged s
+    where s.n in (select n from winners)
+    returning 1
+)
+select s.n, coalesce(e.base_id, w.base_id)
+from staged s
+left join existing e on e.n=s.n
+left join winners w on w.hash=s.hash and w.ctx=s.ctx
+where s.n not in (select n from winners)
+""", (0, h('a'), 2, 123, 0, 1, h('b'), 2, 124, 0, 2, h('c'), 2, 123, 0)),
+            FETCH_ALL,
+            TPC_PREPARE,
+            RESET,
+            TPC_BEGIN,
+            GET_CURSOR,
+            EXECUTE("""
+with incoming (n, base_id, ctx, value, flags) as (
+    values (%s, %s, %s, %s, %s)
+),
+missing as (
+    select s.n
+    from incoming s
+    where
+        s.ctx=%s
+        and not exists (
+            select 1
+            from node b
+            where
+                b.time_removed is null
+                and b.id=s.base_id
+                and b.ctx=%s
+        )
+),
+staged as (
+    select s.n, s.base_id, s.value, s.flags
+    from incoming s
+    where
+        s.ctx=%s
+        and s.n not in (select n from missing)
+),
+insertquery as (
+    insert into alias (base_id, ctx, value, flags, pos)
+    select staged.base_id, %s, staged.value, staged.flags, row_number() over (
+        partition by staged.base_id
+        order by staged.n
+    ) + coalesce((
+        select pos
+        from alias t
+        where
+            t.time_removed is null
+            and t.base_id=staged.base_id
+            and t.ctx=%s
+        order by pos desc
+        limit 1
+    ), 0)
+    from staged
+    returning 1
+)
+select s.n, s.n in (select n from missing)
+from incoming s
+where
+    s.ctx=%s
+    and s.n not in (select n from staged)
+""", (0, 123, 2, u'a', 0, 2, 1, 2, 2, 2, 2)),
+            FETCH_ALL,
+            TPC_PREPARE,
+            RESET,
+            TPC_COMMIT,
+            TPC_COMMIT])
+
+    def test_set_many_missing_base(self):
+        # the first round finds 124 missing, so rolls back and goes again
+        add_fetch_result([])
+        add_fetch_result([(1, True)])
+        add_fetch_result([])
+        add_fetch_result([])
+
+        results = datahog.alias.set_many(self.p, [
+            (123, 2, u'a'),
+            (124, 2, u'b')])
+
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], error.NoObject)
+
+        # the alias writes are prepared too, and nothing is committed until
+        # the lookups and aliases have all been
+        self.assertEqual(
+                [e for e in eventlog if not isinstance(e, EXECUTE)], [
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_ROLLBACK, TPC_ROLLBACK,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_COMMIT, TPC_COMMIT])
+        self.assertEqual([e.args[:10] for e in eventlog
+                if isinstance(e, EXECUTE) and 'incoming' in e.pattern], [
+            (0, 123, 2, u'a', 0, 1, 124, 2, u'b', 0),
+            (0, 123, 2, u'a', 0, 2, 1, 2, 2, 2)])
+
+    def test_set_many_bad_context(self):
+        self.assertRaises(error.BadContext, datahog.alias.set_many, self.p,
+                [(123, 2, u'a'), (123, 1, u'b')])
+        self.assertEqual(eventlog, [])
+
     def test_lookup(self):
         add_fetch_result([(123, 0)])
 
@@ -238,6 +545,98 @@ where
             ROWCOUNT,
             COMMIT])
 
+    def test_lookup_concurrent_probes(self):
+        p = self.shard_pool(2, concurrent_lookups=True,
+                lookup_insertion_plans=[[(0, 1)], [(1, 1)]])
+        add_fetch_result([(123, 0)])
+        add_fetch_result([(124, 0)])
+
+        # both candidate shards are probed, the newest plan's shard wins
+        self.assertEqual(
+                datahog.alias.lookup(p, 'value', 2),
+                {'base_id': 124, 'ctx': 2, 'value': 'value', 'flags': set([])})
+
+        h = hmac.new(self.p.digestkey, 'value', hashlib.sha1).digest()
+        probe = EXECUTE("""
+select base_id, flags
+from alias_lookup
+where
+    time_removed is null
+    and hash=%s
+    and ctx=%s
+""", (h, 2))
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR, probe, ROWCOUNT, FETCH_ONE, COMMIT,
+            GET_CURSOR, probe, ROWCOUNT, FETCH_ONE, COMMIT])
+
+        self.assertEqual(len(p._conns[1]._data), 2)
+
+    def test_lookup_cached(self):
+        self.p.alias_cache = datahog.cache.LRUCache()
+        add_fetch_result([])
+
+        self.assertEqual(datahog.alias.lookup(self.p, 'value', 2), None)
+        self.assertEqual(len(eventlog), 4)
+
+        # the miss is cached
+        self.assertEqual(datahog.alias.lookup(self.p, 'value', 2), None)
+        self.assertEqual(len(eventlog), 4)
+
+        # and invalidated by a write
+        add_fetch_result([])
+        add_fetch_result([None])
+        self.assertEqual(datahog.alias.set(self.p, 123, 2, 'value'), True)
+        del eventlog[:]
+
+        add_fetch_result([(123, 0)])
+        result = datahog.alias.lookup(self.p, 'value', 2)
+        self.assertEqual(result,
+                {'base_id': 123, 'ctx': 2, 'value': 'value', 'flags': set([])})
+        self.assertEqual(len(eventlog), 5)
+
+        # hits hand out a fresh dict each time
+        result['flags'].add(1)
+        self.assertEqual(
+                datahog.alias.lookup(self.p, 'value', 2),
+                {'base_id': 123, 'ctx': 2, 'value': 'value', 'flags': set([])})
+        self.assertEqual(len(eventlog), 5)
+
+    def test_lookup_cache_writes_under_pool_lock(self):
+        held = []
+
+        class Lock(object):
+            def __enter__(self):
+                held.append(True)
+
+            def __exit__(self, *exc):
+                held.pop()
+
+        writes = []
+
+        class Cache(datahog.cache.LRUCache):
+            def set(self, key, value):
+                writes.append(('set', bool(held)))
+                super(Cache, self).set(key, value)
+
+            def delete(self, key):
+                writes.append(('delete', bool(held)))
+                super(Cache, self).delete(key)
+
+        self.p._lock = Lock()
+        self.p.alias_cache = Cache()
+        add_fetch_result([])
+        datahog.alias.lookup(self.p, 'value', 2)
+
+        add_fetch_result([])
+        add_fetch_result([None])
+        datahog.alias.set(self.p, 123, 2, 'value')
+
+        # the epoch check and the write back, and the epoch bump and the
+        # invalidation, each happen as one step under the pool's lock
+        self.assertEqual(writes, [('set', True), ('delete', True)])
+        self.assertEqual(self.p.alias_cache_epoch, 1)
+
     def test_list(self):
         add_fetch_result([(0, 'val1', 0), (0, 'val2', 1), (0, 'val3', 2)])
 
@@ -268,6 +667,64 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_iter(self):
+        add_fetch_result([(0, 'val1'), (0, 'val2'), (0, 'val3')])
+
+        self.assertEqual(
+                list(datahog.alias.iter(self.p, 123, 2, itersize=2)),
+                [
+                    {'base_id': 123, 'ctx': 2, 'value': 'val1',
+                        'flags': set([])},
+                    {'base_id': 123, 'ctx': 2, 'value': 'val2',
+                        'flags': set([])},
+                    {'base_id': 123, 'ctx': 2, 'value': 'val3',
+                        'flags': set([])},
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_NAMED_CURSOR,
+            EXECUTE("""
+select flags, value
+from alias
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (123, 2, 0)),
+            FETCH_MANY,
+            FETCH_MANY,
+            COMMIT])
+
+    def test_iter_closed_early(self):
+        add_fetch_result([(0, 'val1'), (0, 'val2'), (0, 'val3')])
+
+        aliases = datahog.alias.iter(self.p, 123, 2, itersize=2)
+        self.assertEqual(aliases.next()['value'], 'val1')
+        aliases.close()
+
+        self.assertEqual(eventlog[-2:], [FETCH_MANY, ROLLBACK])
+
+    def test_iter_failed_rollback_returns_conn(self):
+        add_fetch_result([(0, 'val1'), (0, 'val2'), (0, 'val3')])
+
+        def rollback(self):
+            raise psycopg2.OperationalError()
+
+        aliases = datahog.alias.iter(self.p, 123, 2, itersize=2)
+        aliases.next()
+        orig = pgmock.FakePGConn.rollback
+        pgmock.FakePGConn.rollback = rollback
+        try:
+            self.assertRaises(psycopg2.OperationalError, aliases.close)
+        finally:
+            pgmock.FakePGConn.rollback = orig
+
+        # the connection is reset and goes back to the pool all the same
+        self.assertEqual(eventlog[-1], RESET)
+        self.assertEqual(self.p._in_use[0], 0)
+
     def test_list_empty(self):
         add_fetch_result([])
 
@@ -675,6 +1132,102 @@ select exists (select 1 from move)
             FETCH_ONE,
             COMMIT])
 
+    def test_shift_sparse(self):
+        datahog.set_context(3, datahog.ALIAS, {
+            'base_ctx': 1, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([(1,)])
+        add_fetch_result([(131072,), (196608,)])
+        add_fetch_result([None])
+
+        self.assertEqual(
+                datahog.alias.shift(self.p, 123, 3, 'b', 2),
+                True)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select 1
+from alias
+where
+    time_removed is null
+    and base_id=%s and ctx=%s
+    and value=%s
+for update
+""", (123, 3, 'b')),
+            ROWCOUNT,
+            EXECUTE("""
+select pos
+from alias
+where
+    time_removed is null
+    and base_id=%s and ctx=%s and not (value=%s)
+order by pos asc
+offset %s
+limit 2
+""", (123, 3, 'b', 1)),
+            FETCH_ALL,
+            EXECUTE("""
+update alias
+set pos=%s
+where
+    time_removed is null
+    and base_id=%s and ctx=%s
+    and value=%s
+""", (163840, 123, 3, 'b')),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_shift_sparse_missing(self):
+        datahog.set_context(3, datahog.ALIAS, {
+            'base_ctx': 1, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.alias.shift(self.p, 123, 3, 'b', 2),
+                False)
+
+        # nothing else in the list is looked at or renumbered
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select 1
+from alias
+where
+    time_removed is null
+    and base_id=%s and ctx=%s
+    and value=%s
+for update
+""", (123, 3, 'b')),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_respace(self):
+        datahog.set_context(3, datahog.ALIAS, {
+            'base_ctx': 1, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([None, None, None])
+
+        self.assertEqual(datahog.alias.respace(self.p, 123, 3), 3)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+update alias t
+set pos=renumbered.n * 65536
+from (
+    select ctid, row_number() over (order by pos asc) as n
+    from alias
+    where
+        time_removed is null
+        and base_id=%s and ctx=%s
+) as renumbered
+where t.ctid=renumbered.ctid
+""", (123, 3)),
+            ROWCOUNT,
+            COMMIT])
+
+        self.assertRaises(error.BadContext,
+                datahog.alias.respace, self.p, 123, 2)
+
     def test_remove(self):
         add_fetch_result([(123, 0)])
         add_fetch_result([()])
@@ -740,6 +1293,35 @@ select 1 from removal
             COMMIT,
             TPC_COMMIT])
 
+    def test_remove_sparse(self):
+        datahog.set_context(3, datahog.ALIAS, {
+            'base_ctx': 1, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([(123, 0)])
+        add_fetch_result([()])
+        add_fetch_result([()])
+
+        self.assertEqual(
+                datahog.alias.remove(self.p, 123, 3, 'value'),
+                True)
+
+        h = hmac.new(self.p.digestkey, 'value', hashlib.sha1).digest()
+
+        self.assertEqual(eventlog[-6:], [
+            RESET,
+            GET_CURSOR,
+            EXECUTE("""
+update alias
+set time_removed=now()
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and value=%s
+""", (123, 3, 'value')),
+            ROWCOUNT,
+            COMMIT,
+            TPC_COMMIT])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,389 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import hashlib
+import hmac
+import os
+import sys
+import unittest
+
+import datahog
+from datahog import error
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+def _hex(value):
+    return hmac.new('digest key', value, hashlib.sha1).hexdigest()
+
+
+class BulkTests(base.TestCase):
+    def setUp(self):
+        super(BulkTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.PROPERTY,
+                {'base_ctx': 1, 'storage': datahog.storage.INT})
+        datahog.set_context(3, datahog.ALIAS, {'base_ctx': 1})
+        datahog.set_context(4, datahog.NAME,
+                {'base_ctx': 1, 'search': datahog.search.PREFIX})
+
+    def test_load_properties(self):
+        add_fetch_result([])
+        add_fetch_result([(1,)])
+
+        conflicts = datahog.bulk.load_properties(self.p, [
+            (1234, 2, 10),
+            (1235, 2, 11, []),
+            (1236, 5, 12),
+            (1237, 2, 'thirteen')])
+
+        self.assertEqual([(i, type(exc)) for i, exc in conflicts], [
+            (1, error.NoObject),
+            (2, error.BadContext),
+            (3, error.StorageClassError)])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+create temporary table bulk_property (n int not null, base_id bigint,
+    ctx smallint, num bigint, value bytea, flags smallint)
+on commit drop
+""", ()),
+            COPY('bulk_property', ('n', 'base_id', 'ctx', 'num', 'value',
+                'flags'), '0\t1234\t2\t10\t\\N\t0\n1\t1235\t2\t11\t\\N\t0\n'),
+            EXECUTE("""
+with missing as (
+    select s.n
+    from bulk_property s
+    where
+        s.ctx=%s
+        and not exists (
+            select 1
+            from node b
+            where
+                b.time_removed is null
+                and b.id=s.base_id
+                and b.ctx=%s
+        )
+),
+staged as (
+    select distinct on (s.base_id) s.base_id, s.num, s.value, s.flags
+    from bulk_property s
+    where
+        s.ctx=%s
+        and s.n not in (select n from missing)
+    order by s.base_id, s.n desc
+),
+updatequery as (
+    update property p
+    set num=staged.num, value=staged.value
+    from staged
+    where
+        p.time_removed is null
+        and p.base_id=staged.base_id
+        and p.ctx=%s
+    returning p.base_id
+),
+insertquery as (
+    insert into property (base_id, ctx, num, value, flags)
+    select staged.base_id, %s, staged.num, staged.value, staged.flags
+    from staged
+    where staged.base_id not in (select base_id from updatequery)
+    returning 1
+)
+select n
+from missing
+""", (2, 1, 2, 2, 2)),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_load_properties_chunks(self):
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(2,)])
+
+        conflicts = datahog.bulk.load_properties(self.p,
+                iter([(1234, 2, 10), (1235, 2, 11), (1236, 2, 12)]),
+                chunksize=2)
+
+        self.assertEqual([(i, type(exc)) for i, exc in conflicts],
+                [(2, error.NoObject)])
+        self.assertEqual([e.data for e in eventlog if isinstance(e, COPY)],
+                ['0\t1234\t2\t10\t\\N\t0\n1\t1235\t2\t11\t\\N\t0\n',
+                '2\t1236\t2\t12\t\\N\t0\n'])
+
+    def test_load_aliases(self):
+        add_fetch_result([])
+        add_fetch_result([(1, 999)])
+        add_fetch_result([])
+        add_fetch_result([(2, True)])
+        add_fetch_result([])
+
+        conflicts = datahog.bulk.load_aliases(self.p, [
+            (123, 3, u'a'),
+            (124, 3, u'b'),
+            (125, 3, u'c\tc')])
+
+        self.assertEqual([(i, type(exc)) for i, exc in conflicts], [
+            (1, error.AliasInUse),
+            (2, error.NoObject)])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+create temporary table bulk_alias_lookup (n int not null, hash bytea,
+    ctx smallint, base_id bigint, flags smallint)
+on commit drop
+""", ()),
+            COPY('bulk_alias_lookup', ('n', 'hash', 'ctx', 'base_id', 'flags'),
+                '0\t\\\\x%s\t3\t123\t0\n1\t\\\\x%s\t3\t124\t0\n'
+                '2\t\\\\x%s\t3\t125\t0\n' % (
+                    _hex('a'), _hex('b'), _hex('c\tc'))),
+            EXECUTE("""
+with existing as (
+    select s.n, l.base_id
+    from bulk_alias_lookup s
+    join alias_lookup l
+    on
+        l.time_removed is null
+        and l.hash=s.hash
+        and l.ctx=s.ctx
+),
+winners as (
+    select distinct on (s.hash, s.ctx) s.n, s.hash, s.ctx, s.base_id
+    from bulk_alias_lookup s
+    where s.n not in (select n from existing)
+    order by s.hash, s.ctx, s.n
+),
+insertquery as (
+    insert into alias_lookup (hash, ctx, base_id, flags)
+    select s.hash, s.ctx, s.base_id, s.flags
+    from bulk_alias_lookup s
+    where s.n in (select n from winners)
+    returning 1
+)
+select s.n, coalesce(e.base_id, w.base_id)
+from bulk_alias_lookup s
+left join existing e on e.n=s.n
+left join winners w on w.hash=s.hash and w.ctx=s.ctx
+where s.n not in (select n from winners)
+""", ()),
+            FETCH_ALL,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+create temporary table bulk_alias (n int not null, base_id bigint,
+    ctx smallint, value varchar(255), flags smallint)
+on commit drop
+""", ()),
+            COPY('bulk_alias', ('n', 'base_id', 'ctx', 'value', 'flags'),
+                '0\t123\t3\ta\t0\n2\t125\t3\tc\\tc\t0\n'),
+            EXECUTE("""
+with missing as (
+    select s.n
+    from bulk_alias s
+    where
+        s.ctx=%s
+        and not exists (
+            select 1
+            from node b
+            where
+                b.time_removed is null
+                and b.id=s.base_id
+                and b.ctx=%s
+        )
+),
+staged as (
+    select distinct on (s.base_id, s.value) s.n, s.base_id, s.value, s.flags
+    from bulk_alias s
+    where
+        s.ctx=%s
+        and s.n not in (select n from missing)
+        and not exists (
+            select 1
+            from alias t
+            where
+                t.time_removed is null
+                and t.base_id=s.base_id
+                and t.ctx=s.ctx
+                and t.value=s.value
+        )
+    order by s.base_id, s.value, s.n
+),
+insertquery as (
+    insert into alias (base_id, ctx, value, flags, pos)
+    select staged.base_id, %s, staged.value, staged.flags, row_number() over (
+        partition by staged.base_id
+        order by staged.n
+    ) + coalesce((
+        select pos
+        from alias t
+        where
+            t.time_removed is null
+            and t.base_id=staged.base_id
+            and t.ctx=%s
+        order by pos desc
+        limit 1
+    ), 0)
+    from staged
+    returning 1
+)
+select s.n, s.n in (select n from missing)
+from bulk_alias s
+where
+    s.ctx=%s
+    and s.n not in (select n from staged)
+""", (3, 1, 3, 3, 3, 3)),
+            FETCH_ALL,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+update alias_lookup
+set time_removed=now()
+where
+    time_removed is null
+    and (hash, ctx) in ((%s, %s))
+returning hash, ctx
+""", (hmac.new('digest key', 'c\tc', hashlib.sha1).digest(), 3)),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_load_aliases_rerun(self):
+        # a's lookup was claimed for the same base_id by an earlier load
+        # that failed before writing the alias
+        add_fetch_result([])
+        add_fetch_result([(0, 123)])
+        add_fetch_result([])
+        add_fetch_result([])
+
+        self.assertEqual(datahog.bulk.load_aliases(self.p, [
+            (123, 3, u'a'),
+            (124, 3, u'b')]), [])
+
+        self.assertEqual(eventlog[-4], COPY('bulk_alias',
+            ('n', 'base_id', 'ctx', 'value', 'flags'),
+            '0\t123\t3\ta\t0\n1\t124\t3\tb\t0\n'))
+        self.assertEqual(eventlog[-2:], [FETCH_ALL, COMMIT])
+
+    def test_load_names(self):
+        add_fetch_result([])
+        add_fetch_result([(1, False), (2, True)])
+
+        conflicts = datahog.bulk.load_names(self.p, [
+            (123, 4, u'foo'),
+            (124, 4, u'bar'),
+            (125, 4, u'baz')])
+
+        self.assertEqual([(i, type(exc)) for i, exc in conflicts],
+                [(2, error.NoObject)])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+create temporary table bulk_name (n int not null, base_id bigint,
+    ctx smallint, value varchar(255), flags smallint)
+on commit drop
+""", ()),
+            COPY('bulk_name', ('n', 'base_id', 'ctx', 'value', 'flags'),
+                '0\t123\t4\tfoo\t0\n1\t124\t4\tbar\t0\n2\t125\t4\tbaz\t0\n'),
+            EXECUTE("""
+with missing as (
+    select s.n
+    from bulk_name s
+    where
+        s.ctx=%s
+        and not exists (
+            select 1
+            from node b
+            where
+                b.time_removed is null
+                and b.id=s.base_id
+                and b.ctx=%s
+        )
+),
+staged as (
+    select distinct on (s.base_id, s.value) s.n, s.base_id, s.value, s.flags
+    from bulk_name s
+    where
+        s.ctx=%s
+        and s.n not in (select n from missing)
+        and not exists (
+            select 1
+            from name t
+            where
+                t.time_removed is null
+                and t.base_id=s.base_id
+                and t.ctx=s.ctx
+                and t.value=s.value
+        )
+    order by s.base_id, s.value, s.n
+),
+insertquery as (
+    insert into name (base_id, ctx, value, flags, pos)
+    select staged.base_id, %s, staged.value, staged.flags, row_number() over (
+        partition by staged.base_id
+        order by staged.n
+    ) + coalesce((
+        select pos
+        from name t
+        where
+            t.time_removed is null
+            and t.base_id=staged.base_id
+            and t.ctx=%s
+        order by pos desc
+        limit 1
+    ), 0)
+    from staged
+    returning 1
+)
+select s.n, s.n in (select n from missing)
+from bulk_name s
+where
+    s.ctx=%s
+    and s.n not in (select n from staged)
+""", (4, 1, 4, 4, 4, 4)),
+            FETCH_ALL,
+            COMMIT,
+            GET_CURSOR,
+            COPY('prefix_lookup', ('value', 'flags', 'ctx', 'base_id'),
+                'foo\t0\t4\t123\n'),
+            EXECUTE("""
+create temporary table bulk_prefix_lookup (n int not null,
+    value varchar(255), flags smallint, ctx smallint, base_id bigint)
+on commit drop
+""", ()),
+            COPY('bulk_prefix_lookup',
+                ('n', 'value', 'flags', 'ctx', 'base_id'),
+                '0\tbar\t0\t4\t124\n'),
+            EXECUTE("""
+insert into prefix_lookup (value, flags, ctx, base_id)
+select distinct on (s.ctx, s.base_id, s.value)
+    s.value, s.flags, s.ctx, s.base_id
+from bulk_prefix_lookup s
+where not exists (
+    select 1
+    from prefix_lookup l
+    where
+        l.time_removed is null
+        and l.ctx=s.ctx
+        and l.base_id=s.base_id
+        and l.value=s.value
+)
+order by s.ctx, s.base_id, s.value, s.n
+""", ()),
+            COMMIT])
+
+    def test_readonly(self):
+        self.p.readonly = True
+        try:
+            self.assertRaises(error.ReadOnly,
+                    datahog.bulk.load_properties, self.p, [(1234, 2, 10)])
+        finally:
+            self.p.readonly = False
+
+
+if __name__ == '__main__':
+    unittest.main()
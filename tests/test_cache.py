@@ -0,0 +1,74 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import threading
+import time
+import unittest
+
+from datahog import cache
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_get_set_delete(self):
+        c = cache.LRUCache()
+        self.assertEqual(c.get('a'), None)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), 1)
+        c.delete('a')
+        self.assertEqual(c.get('a', 'missing'), 'missing')
+
+    def test_lru_eviction(self):
+        c = cache.LRUCache(2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b', 'missing'), 'missing')
+        self.assertEqual(c.get('c'), 3)
+
+    def test_ttl(self):
+        c = cache.LRUCache(ttl=0.01)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(c.get('a', 'missing'), 'missing')
+
+    def test_negative_caching(self):
+        c = cache.LRUCache(ttl=60)
+        c.set('a', None)
+        self.assertEqual(c.get('a', 'missing'), None)
+
+        c = cache.LRUCache(ttl=60, negative_ttl=0)
+        c.set('a', None)
+        self.assertEqual(c.get('a', 'missing'), 'missing')
+
+    def test_threads(self):
+        c = cache.LRUCache(8)
+        errors = []
+
+        def churn(n):
+            try:
+                for i in xrange(2000):
+                    key = (n + i) % 16
+                    c.set(key, i)
+                    c.get((key + 1) % 16)
+                    if not i % 7:
+                        c.delete(key)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=churn, args=(n,))
+                for n in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(len(c) <= 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -382,6 +382,33 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_iter(self):
+        add_fetch_result([(0, 'foo'), (0, 'bar')])
+
+        self.assertEqual(
+                list(datahog.name.iter(self.p, 123, 2)),
+                [
+                    {'base_id': 123, 'ctx': 2, 'flags': set([]),
+                        'value': 'foo'},
+                    {'base_id': 123, 'ctx': 2, 'flags': set([]),
+                        'value': 'bar'},
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_NAMED_CURSOR,
+            EXECUTE("""
+select flags, value
+from name
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (123, 2, 0)),
+            FETCH_MANY,
+            COMMIT])
+
     def test_add_flags_prefix(self):
         datahog.set_flag(1, 3)
         datahog.set_flag(2, 3)
@@ -1,5 +1,7 @@
 # vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
 
+import hashlib
+import hmac
 import os
 import sys
 import unittest
@@ -108,6 +110,142 @@ returning 1
             ROWCOUNT,
             COMMIT])
 
+    def test_create_sparse_at_index_without_room(self):
+        datahog.set_context(3, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT,
+            'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([(1234,)])
+        add_fetch_result([(1,), (65537,)])
+        add_fetch_result([])
+        add_fetch_result([(1,)])
+        self.assertEqual(
+                datahog.node.create(self.p, 3, 12, 123, 0),
+                {'id': 1234, 'ctx': 3, 'value': 12, 'flags': set()})
+
+        self.assertEqual(eventlog[4:], [
+            EXECUTE("""
+select pos
+from edge
+where
+    time_removed is null
+    and base_id=%s and ctx=%s
+order by pos asc
+offset %s
+limit 2
+""", (123, 3, 0)),
+            FETCH_ALL,
+            EXECUTE("""
+update edge
+set pos=pos + 65536
+where
+    time_removed is null
+    and base_id=%s and ctx=%s
+    and pos >= %s
+""", (123, 3, 1)),
+            EXECUTE("""
+insert into edge (base_id, ctx, child_id, pos)
+select %s, %s, %s, %s
+where true
+""", (123, 3, 1234, 32768)),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_create_many(self):
+        # ids don't come back in the order of the values
+        add_fetch_result([(1236, 1), (1234, 2), (1235, 0)])
+        add_fetch_result([])
+        self.assertEqual(
+            datahog.node.create_many(self.p, 2, [12, 13, 14], 123),
+            [{'id': 1235, 'ctx': 2, 'value': 12, 'flags': set()},
+            {'id': 1236, 'ctx': 2, 'value': 13, 'flags': set()},
+            {'id': 1234, 'ctx': 2, 'value': 14, 'flags': set()}])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with newnodes (id, v, n) as (
+    select nextval('node_ids'), v, n
+    from (values (%s::bigint, %s),(%s::bigint, %s),(%s::bigint, %s))
+        as newvalues (v, n)
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=%s
+            and ctx=%s
+    )
+), insertion as (
+    insert into node (id, ctx, num, flags)
+    select id, %s, v, %s
+    from newnodes
+)
+select id, n
+from newnodes
+""", (12, 0, 13, 1, 14, 2, 123, 1, 2, 0)),
+            FETCH_ALL,
+            EXECUTE("""
+insert into edge (base_id, ctx, child_id, pos)
+select %s, %s, newedges.child_id, newedges.n + coalesce((
+    select pos
+    from edge
+    where
+        time_removed is null
+        and base_id=%s
+        and ctx=%s
+    order by pos desc
+    limit 1
+), 0)
+from (values (%s, %s),(%s, %s),(%s, %s)) as newedges (child_id, n)
+""", (123, 2, 123, 2, 1235, 1, 1236, 2, 1234, 3)),
+            ROWCOUNT,
+            COMMIT])
+
+    def test_create_many_roots_on_one_shard(self):
+        datahog.set_context(3, datahog.NODE, {
+            'storage': datahog.storage.INT})
+        p = self.shard_pool(3)
+        add_fetch_result([(1234, 0), (1235, 1), (1236, 2)])
+
+        self.assertEqual(
+                [node['id'] for node in
+                    datahog.node.create_many(p, 3, [12, 13, 14])],
+                [1234, 1235, 1236])
+
+        # one statement in one transaction, rather than one per shard
+        self.assertEqual(eventlog.count(GET_CURSOR), 1)
+        self.assertEqual(eventlog[-2:], [FETCH_ALL, COMMIT])
+
+    def test_create_many_missing_parent(self):
+        add_fetch_result([])
+        self.assertRaises(error.NoObject,
+                datahog.node.create_many, self.p, 2, [12, 13], 123)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with newnodes (id, v, n) as (
+    select nextval('node_ids'), v, n
+    from (values (%s::bigint, %s),(%s::bigint, %s)) as newvalues (v, n)
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=%s
+            and ctx=%s
+    )
+), insertion as (
+    insert into node (id, ctx, num, flags)
+    select id, %s, v, %s
+    from newnodes
+)
+select id, n
+from newnodes
+""", (12, 0, 13, 1, 123, 1, 2, 0)),
+            FETCH_ALL,
+            ROLLBACK])
+
     def test_get(self):
         datahog.set_flag(1, 2)
         datahog.set_flag(2, 2)
@@ -165,6 +303,44 @@ where
             FETCH_ALL,
             COMMIT])
 
+    def test_batch_get_multiple_shards(self):
+        datahog.set_flag(1, 2)
+        p = self.shard_pool(2)
+        other = (1 << 56) + 1234
+        add_fetch_result([(1234, 2, 0, 3478, None)])
+        add_fetch_result([(other, 2, 1, 3782, None)])
+
+        self.assertEqual(
+                datahog.node.batch_get(p, [(other, 2), (1235, 2), (1234, 2)]),
+                [{'id': other, 'ctx': 2, 'flags': set([1]), 'value': 3782},
+                None,
+                {'id': 1234, 'ctx': 2, 'flags': set(), 'value': 3478}])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select id, ctx, flags, num, value
+from node
+where
+    time_removed is null
+    and (id, ctx) in ((%s,%s), (%s,%s))
+""", (1235, 2, 1234, 2)),
+            FETCH_ALL,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+select id, ctx, flags, num, value
+from node
+where
+    time_removed is null
+    and (id, ctx) in ((%s,%s))
+""", (other, 2)),
+            FETCH_ALL,
+            COMMIT])
+
+        self.assertEqual(len(p._conns[0]._data), 2)
+        self.assertEqual(len(p._conns[1]._data), 2)
+
     def test_child_of_success(self):
         add_fetch_result([(1,)])
 
@@ -233,6 +409,28 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_iter_children(self):
+        add_fetch_result([(1234,), (1235,), (1236,)])
+
+        self.assertEqual(
+                list(datahog.node.iter_children(self.p, 1233, 2, start=4)),
+                [1234, 1235, 1236])
+
+        self.assertEqual(eventlog, [
+            GET_NAMED_CURSOR,
+            EXECUTE("""
+select child_id
+from edge
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and pos >= %s
+order by pos asc
+""", (1233, 2, 4)),
+            FETCH_MANY,
+            COMMIT])
+
     def test_get_children(self):
         add_fetch_result([
             (1234, 2, 0),
@@ -279,6 +477,91 @@ where
             FETCH_ALL,
             COMMIT])
 
+    def test_list_children_many(self):
+        add_fetch_result([
+            (123, 2, 1234, 1),
+            (123, 2, 1235, 2),
+            (124, 2, 1236, 4)])
+
+        self.assertEqual(
+                datahog.node.list_children_many(self.p,
+                    [(124, 2), (125, 2), (123, 2)], 2),
+                [([1236], 5), ([], 0), ([1234, 1235], 3)])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with window_query as (
+    select base_id, ctx, child_id, pos, row_number() over (
+        partition by base_id, ctx
+        order by pos
+    ) as r
+    from edge
+    where
+        time_removed is null
+        and (base_id, ctx) in ((%s, %s),(%s, %s),(%s, %s))
+)
+select w.base_id, w.ctx, w.child_id, w.pos
+from window_query w
+where w.r <= %s
+order by w.base_id, w.ctx, w.pos
+""", (124, 2, 125, 2, 123, 2, 2)),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_list_children_many_fetch_nodes(self):
+        datahog.set_flag(1, 2)
+        p = self.shard_pool(2)
+        moved = (1 << 56) + 1236
+        add_fetch_result([
+            (123, 2, 1234, 1, 1, 10, None),
+            (123, 2, moved, 2, None, None, None),
+            (123, 2, 1235, 3, None, None, None)])
+        add_fetch_result([(moved, 2, 0, 11, None)])
+
+        self.assertEqual(
+                datahog.node.list_children_many(p, [(123, 2)],
+                    fetch_nodes=True),
+                [([{'id': 1234, 'ctx': 2, 'flags': set([1]), 'value': 10},
+                    {'id': moved, 'ctx': 2, 'flags': set(), 'value': 11}],
+                    4)])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with window_query as (
+    select base_id, ctx, child_id, pos, row_number() over (
+        partition by base_id, ctx
+        order by pos
+    ) as r
+    from edge
+    where
+        time_removed is null
+        and (base_id, ctx) in ((%s, %s))
+)
+select w.base_id, w.ctx, w.child_id, w.pos, n.flags, n.num, n.value
+from window_query w
+left join node n
+on
+    n.time_removed is null
+    and n.id=w.child_id
+    and n.ctx=w.ctx
+where w.r <= %s
+order by w.base_id, w.ctx, w.pos
+""", (123, 2, 100)),
+            FETCH_ALL,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+select id, ctx, flags, num, value
+from node
+where
+    time_removed is null
+    and (id, ctx) in ((%s,%s))
+""", (moved, 2)),
+            FETCH_ALL,
+            COMMIT])
+
     def test_update_success(self):
         add_fetch_result([None]) # for rowcount
 
@@ -941,6 +1224,273 @@ returning child_id
             TPC_COMMIT,
             TPC_COMMIT])
 
+    def test_remove_one_phase_local(self):
+        self.p.one_phase_local = True
+        id = 1234
+        ctx = 2
+        base_id = 123
+
+        add_fetch_result([None])
+        add_fetch_result([(id,)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.node.remove(self.p, id, ctx, base_id),
+                True)
+
+        # the edge and the node come off in one ordinary transaction
+        self.assertNotIn(TPC_BEGIN, eventlog)
+        self.assertEqual(eventlog.count(GET_CURSOR), 2)
+        self.assertEqual(eventlog[-2:], [FETCH_ALL, COMMIT])
+
+    def test_remove_one_phase_local_cascade(self):
+        p = self.shard_pool(2, one_phase_local=True)
+        datahog.set_context(3, datahog.RELATIONSHIP,
+                {'base_ctx': 2, 'rel_ctx': 2})
+
+        id = 1234
+        rel_id = (1 << 56) + 5
+
+        add_fetch_result([None])
+        add_fetch_result([(id,)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(id, 3, True, rel_id)])
+        add_fetch_result([])
+        for i in xrange(10):
+            add_fetch_result([])
+
+        self.assertEqual(datahog.node.remove(p, id, 2, 123), True)
+
+        # shard 0 commits first, and decides for the prepared shard 1
+        self.assertEqual(eventlog.count(TPC_BEGIN), 1)
+        self.assertEqual(eventlog[-2:], [COMMIT, TPC_COMMIT])
+        self.assertEqual([len(p._conns[s]._data) for s in xrange(2)],
+                [2, 2])
+
+    def test_remove_cascades_in_waves(self):
+        p = self.shard_pool(3)
+        datahog.set_context(3, datahog.RELATIONSHIP,
+                {'base_ctx': 2, 'rel_ctx': 2})
+
+        id = 1234
+        rel_id = (1 << 56) + 5
+        child_id = (2 << 56) + 6
+
+        add_fetch_result([None])
+        add_fetch_result([(id,)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(id, 3, True, rel_id)])
+        add_fetch_result([(child_id,)])
+        for i in xrange(10):
+            add_fetch_result([])
+
+        self.assertEqual(datahog.node.remove(p, id, 2, 123), True)
+
+        # the edge, then shard 0, then shards 1 and 2 together
+        self.assertEqual(eventlog.count(TPC_BEGIN), 4)
+        self.assertEqual(eventlog.count(TPC_PREPARE), 4)
+        self.assertEqual(eventlog.count(TPC_COMMIT), 4)
+        self.assertEqual(eventlog[-4:], [TPC_COMMIT] * 4)
+        self.assertEqual([len(p._conns[s]._data) for s in xrange(3)],
+                [2, 2, 2])
+
+    def test_remove_cascade_prunes_lookup_shards(self):
+        p = self.shard_pool(3, lookup_insertion_plans=[[(1, 1)], [(2, 1)]])
+        digest = hmac.new(p.digestkey, 'value', hashlib.sha1).digest()
+
+        add_fetch_result([None])
+        add_fetch_result([(1234,)])
+        add_fetch_result([])
+        add_fetch_result([('value', 4)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(buffer(digest), 4)])
+        for i in xrange(5):
+            add_fetch_result([])
+
+        self.assertEqual(datahog.node.remove(p, 1234, 2, 123), True)
+
+        # the edge, then shard 0, then only the first of the alias lookup's
+        # two candidate shards, which finds it
+        self.assertEqual(eventlog.count(TPC_BEGIN), 3)
+        self.assertEqual(eventlog.count(TPC_COMMIT), 3)
+        self.assertEqual([len(p._conns[s]._data) for s in xrange(3)],
+                [2, 2, 2])
+
+    def test_remove_deferred(self):
+        id = 1234
+        ctx = 2
+        base_id = 123
+
+        add_fetch_result([None])
+        add_fetch_result([(id,)])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.node.remove(self.p, id, ctx, base_id, defer=True),
+                True)
+
+        self.assertEqual(eventlog[6:], [
+            TPC_BEGIN,
+            GET_CURSOR,
+            EXECUTE("""
+update node
+set time_removed=now()
+where
+    time_removed is null
+    and id in (%s)
+returning id
+""", (id,)),
+            FETCH_ALL,
+            EXECUTE("""
+insert into remove_queue (id)
+values (%s)
+""", (id,)),
+            TPC_PREPARE,
+            RESET,
+            TPC_COMMIT,
+            TPC_COMMIT])
+
+    def test_sweep(self):
+        add_fetch_result([(1234,)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(1235,)])
+        add_fetch_result([(1235,)])
+        add_fetch_result([])
+        add_fetch_result([(1,)])
+
+        self.assertEqual(datahog.node.sweep(self.p, 0, 100),
+                {'swept': 1, 'remaining': 1})
+
+        self.assertEqual(eventlog[:4], [
+            TPC_BEGIN,
+            GET_CURSOR,
+            EXECUTE("""
+delete from remove_queue
+where ctid in (
+    select ctid
+    from remove_queue
+    order by time_queued
+    limit %s
+    for update skip locked
+)
+returning id
+""", (100,)),
+            FETCH_ALL])
+        self.assertEqual(eventlog[-8:], [
+            EXECUTE("""
+update node
+set time_removed=now()
+where
+    time_removed is null
+    and id in (%s)
+returning id
+""", (1235,)),
+            FETCH_ALL,
+            EXECUTE("""
+insert into remove_queue (id)
+values (%s)
+""", (1235,)),
+            EXECUTE("""
+select count(*)
+from remove_queue
+""", ()),
+            FETCH_ONE,
+            TPC_PREPARE,
+            RESET,
+            TPC_COMMIT])
+
+    def test_sweep_limits_children(self):
+        add_fetch_result([(1234,)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(1235,), (1236,)])
+        add_fetch_result([])
+        add_fetch_result([(1235,), (1236,)])
+        add_fetch_result([])
+        add_fetch_result([(3,)])
+
+        self.assertEqual(datahog.node.sweep(self.p, 0, 2),
+                {'swept': 1, 'remaining': 3})
+
+        # the cap was reached, so 1234 goes back on the queue if it has
+        # children left
+        self.assertEqual(eventlog[12:16], [
+            EXECUTE("""
+update edge
+set time_removed=now()
+where ctid in (
+    select ctid
+    from edge
+    where
+        time_removed is null
+        and base_id in (%s)
+    limit %s
+    for update
+)
+returning child_id
+""", (1234, 2)),
+            FETCH_ALL,
+            EXECUTE("""
+insert into remove_queue (id)
+select distinct base_id
+from edge
+where
+    time_removed is null
+    and base_id in (%s)
+""", (1234,)),
+            EXECUTE("""
+update node
+set time_removed=now()
+where
+    time_removed is null
+    and id in (%s, %s)
+returning id
+""", (1235, 1236))])
+
+    def test_sweep_empty(self):
+        add_fetch_result([])
+
+        self.assertEqual(datahog.node.sweep(self.p, 0),
+                {'swept': 0, 'remaining': 0})
+        self.assertEqual(eventlog[-1], TPC_ROLLBACK)
+
+    def test_remove_positional_timeout(self):
+        # a timeout passed positionally, as before defer existed, mustn't
+        # turn into a deferred removal
+        id = 1234
+        add_fetch_result([None])
+        add_fetch_result([(id,)])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.node.remove(self.p, id, 2, 123, 5),
+                True)
+
+        self.assertNotIn(EXECUTE("""
+insert into remove_queue (id)
+values (%s)
+""", (id,)), eventlog)
+        self.assertEqual(eventlog[-2:], [TPC_COMMIT, TPC_COMMIT])
+
     def test_remove_failure(self):
         add_fetch_result([])
 
@@ -0,0 +1,627 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import bisect
+import copy
+import hashlib
+import os
+import sys
+import threading
+import time
+import unittest
+
+import psycopg2
+
+import datahog
+from datahog import pool as dbpool
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+import pgmock
+from pgmock import *
+
+
+def naive_route(plans, digest):
+    num = 0
+    for c in digest:
+        num = (num << 8) | ord(c)
+
+    route = []
+    for plan in plans[::-1]:
+        index = bisect.bisect_right(plan, (num % plan[-1][0], 999999999))
+        if plan[index][1] not in route:
+            route.append(plan[index][1])
+    return route
+
+
+class RoutingTests(unittest.TestCase):
+    def pool(self, plans):
+        conf = copy.deepcopy(base.TestCase.CONFIG)
+        conf['lookup_insertion_plans'] = plans
+        return dbpool.ConnectionPool(conf)
+
+    def check_routes(self, plans):
+        p = self.pool(copy.deepcopy(plans))
+        prepared = p._dbconf['lookup_insertion_plans']
+        for i in xrange(500):
+            digest = hashlib.sha1(str(i)).digest()
+            route = naive_route(prepared, digest)
+            self.assertEqual(list(p.shards_for_lookup_hash(digest)), route)
+            self.assertEqual(p.shard_for_alias_write(digest), route[0])
+        return p
+
+    def test_int_hash(self):
+        self.assertEqual(dbpool._int_hash('\x01\x00'), 256)
+        self.assertEqual(dbpool._int_hash('\xff' * 20), (1 << 160) - 1)
+
+    def test_compiled_table(self):
+        p = self.check_routes([
+            [(0, 1), (1, 1)],
+            [(0, 1), (1, 1), (2, 1)],
+            [(0, 2), (1, 1), (2, 3), (3, 1)]])
+        self.assertEqual(p._lookup_routes[0], 42)
+
+    def test_uncompiled_fallback(self):
+        p = self.check_routes([
+            [(0, 1009), (1, 1013)],
+            [(2, 1019), (3, 1021)]])
+        self.assertEqual(p._lookup_routes[0], None)
+
+    def test_prefix_routes(self):
+        p = self.pool([[(0, 1), (1, 1)], [(1, 1), (2, 1), (3, 1)]])
+        self.assertEqual(list(p.shards_for_lookup_prefix('a')), [2, 1])
+        self.assertEqual(list(p.shards_for_lookup_prefix('b')), [3, 0])
+        self.assertEqual(p.shard_for_prefix_write('b'), 3)
+
+
+class PreparedStatementTests(base.TestCase):
+    def setUp(self):
+        super(PreparedStatementTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+
+    def test_number_params(self):
+        self.assertEqual(
+                dbpool._number_params("a=%s and b like %s || '%%'"),
+                "a=$1 and b like $2 || '%'")
+
+    def test_prepare_once(self):
+        p = self.shard_pool(1, prepare_statements=True)
+        # the registry is per-connection, so make sure both calls get the same
+        p._conns[0]._data.pop()
+        add_fetch_result([]) # for the PREPARE
+        add_fetch_result([(0, 4781)])
+        add_fetch_result([(0, 4782)])
+
+        self.assertEqual(datahog.node.get(p, 34789, 2)['value'], 4781)
+        self.assertEqual(datahog.node.get(p, 34790, 2)['value'], 4782)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+prepare datahog_0 as
+select flags, num
+from node
+where
+    time_removed is null
+    and id=$1
+    and ctx=$2
+""", ()),
+            EXECUTE("execute datahog_0 (%s,%s)", (34789, 2)),
+            ROWCOUNT,
+            FETCH_ONE,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("execute datahog_0 (%s,%s)", (34790, 2)),
+            ROWCOUNT,
+            FETCH_ONE,
+            COMMIT])
+
+
+    def test_reprepare_after_tpc(self):
+        datahog.set_context(3, datahog.ALIAS, {'base_ctx': 1})
+        p = self.shard_pool(1, prepare_statements=True)
+        p._conns[0]._data.pop()
+        add_fetch_result([]) # for the PREPARE
+        add_fetch_result([(0, 4781)])
+        self.assertEqual(datahog.node.get(p, 34789, 2)['value'], 4781)
+
+        # the two-phase commit's reset discards the prepared statements
+        add_fetch_result([])
+        add_fetch_result([None])
+        self.assertTrue(datahog.alias.set(p, 123, 3, 'value'))
+        self.assertIn(RESET, eventlog)
+        self.assertEqual(p._conns[0]._data[-1].prepared, {})
+
+        del eventlog[:]
+        add_fetch_result([])
+        add_fetch_result([(0, 4782)])
+        self.assertEqual(datahog.node.get(p, 34790, 2)['value'], 4782)
+        self.assertEqual(eventlog[:3], [
+            GET_CURSOR,
+            EXECUTE("""
+prepare datahog_0 as
+select flags, num
+from node
+where
+    time_removed is null
+    and id=$1
+    and ctx=$2
+""", ()),
+            EXECUTE("execute datahog_0 (%s,%s)", (34790, 2))])
+
+class HealthCheckTests(base.TestCase):
+    def test_closed_conn_replaced(self):
+        p = self.shard_pool(1)
+        dead = p._conns[0]._data[-1]
+        dead.conn.close()
+
+        conn = p.get_by_shard(0, replace=False)
+        self.assertIsNot(conn, dead)
+        p.put(conn)
+        p._pause(1)
+
+        self.assertEqual(eventlog, [CONNECT])
+        self.assertEqual(len(p._conns[0]._data), 2)
+        self.assertNotIn(dead, p._conns[0]._data)
+
+    def test_closed_on_put_replaced(self):
+        p = self.shard_pool(1)
+        conn = p.get_by_shard(0, replace=False)
+        conn.conn.close()
+        p.put(conn)
+        p._pause(1)
+
+        self.assertEqual(eventlog, [CONNECT])
+        self.assertEqual(len(p._conns[0]._data), 2)
+        self.assertNotIn(conn, p._conns[0]._data)
+
+    def test_max_lifetime(self):
+        p = self.shard_pool(1, max_lifetime=60)
+        old = p._conns[0]._data[-1]
+        old.created -= 120
+
+        conn = p.get_by_shard(0, replace=False)
+        self.assertIsNot(conn, old)
+        self.assertTrue(old.closed)
+        p.put(conn)
+        p._pause(1)
+
+        self.assertEqual(eventlog, [CONNECT])
+
+    def test_check_idle(self):
+        p = self.shard_pool(1, check_idle=5)
+        idle = p._conns[0]._data[-1]
+        idle.last_used -= 10
+        add_fetch_result([(1,)])
+
+        conn = p.get_by_shard(0, replace=False)
+        self.assertIs(conn, idle)
+        p.put(conn)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("select 1", ()),
+            ROLLBACK])
+
+    def test_check_idle_failure(self):
+        p = self.shard_pool(1, check_idle=5)
+        idle = p._conns[0]._data[-1]
+        idle.last_used -= 10
+        query_fail(psycopg2.OperationalError)
+
+        conn = p.get_by_shard(0, replace=False)
+        self.assertIsNot(conn, idle)
+        p.put(conn)
+        p._pause(1)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE_FAILURE("select 1", ()),
+            CONNECT])
+        self.assertEqual(len(p._conns[0]._data), 2)
+
+
+class ElasticSizingTests(base.TestCase):
+    def elastic_pool(self, **extra):
+        conf = copy.deepcopy(self.CONFIG)
+        conf['shards'][0]['max'] = 3
+        conf.update(extra)
+        p = datahog.GreenhouseConnPool(conf)
+        p.start()
+        p.wait_ready()
+        reset()
+        return p
+
+    def test_grow_on_demand(self):
+        p = self.elastic_pool()
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(3)]
+
+        self.assertEqual(eventlog, [CONNECT])
+        stats = p.stats()[0]
+        self.assertEqual(
+                (stats['size'], stats['idle'], stats['in_use']), (3, 0, 3))
+        self.assertEqual((stats['checkouts'], stats['waits']), (3, 1))
+
+        # at max, so no more growing
+        self.assertRaises(datahog.error.Timeout,
+                p.get_by_shard, 0, False, 0.01)
+        stats = p.stats()[0]
+        self.assertEqual((stats['size'], stats['timeouts']), (3, 1))
+        self.assertEqual(eventlog, [CONNECT])
+
+        for conn in conns:
+            p.put(conn)
+        self.assertEqual(p.stats()[0]['idle'], 3)
+
+    def test_reap_idle(self):
+        p = self.elastic_pool(idle_timeout=60)
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(3)]
+        for conn in conns:
+            p.put(conn)
+            conn.last_used -= 120
+
+        # the most recently used comes out first, is reaped, and then the
+        # shard is back at its count
+        conn = p.get_by_shard(0, replace=False)
+        self.assertIs(conn, conns[1])
+        self.assertTrue(conns[2].closed)
+        stats = p.stats()[0]
+        self.assertEqual(
+                (stats['size'], stats['idle'], stats['in_use']), (2, 1, 1))
+        p.put(conn)
+
+    def test_sweep_idle(self):
+        p = self.elastic_pool(idle_timeout=60)
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(3)]
+        for conn in conns:
+            p.put(conn)
+        conns[0].last_used -= 120
+        conns[1].last_used -= 120
+
+        # only the oldest goes, then the shard is back at its count
+        p._sweep_idle()
+        self.assertTrue(conns[0].closed)
+        self.assertEqual(p._conns[0]._data, conns[1:])
+        stats = p.stats()[0]
+        self.assertEqual((stats['size'], stats['idle']), (2, 2))
+
+    def test_sweeper(self):
+        # a shard that sees no more checkouts still shrinks back
+        p = self.elastic_pool(idle_timeout=0.01)
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(3)]
+        for conn in conns:
+            p.put(conn)
+
+        p._pause(50)
+        self.assertEqual(p.stats()[0]['size'], 2)
+        self.assertTrue(conns[0].closed)
+
+    def test_checkout_most_recent(self):
+        p = self.elastic_pool()
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(3)]
+        for conn in conns:
+            p.put(conn)
+
+        conn = p.get_by_shard(0, replace=False)
+        self.assertIs(conn, conns[2])
+        p.put(conn)
+
+    def test_fixed_size_by_default(self):
+        self.p._grow(0)
+        self.assertEqual(self.p.stats()[0]['size'], 2)
+        self.assertEqual(eventlog, [])
+
+
+class ThreadedPoolTests(base.TestCase):
+    def threaded_pool(self, **extra):
+        conf = copy.deepcopy(self.CONFIG)
+        conf['shards'][0]['max'] = 4
+        conf.update(extra)
+        p = datahog.ThreadedConnPool(conf)
+        p.start()
+        self.assertTrue(p.wait_ready(5))
+        reset()
+        return p
+
+    def test_query(self):
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE,
+                {'base_ctx': 1, 'storage': datahog.storage.INT})
+        p = self.threaded_pool()
+        add_fetch_result([(0, 7)])
+
+        self.assertEqual(datahog.node.get(p, 1234, 2),
+                {'id': 1234, 'ctx': 2, 'value': 7, 'flags': set()})
+        self.assertEqual(eventlog[-1], COMMIT)
+        self.assertEqual(p.stats()[0]['idle'], 2)
+
+    def test_sweep_doesnt_grow(self):
+        p = self.threaded_pool(idle_timeout=60)
+        conns = [p.get_by_shard(0, replace=False, timeout=5)
+                for i in xrange(3)]
+        for conn in conns:
+            p.put(conn)
+        conns[0].last_used -= 120
+        got = []
+        threads = []
+        close = p._close
+
+        def closing(conn):
+            # check out while the sweep has the idle queue drained
+            t = threading.Thread(target=lambda: got.append(
+                p.get_by_shard(0, replace=False, timeout=5)))
+            threads.append(t)
+            t.start()
+            t.join(0.05)
+            close(conn)
+
+        p._close = closing
+        p._sweep_idle()
+        threads[0].join(5)
+
+        self.assertTrue(conns[0].closed)
+        self.assertEqual(len(got), 1)
+        stats = p.stats()[0]
+        self.assertEqual(
+                (stats['size'], stats['idle'], stats['in_use']), (2, 1, 1))
+        p.put(got[0])
+
+    def test_concurrent_checkouts(self):
+        p = self.threaded_pool()
+        errors = []
+
+        def worker():
+            try:
+                for i in xrange(200):
+                    conn = p.get_by_shard(0, replace=False, timeout=5)
+                    p.put(conn)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=worker) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        stats = p.stats()[0]
+        self.assertEqual((stats['checkouts'], stats['in_use']), (1600, 0))
+        self.assertEqual(stats['idle'], stats['size'])
+        self.assertTrue(2 <= stats['size'] <= 4)
+        self.assertEqual(p._out, {})
+
+    def test_timeout(self):
+        p = self.threaded_pool()
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(4)]
+        p._pause(50)
+
+        self.assertRaises(datahog.error.Timeout,
+                p.get_by_shard, 0, False, 0.01)
+
+        for conn in conns:
+            p.put(conn)
+        self.assertEqual(p.stats()[0]['timeouts'], 1)
+
+    def test_deadline_passes_before_fallback(self):
+        p = datahog.ThreadedConnPool(dict(copy.deepcopy(self.CONFIG),
+                max_staleness=5, shards=[dict(self.CONFIG['shards'][0],
+                    max=2, replicas=[{'host': 'r0'}])]))
+        p.start()
+        self.assertTrue(p.wait_ready(5))
+        conns = [p.get_by_shard(0, replace=False) for i in xrange(2)]
+
+        # the replica's lag check outlasts the timeout, then the fallback
+        # to the primary finds no idle connection there
+        def too_stale(slot, conn):
+            time.sleep(0.02)
+            return True
+        p._too_stale = too_stale
+
+        self.assertRaises(datahog.error.Timeout,
+                p.get_by_shard, 0, False, 0.01, True)
+
+        for conn in conns:
+            p.put(conn)
+
+
+class ForkTests(base.TestCase):
+    def setUp(self):
+        super(ForkTests, self).setUp()
+        self.getpid = os.getpid
+        self.pid = os.getpid()
+        self.pipes = []
+
+    def tearDown(self):
+        os.getpid = self.getpid
+        for r, w in self.pipes:
+            os.close(r)
+            os.close(w)
+        super(ForkTests, self).tearDown()
+
+    def give_sockets(self, conns):
+        # a pipe's write end stands in for each connection's socket
+        for conn in conns:
+            r, w = os.pipe()
+            self.pipes.append((r, w))
+            conn.conn.fileno = lambda w=w: w
+
+    def fork(self):
+        self.pid += 1
+        os.getpid = lambda: self.pid
+
+    def test_reconnect_after_fork(self):
+        p = self.shard_pool(1)
+        inherited = list(p._conns[0]._data)
+        self.give_sockets(inherited)
+        routes = p._lookup_routes
+
+        self.fork()
+        conn = p.get_by_shard(0, replace=False)
+
+        self.assertEqual(eventlog, [CONNECT, CONNECT])
+        self.assertTrue(all(c.closed for c in inherited))
+        self.assertNotIn(conn, inherited)
+        self.assertIs(p._lookup_routes, routes)
+        self.assertEqual(p.stats()[0]['checkouts'], 1)
+        p.put(conn)
+        self.assertEqual(len(p._conns[0]._data), 2)
+
+    def test_inherited_sockets_left_alone(self):
+        p = self.shard_pool(1)
+        self.give_sockets(p._conns[0]._data)
+
+        self.fork()
+        p.after_fork()
+
+        # our ends were swapped for /dev/null before closing, so nothing
+        # reaches the other side, not even the goodbye
+        for r, w in self.pipes:
+            self.assertEqual(os.read(r, 1), '')
+        self.assertEqual(dbpool._disowned, [])
+
+    def test_put_from_before_fork(self):
+        p = self.shard_pool(1)
+        self.give_sockets(p._conns[0]._data)
+        conn = p.get_by_shard(0, replace=False)
+
+        self.fork()
+        p.after_fork()
+        p.put(conn)
+
+        self.assertTrue(conn.closed)
+        self.assertEqual(p.stats()[0]['in_use'], 0)
+        p._pause(1)
+        self.assertEqual(len(p._conns[0]._data), 2)
+
+    def test_no_fork_no_reconnect(self):
+        conn = self.p.get_by_shard(0, replace=False)
+        self.p.put(conn)
+        self.assertEqual(eventlog, [])
+        self.assertFalse(conn.closed)
+
+
+class ReplicaTests(base.TestCase):
+    def setUp(self):
+        super(ReplicaTests, self).setUp()
+        datahog.set_context(1, datahog.NODE)
+        datahog.set_context(2, datahog.NODE, {
+            'base_ctx': 1, 'storage': datahog.storage.INT
+        })
+
+    def replica_pool(self, replicas, **extra):
+        conf = copy.deepcopy(self.CONFIG)
+        conf['shards'][0]['replicas'] = replicas
+        conf.update(extra)
+        p = datahog.GreenhouseConnPool(conf)
+        p.start()
+        p.wait_ready()
+        reset()
+        return p
+
+    def test_reads_go_to_replicas(self):
+        p = self.replica_pool([{'host': 'r0'}, {'host': 'r1', 'count': 1}])
+        stats = p.stats()
+        self.assertEqual((stats[(0, 0)]['size'], stats[(0, 1)]['size']),
+                (2, 1))
+
+        add_fetch_result([(0, 4781)])
+        self.assertEqual(datahog.node.get(p, 34789, 2)['value'], 4781)
+
+        stats = p.stats()
+        self.assertEqual(stats[0]['checkouts'], 0)
+        self.assertEqual(
+                stats[(0, 0)]['checkouts'] + stats[(0, 1)]['checkouts'], 1)
+
+    def test_writes_go_to_primary(self):
+        p = self.replica_pool([{'host': 'r0'}])
+        add_fetch_result([(1,)])
+
+        datahog.node.update(p, 34789, 2, 4781)
+
+        stats = p.stats()
+        self.assertEqual(stats[0]['checkouts'], 1)
+        self.assertEqual(stats[(0, 0)]['checkouts'], 0)
+
+    def test_least_outstanding(self):
+        p = self.replica_pool([{'host': 'r0'}, {'host': 'r1'}])
+        first = p.get_by_shard(0, replace=False, read=True)
+        second = p.get_by_shard(0, replace=False, read=True)
+
+        self.assertEqual(sorted([p._out[id(first)], p._out[id(second)]]),
+                [(0, 0), (0, 1)])
+
+        p.put(first)
+        p.put(second)
+
+    def test_stale_replica_falls_back(self):
+        p = self.replica_pool([{'host': 'r0'}], max_staleness=5)
+        add_fetch_result([(30,)])
+
+        conn = p.get_by_shard(0, replace=False, read=True)
+        self.assertEqual(p._out[id(conn)], 0)
+        p.put(conn)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE(LAG_QUERY, ()),
+            FETCH_ONE,
+            ROLLBACK])
+
+        # not rechecked for a while, meanwhile reads stay on the primary
+        conn = p.get_by_shard(0, replace=False, read=True)
+        self.assertEqual(p._out[id(conn)], 0)
+        p.put(conn)
+        self.assertEqual(len(eventlog), 4)
+
+    def test_failed_lag_check_rolls_back(self):
+        p = self.replica_pool([{'host': 'r0'}], max_staleness=5)
+        query_fail(psycopg2.OperationalError)
+
+        conn = p.get_by_shard(0, replace=False, read=True)
+        query_fail(None)
+        self.assertEqual(p._out[id(conn)], 0)
+        p.put(conn)
+
+        # the replica's aborted transaction doesn't leak back into the pool
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE_FAILURE(LAG_QUERY, ()),
+            ROLLBACK])
+        self.assertEqual(p.stats()[(0, 0)]['idle'], 2)
+
+    def test_lag_check_before_postgres_10(self):
+        p = self.replica_pool([{'host': 'r0'}], max_staleness=5)
+        pgmock.FakePGConn.server_version = 90600
+        self.addCleanup(setattr, pgmock.FakePGConn, 'server_version', 100000)
+        add_fetch_result([(0,)])
+
+        conn = p.get_by_shard(0, replace=False, read=True)
+        self.assertEqual(p._out[id(conn)], (0, 0))
+        p.put(conn)
+
+        self.assertEqual(eventlog[1], EXECUTE("""
+select case
+    when pg_last_xlog_receive_location() =
+        pg_last_xlog_replay_location() then 0
+    else coalesce(
+        extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+end
+""", ()))
+
+
+LAG_QUERY = """
+select case
+    when pg_last_wal_receive_lsn() =
+        pg_last_wal_replay_lsn() then 0
+    else coalesce(
+        extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+end
+"""
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -317,6 +317,52 @@ where
             FETCH_ALL,
             COMMIT])
 
+    def test_batch_get(self):
+        datahog.set_context(3, datahog.PROPERTY, {
+            'base_ctx': 1, 'storage': datahog.storage.STR})
+        datahog.set_flag(1, 3)
+
+        add_fetch_result([
+            (124, 3, None, "foobar", 1),
+            (123, 2, 10, None, 0)])
+
+        self.assertEqual(
+                datahog.prop.batch_get(self.p, [(123, 2), (123, 3), (124, 3)]),
+                [
+                    {'base_id': 123, 'ctx': 2, 'flags': set([]), 'value': 10},
+                    None,
+                    {'base_id': 124, 'ctx': 3, 'flags': set([1]),
+                        'value': 'foobar'}
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select base_id, ctx, num, value, flags
+from property
+where
+    time_removed is null
+    and (base_id, ctx) in ((%s, %s),(%s, %s),(%s, %s))
+""", (123, 2, 123, 3, 124, 3)),
+            FETCH_ALL,
+            COMMIT])
+
+    def test_batch_get_multiple_shards(self):
+        p = self.shard_pool(2)
+        other = (1 << 56) + 123
+        add_fetch_result([(123, 2, 10, None, 0)])
+        add_fetch_result([(other, 2, 11, None, 0)])
+
+        self.assertEqual(
+                datahog.prop.batch_get(p, [(other, 2), (123, 2)]),
+                [
+                    {'base_id': other, 'ctx': 2, 'flags': set(), 'value': 11},
+                    {'base_id': 123, 'ctx': 2, 'flags': set(), 'value': 10}
+                ])
+
+        self.assertEqual(len(p._conns[0]._data), 2)
+        self.assertEqual(len(p._conns[1]._data), 2)
+
     def test_increment(self):
         add_fetch_result([(10,)])
 
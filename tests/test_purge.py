@@ -0,0 +1,121 @@
+# vim: fileencoding=utf8:et:sw=4:ts=8:sts=4
+
+import datetime
+import os
+import sys
+import unittest
+
+import datahog
+from datahog import error
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import base
+from pgmock import *
+
+
+class PurgeTests(base.TestCase):
+    def test_purge_batches(self):
+        cutoff = datetime.datetime(2014, 1, 2)
+        first = datetime.datetime(2013, 12, 1)
+        last = datetime.datetime(2013, 12, 3)
+        add_fetch_result([(cutoff,)])
+        add_fetch_result([(2, first)])
+        add_fetch_result([(1, last)])
+
+        calls = []
+        self.assertEqual(
+                datahog.purge.run(self.p, 86400, tables=['property'],
+                    batchsize=2, pause=0,
+                    progress=lambda *args: calls.append(args)),
+                {(0, 'property'): 3})
+
+        self.assertEqual(calls, [(0, 'property', 2), (0, 'property', 3)])
+
+        # the second batch picks up the index walk where the first left off
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select now() - %s * interval '1 second'
+""", (86400,)),
+            FETCH_ONE,
+            EXECUTE("""
+with batch as (
+    select ctid, time_removed
+    from property
+    where
+        time_removed < %s
+    order by time_removed
+    limit %s
+), removal as (
+    delete from property
+    where ctid = any(array(select ctid from batch))
+)
+select count(*), max(time_removed)
+from batch
+""", (cutoff, 2)),
+            FETCH_ONE,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+with batch as (
+    select ctid, time_removed
+    from property
+    where
+        time_removed < %s
+        and time_removed >= %s
+    order by time_removed
+    limit %s
+), removal as (
+    delete from property
+    where ctid = any(array(select ctid from batch))
+)
+select count(*), max(time_removed)
+from batch
+""", (cutoff, first, 2)),
+            FETCH_ONE,
+            COMMIT])
+
+    def test_dry_run(self):
+        add_fetch_result([(42,)])
+        add_fetch_result([(0,)])
+
+        self.assertEqual(
+                datahog.purge.run(self.p, 3600, tables=['node', 'edge'],
+                    dry_run=True),
+                {(0, 'node'): 42, (0, 'edge'): 0})
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select count(*)
+from node
+where time_removed < now() - %s * interval '1 second'
+""", (3600,)),
+            FETCH_ONE,
+            COMMIT,
+            GET_CURSOR,
+            EXECUTE("""
+select count(*)
+from edge
+where time_removed < now() - %s * interval '1 second'
+""", (3600,)),
+            FETCH_ONE,
+            COMMIT])
+
+    def test_bad_table(self):
+        self.assertRaises(ValueError, datahog.purge.run, self.p, 3600,
+                tables=['node; drop table node'])
+        self.assertEqual(eventlog, [])
+
+    def test_readonly(self):
+        self.p.readonly = True
+        try:
+            self.assertRaises(error.ReadOnly,
+                    datahog.purge.run, self.p, 3600)
+        finally:
+            self.p.readonly = False
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -277,6 +277,232 @@ returning 1
             COMMIT,
             TPC_COMMIT])
 
+    def test_create_many(self):
+        # 457 was already related
+        add_fetch_result([(1, False)])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.relationship.create_many(
+                    self.p, 3, 123, [456, 457, 456]),
+                [True, False, False])
+
+        self.assertEqual(eventlog, [
+            TPC_BEGIN,
+            GET_CURSOR,
+            EXECUTE("""
+with staged (n, base_id, rel_id) as (
+    values (%s, %s, %s), (%s, %s, %s)
+),
+eligible as (
+    select s.n, s.base_id, s.rel_id, s.base_id as id
+    from staged s
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=s.base_id
+    )
+),
+fresh as (
+    select e.n, e.base_id, e.rel_id, e.id
+    from eligible e
+    where not exists (
+        select 1
+        from relationship t
+        where
+            t.time_removed is null
+            and t.base_id=e.base_id
+            and t.rel_id=e.rel_id
+            and t.ctx=%s
+            and t.forward=%s
+    )
+),
+insertquery as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select fresh.base_id, fresh.rel_id, %s, %s, (
+        select count(*)
+        from relationship t
+        where
+            t.time_removed is null
+            and t.base_id=fresh.id
+            and t.ctx=%s
+            and t.forward=%s
+    ) + (row_number() over (
+        partition by fresh.id
+        order by fresh.n
+    ) - 1), %s
+    from fresh
+    returning 1
+)
+select s.n, s.n not in (select n from eligible)
+from staged s
+where s.n not in (select n from fresh)
+""", (0, 123, 456, 1, 123, 457, 3, True, 3, True, 3, True, 0)),
+            FETCH_ALL,
+            EXECUTE("""
+with staged (n, base_id, rel_id) as (
+    values (%s, %s, %s)
+),
+eligible as (
+    select s.n, s.base_id, s.rel_id, s.rel_id as id
+    from staged s
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=s.rel_id
+    )
+),
+fresh as (
+    select e.n, e.base_id, e.rel_id, e.id
+    from eligible e
+    where not exists (
+        select 1
+        from relationship t
+        where
+            t.time_removed is null
+            and t.base_id=e.base_id
+            and t.rel_id=e.rel_id
+            and t.ctx=%s
+            and t.forward=%s
+    )
+),
+insertquery as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select fresh.base_id, fresh.rel_id, %s, %s, (
+        select count(*)
+        from relationship t
+        where
+            t.time_removed is null
+            and t.rel_id=fresh.id
+            and t.ctx=%s
+            and t.forward=%s
+    ) + (row_number() over (
+        partition by fresh.id
+        order by fresh.n
+    ) - 1), %s
+    from fresh
+    returning 1
+)
+select s.n, s.n not in (select n from eligible)
+from staged s
+where s.n not in (select n from fresh)
+""", (0, 123, 456, 3, False, 3, False, 3, False, 0)),
+            FETCH_ALL,
+            TPC_PREPARE,
+            RESET,
+            TPC_COMMIT])
+
+    def test_create_many_sparse(self):
+        datahog.set_context(4, datahog.RELATIONSHIP, {
+            'base_ctx': 1, 'rel_ctx': 2, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([])
+        add_fetch_result([])
+
+        self.assertEqual(
+                datahog.relationship.create_many(self.p, 4, 123, [456]),
+                [True])
+
+        # an empty list starts one gap in, leaving room in front of it
+        self.assertEqual(eventlog[2], EXECUTE("""
+with staged (n, base_id, rel_id) as (
+    values (%s, %s, %s)
+),
+eligible as (
+    select s.n, s.base_id, s.rel_id, s.base_id as id
+    from staged s
+    where exists (
+        select 1
+        from node
+        where
+            time_removed is null
+            and id=s.base_id
+    )
+),
+fresh as (
+    select e.n, e.base_id, e.rel_id, e.id
+    from eligible e
+    where not exists (
+        select 1
+        from relationship t
+        where
+            t.time_removed is null
+            and t.base_id=e.base_id
+            and t.rel_id=e.rel_id
+            and t.ctx=%s
+            and t.forward=%s
+    )
+),
+insertquery as (
+    insert into relationship (base_id, rel_id, ctx, forward, pos, flags)
+    select fresh.base_id, fresh.rel_id, %s, %s, coalesce((
+        select pos + 65536
+        from relationship t
+        where
+            t.time_removed is null
+            and t.base_id=fresh.id
+            and t.ctx=%s
+            and t.forward=%s
+        order by pos desc
+        limit 1
+    ), 65536) + (row_number() over (
+        partition by fresh.id
+        order by fresh.n
+    ) - 1) * 65536, %s
+    from fresh
+    returning 1
+)
+select s.n, s.n not in (select n from eligible)
+from staged s
+where s.n not in (select n from fresh)
+""", (0, 123, 456, 4, True, 4, True, 4, True, 0)))
+
+    def test_create_many_across_shards(self):
+        p = self.shard_pool(3)
+        far = (1 << 56) + 456
+        farther = (2 << 56) + 457
+
+        # the first round finds farther missing, the second goes through
+        add_fetch_result([])
+        add_fetch_result([])
+        add_fetch_result([(1, True)])
+        add_fetch_result([])
+        add_fetch_result([])
+
+        results = datahog.relationship.create_many(
+                p, 3, 123, [far, farther])
+
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], error.NoObject)
+
+        # the staged rows and the forward flag of each statement
+        self.assertEqual([(e.args[:-7], e.args[-2])
+                for e in eventlog if isinstance(e, EXECUTE)], [
+            ((0, 123, far, 1, 123, farther), True),
+            ((0, 123, far), False),
+            ((1, 123, farther), False),
+            ((0, 123, far), True),
+            ((0, 123, far), False)])
+        self.assertEqual(
+                [e for e in eventlog if not isinstance(e, EXECUTE)], [
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_ROLLBACK, TPC_ROLLBACK, TPC_ROLLBACK,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_BEGIN, GET_CURSOR, FETCH_ALL, TPC_PREPARE, RESET,
+            TPC_COMMIT, TPC_COMMIT])
+
+    def test_create_many_no_base(self):
+        add_fetch_result([(0, True), (1, True)])
+
+        self.assertRaises(error.NoObject, datahog.relationship.create_many,
+                self.p, 3, 123, [456, 457])
+        self.assertEqual(eventlog[-1], TPC_ROLLBACK)
+
     def test_list_forwards(self):
         add_fetch_result([(456, 0, 0), (457, 0, 1), (458, 0, 2), (459, 0, 3)])
 
@@ -306,6 +532,34 @@ limit %s
             FETCH_ALL,
             COMMIT])
 
+    def test_iter_forwards(self):
+        add_fetch_result([(456, 0), (457, 0), (458, 0)])
+
+        self.assertEqual(
+                list(datahog.relationship.iter(self.p, 123, 3, itersize=3)),
+                [
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 456, 'flags': set([])},
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 457, 'flags': set([])},
+                    {'ctx': 3, 'base_id': 123, 'rel_id': 458, 'flags': set([])},
+                ])
+
+        self.assertEqual(eventlog, [
+            GET_NAMED_CURSOR,
+            EXECUTE("""
+select rel_id, flags
+from relationship
+where
+    time_removed is null
+    and base_id=%s
+    and ctx=%s
+    and forward=%s
+    and pos >= %s
+order by pos asc
+""", (123, 3, True, 0)),
+            FETCH_MANY,
+            FETCH_MANY,
+            COMMIT])
+
     def test_list_reverse(self):
         add_fetch_result([(123, 0, 0), (124, 0, 1), (125, 0, 2), (126, 0, 3)])
 
@@ -477,6 +731,30 @@ returning flags
                 datahog.relationship.set_flags(self.p, 123, 456, 3, [], [1, 3]),
                 None)
 
+    def test_batch_get(self):
+        datahog.set_flag(1, 3)
+        add_fetch_result([(123, 3, 789, 1), (123, 3, 456, 0)])
+
+        self.assertEqual(
+                datahog.relationship.batch_get(self.p,
+                    [(3, 123, 456), (3, 124, 456), (3, 123, 789)]),
+                [{'ctx': 3, 'base_id': 123, 'rel_id': 456, 'flags': set()},
+                None,
+                {'ctx': 3, 'base_id': 123, 'rel_id': 789, 'flags': set([1])}])
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select base_id, ctx, rel_id, flags
+from relationship
+where
+    time_removed is null
+    and forward=true
+    and (base_id, ctx, rel_id) in ((%s, %s, %s),(%s, %s, %s),(%s, %s, %s))
+""", (123, 3, 456, 124, 3, 456, 123, 3, 789)),
+            FETCH_ALL,
+            COMMIT])
+
     def test_set_flags_add(self):
         datahog.set_flag(1, 3)
         datahog.set_flag(2, 3)
@@ -632,6 +910,60 @@ select exists (select 1 from move)
             FETCH_ONE,
             COMMIT])
 
+    def test_shift_sparse_to_end(self):
+        datahog.set_context(4, datahog.RELATIONSHIP, {
+            'base_ctx': 1, 'rel_ctx': 2, 'ordering': datahog.ordering.SPARSE})
+        add_fetch_result([(1,)])
+        add_fetch_result([(65536,)])
+        add_fetch_result([None])
+
+        self.assertTrue(
+                datahog.relationship.shift(self.p, 123, 456, 4, True, 5))
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+select 1
+from relationship
+where
+    time_removed is null
+    and base_id=%s and ctx=%s and forward=%s
+    and base_id=%s and rel_id=%s
+for update
+""", (123, 4, True, 123, 456)),
+            ROWCOUNT,
+            EXECUTE("""
+select pos
+from relationship
+where
+    time_removed is null
+    and base_id=%s and ctx=%s and forward=%s
+    and not (base_id=%s and rel_id=%s)
+order by pos asc
+offset %s
+limit 2
+""", (123, 4, True, 123, 456, 4)),
+            FETCH_ALL,
+            EXECUTE("""
+update relationship
+set pos=coalesce((
+    select pos + 65536
+    from relationship
+    where
+        time_removed is null
+        and base_id=%s and ctx=%s and forward=%s
+        and not (base_id=%s and rel_id=%s)
+    order by pos desc
+    limit 1
+), 65536)
+where
+    time_removed is null
+    and base_id=%s and ctx=%s and forward=%s
+    and base_id=%s and rel_id=%s
+""", (123, 4, True, 123, 456, 123, 4, True, 123, 456)),
+            ROWCOUNT,
+            COMMIT])
+
     def test_shift_failure(self):
         add_fetch_result([(False,)])
 
@@ -749,6 +1081,70 @@ select 1 from removal
             COMMIT,
             TPC_COMMIT])
 
+    def test_remove_one_phase_local(self):
+        self.p.one_phase_local = True
+        add_fetch_result([(1,)])
+        add_fetch_result([(1,)])
+
+        self.assertEqual(
+                datahog.relationship.remove(self.p, 123, 456, 3),
+                True)
+
+        self.assertEqual(eventlog, [
+            GET_CURSOR,
+            EXECUTE("""
+with removal as (
+    update relationship
+    set time_removed=now()
+    where
+        time_removed is null
+        and base_id=%s
+        and ctx=%s
+        and forward=%s
+        and rel_id=%s
+    returning pos
+), bump as (
+    update relationship
+    set pos = pos - 1
+    where
+        exists (select 1 from removal)
+        and time_removed is null
+        and base_id=%s
+        and ctx=%s
+        and forward=%s
+        and pos > (select pos from removal)
+)
+select 1 from removal
+""", (123, 3, True, 456, 123, 3, True)),
+            ROWCOUNT,
+            GET_CURSOR,
+            EXECUTE("""
+with removal as (
+    update relationship
+    set time_removed=now()
+    where
+        time_removed is null
+        and base_id=%s
+        and ctx=%s
+        and forward=%s
+        and rel_id=%s
+    returning pos
+), bump as (
+    update relationship
+    set pos = pos - 1
+    where
+        exists (select 1 from removal)
+        and time_removed is null
+        and rel_id=%s
+        and ctx=%s
+        and forward=%s
+        and pos > (select pos from removal)
+)
+select 1 from removal
+""", (123, 3, False, 456, 456, 3, False)),
+            ROWCOUNT,
+            COMMIT])
+
     def test_remove_failure_forward(self):
         add_fetch_result([])
 